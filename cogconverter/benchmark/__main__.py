@@ -0,0 +1,69 @@
+import argparse
+import json
+import os
+import sys
+
+from cogconverter.benchmark import run
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m cogconverter.benchmark')
+    commands = parser.add_subparsers(dest='command')
+
+    bench = commands.add_parser('run', help='Run the benchmark matrix')
+    bench.add_argument('-o', '--output', help='Result JSON file',
+                       required=True)
+    bench.add_argument('-d', '--data',
+                       help='Folder caching the synthetic rasters',
+                       default='benchmark_data')
+    bench.add_argument('--cases', nargs='+', choices=sorted(run.CASES))
+    bench.add_argument('--sizes', nargs='+', type=int, default=run.SIZES)
+    bench.add_argument('--dtypes', nargs='+', default=run.DTYPES)
+    bench.add_argument('--bands', nargs='+', type=int, default=run.BANDS)
+    bench.add_argument('--nodata', nargs='+', type=float,
+                       default=run.NODATA_FRACTIONS,
+                       help='Fractions of nodata pixels')
+    bench.add_argument('--compressions', nargs='+',
+                       default=run.COMPRESSIONS)
+    bench.add_argument('--baseline',
+                       help='Compare with this result file when done')
+    bench.add_argument('--threshold', type=float, default=run.THRESHOLD)
+
+    diff = commands.add_parser('compare',
+                               help='Flag regressions against a baseline')
+    diff.add_argument('baseline')
+    diff.add_argument('current')
+    diff.add_argument('--threshold', type=float, default=run.THRESHOLD)
+
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        if not os.path.exists(args.data):
+            os.makedirs(args.data)
+        current = run.run(args.data, cases=args.cases, sizes=args.sizes,
+                          dtypes=args.dtypes, bands=args.bands,
+                          nodata_fractions=args.nodata,
+                          compressions=args.compressions)
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=4, separators=(',', ': '))
+        baseline_path = args.baseline
+    elif args.command == 'compare':
+        with open(args.current) as f:
+            current = json.load(f)
+        baseline_path = args.baseline
+    else:
+        parser.print_help()
+        sys.exit(2)
+
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        regressions = run.compare(baseline, current, args.threshold)
+        for regression in regressions:
+            print('Regression: %s %s %s -> %s (%+.1f%%)' % (
+                '/'.join(str(k) for k in regression['key']),
+                regression['metric'], regression['baseline'],
+                regression['current'], regression['change'] * 100))
+        print('%d regressions above %.0f%%' %
+              (len(regressions), args.threshold * 100))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,289 @@
+from osgeo import gdal
+import contextlib
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import time
+
+from cogconverter import converter
+from cogconverter import reader
+from cogconverter import simulator
+from cogconverter import validator
+from cogconverter.benchmark.synthetic import make_raster
+from cogconverter.config import default_config
+from cogconverter.src import create_alpha
+from cogconverter.src import pyramid
+from cogconverter.src.metadata import Metadata
+
+
+# Default benchmark matrix
+SIZES = [1024, 4096]
+DTYPES = ['uint8', 'uint16', 'float32']
+BANDS = [1, 3]
+NODATA_FRACTIONS = [0.0, 0.4]
+COMPRESSIONS = ['NONE', 'LZW']
+
+# Relative increase above which a case is reported as a regression
+THRESHOLD = 0.10
+
+# Recorded metrics compared against the baseline, lower is better
+METRICS = ('seconds', 'peak_rss_mb', 'output_bytes')
+
+
+def setup_copy(path_input, workdir):
+    path = os.path.join(workdir, 'input_' + os.path.basename(path_input))
+    shutil.copy(path_input, path)
+    return path
+
+
+def setup_cog(path_input, workdir):
+    path = os.path.join(workdir, 'cog_' + os.path.basename(path_input))
+    ds = converter.convert2blocksize(gdal.Open(path_input), path)
+    ds = None
+    return path
+
+
+def setup_cog_hilbert(path_input, workdir):
+    path = os.path.join(workdir, 'cog_' + os.path.basename(path_input))
+    ds = converter.convert2blocksize(gdal.Open(path_input), path,
+                                     tile_order='hilbert')
+    ds = None
+    return path
+
+
+def setup_none(path_input, workdir):
+    return path_input
+
+
+def run_convert_parallel(path, workdir):
+    path_output = os.path.join(workdir, 'output.tif')
+    ds = converter.convert2blocksize(gdal.Open(path), path_output,
+                                     engine='parallel')
+    ds = None
+    return path_output
+
+
+def run_convert_createcopy(path, workdir):
+    path_output = os.path.join(workdir, 'output.tif')
+    ds = converter.convert2blocksize(gdal.Open(path), path_output,
+                                     engine='createcopy')
+    ds.FlushCache()
+    ds = None
+    return path_output
+
+
+def run_alpha(path, workdir):
+    r = converter.raster(gdal.Open(path))
+    r.path_input = path
+    return create_alpha.create_alpha(
+        r, path_alpha=os.path.join(workdir, 'alpha.tif'))
+
+
+def run_pyramid(path, workdir):
+    ds = gdal.Open(path, gdal.GA_Update)
+    pyramid.pyramid(ds).gdal_addo()
+    ds = None
+    return path
+
+
+def run_validate_gdal(path, workdir):
+    validator.validate(path, backend='gdal')
+
+
+def run_validate_header(path, workdir):
+    validator.validate(path, backend='header')
+
+
+def run_metadata(path, workdir):
+    Metadata(path).extract()
+
+
+def run_read_gdal(path, workdir):
+    ds = gdal.Open(path)
+    width, height = ds.GetRasterBand(1).GetBlockSize()
+    for y in range(0, ds.RasterYSize, height):
+        for x in range(0, ds.RasterXSize, width):
+            ds.ReadAsArray(x, y, min(width, ds.RasterXSize - x),
+                           min(height, ds.RasterYSize - y))
+    ds = None
+
+
+def run_read_reader(path, workdir):
+    with reader.CogReader(path) as cog:
+        level = cog.levels[0]
+        # One coalesced read per tile row, as a viewport would fetch them
+        for y in range(level.tiles_y):
+            cog.tiles(0, [(x, y) for x in range(level.tiles_x)])
+
+
+def run_neighbourhoods(path, workdir):
+    return simulator.neighbourhoods(path)
+
+
+# Case name: (setup returning the timed function's input, timed function)
+CASES = {
+    'convert_parallel': (setup_none, run_convert_parallel),
+    'convert_createcopy': (setup_copy, run_convert_createcopy),
+    'create_alpha': (setup_none, run_alpha),
+    'pyramid_addo': (setup_copy, run_pyramid),
+    'validate_gdal': (setup_cog, run_validate_gdal),
+    'validate_header': (setup_cog, run_validate_header),
+    'metadata_extract': (setup_none, run_metadata),
+    'read_gdal': (setup_cog, run_read_gdal),
+    'read_reader': (setup_cog, run_read_reader),
+    'neighbourhood_row': (setup_cog, run_neighbourhoods),
+    'neighbourhood_hilbert': (setup_cog_hilbert, run_neighbourhoods),
+}
+
+
+def _setup(case, path_input, workdir, conn):
+    """Prepare the input of a case in its own process, so the memory it
+    needs is not counted in the peak RSS of the case."""
+    setup, _ = CASES[case]
+    try:
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            conn.send({'path': setup(path_input, workdir)})
+    except Exception as e:
+        conn.send({'error': '%s' % e})
+    finally:
+        conn.close()
+
+
+def _measure(case, path, workdir, conn):
+    """Run one case in a fresh process so peak RSS is its own.
+
+    A case returns the path of its output, or a dictionary of metrics
+    added to its result.
+    """
+    _, run = CASES[case]
+    try:
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            start = time.time()
+            path_output = run(path, workdir)
+            seconds = time.time() - start
+        metrics = {}
+        if isinstance(path_output, dict):
+            metrics, path_output = path_output, None
+        output_bytes = os.path.getsize(path_output) if path_output else None
+        # ru_maxrss is in kilobytes on Linux. Pool workers of the case
+        # report as children once they have exited
+        peak_rss = max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        conn.send(dict({'seconds': seconds, 'output_bytes': output_bytes,
+                        'peak_rss_mb': round(peak_rss / 1024.0, 1)},
+                       **metrics))
+    except Exception as e:
+        conn.send({'error': '%s' % e})
+    finally:
+        conn.close()
+
+
+def _spawn(target, *args):
+    """Run ``target(*args, conn)`` in a new process, return what it sends."""
+    parent, child = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=target, args=args + (child,))
+    process.start()
+    child.close()
+    result = parent.recv()
+    process.join()
+    return result
+
+
+def measure(case, path_input):
+    """Set up then time one case, each in a fresh process."""
+    workdir = tempfile.mkdtemp(prefix='cogconverter_bench_')
+    try:
+        setup = _spawn(_setup, case, path_input, workdir)
+        if 'error' in setup:
+            return setup
+        return _spawn(_measure, case, setup['path'], workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def environment():
+    return {
+        'gdal': gdal.VersionInfo('RELEASE_NAME'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'config': {'BLOCKSIZE': default_config.BLOCKSIZE,
+                   'COMPRESS': default_config.COMPRESS,
+                   'RESAMPLING': default_config.RESAMPLING,
+                   'ENGINE': default_config.ENGINE},
+    }
+
+
+def run(folder, cases=None, sizes=SIZES, dtypes=DTYPES, bands=BANDS,
+        nodata_fractions=NODATA_FRACTIONS, compressions=COMPRESSIONS):
+    """Time every case on every synthetic raster of the matrix.
+
+    Returns:
+      A dictionary with the environment and one result per case and raster.
+    """
+    cases = cases or list(CASES)
+    results = []
+    matrix = itertools.product(sizes, dtypes, bands, nodata_fractions,
+                               compressions)
+    for size, dtype, band_count, nodata, compression in matrix:
+        path_input = make_raster(folder, size, dtype, band_count, nodata,
+                                 compression)
+        itemsize = gdal.GetDataTypeSize(
+            gdal.Open(path_input).GetRasterBand(1).DataType) // 8
+        megabytes = size * size * band_count * itemsize / 1024.0 / 1024.0
+
+        for case in cases:
+            result = {'case': case, 'size': size, 'dtype': dtype,
+                      'bands': band_count, 'nodata': nodata,
+                      'compression': compression}
+            result.update(measure(case, path_input))
+            if 'seconds' in result:
+                result['mb_per_s'] = round(megabytes / result['seconds'], 2) \
+                    if result['seconds'] else None
+            print(json.dumps(result))
+            results.append(result)
+
+    return {'environment': environment(), 'results': results}
+
+
+def result_key(result):
+    return (result['case'], result['size'], result['dtype'],
+            result['bands'], result['nodata'], result['compression'])
+
+
+def compare(baseline, current, threshold=THRESHOLD):
+    """Compare two benchmark runs.
+
+    Every metric of METRICS recorded in both runs is compared, so a case
+    can regress in time, memory or output size.
+
+    Returns:
+      A list of regressions, each a dictionary with the case key, the
+      metric, both values and the relative change.
+    """
+    before = {result_key(r): r for r in baseline['results']
+              if 'seconds' in r}
+    regressions = []
+    for result in current['results']:
+        key = result_key(result)
+        if key not in before:
+            continue
+        for metric in METRICS:
+            old = before[key].get(metric)
+            new = result.get(metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / float(old) if old else 0.0
+            if change > threshold:
+                regressions.append({'key': key, 'metric': metric,
+                                    'baseline': old, 'current': new,
+                                    'change': round(change, 3)})
+    return regressions
@@ -0,0 +1,68 @@
+from osgeo import gdal
+from osgeo import gdal_array
+from osgeo import osr
+import numpy as np
+import os
+
+from cogconverter.config import default_config
+
+
+def synthetic_name(size, dtype, bands, nodata_fraction, compression):
+    return 'synthetic_%d_%s_%db_nd%02d_%s.tif' % (
+        size, dtype, bands, int(round(nodata_fraction * 100)),
+        compression.lower())
+
+
+def synthetic_array(size, dtype, bands, nodata_fraction, no_data, seed=0):
+    """Smooth gradients plus noise, compressible like real imagery.
+
+    The nodata part is a collar on the right of the raster, the shape left
+    behind by reprojection.
+    """
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:size, 0:size].astype(np.float32) / size
+    array = np.empty((bands, size, size), dtype=dtype)
+    if np.issubdtype(np.dtype(dtype), np.integer):
+        top = min(np.iinfo(dtype).max, 4000)
+    else:
+        top = 1000.0
+    for b in range(bands):
+        values = (np.sin(x * (3 + b)) + np.cos(y * (5 + b)) + 2) / 4 * top
+        values += rng.normal(0, top * 0.02, values.shape)
+        array[b] = np.clip(values, 1, top).astype(dtype)
+
+    collar = int(size * nodata_fraction)
+    if collar:
+        array[:, :, size - collar:] = no_data
+    return array
+
+
+def make_raster(folder, size, dtype='uint8', bands=1, nodata_fraction=0.0,
+                compression='NONE'):
+    """Write a georeferenced synthetic GTiff and return its path.
+
+    Rasters are cached by name in ``folder``.
+    """
+    path = os.path.join(folder, synthetic_name(size, dtype, bands,
+                                               nodata_fraction, compression))
+    if os.path.exists(path):
+        return path
+
+    no_data = 0
+    gdal_dtype = gdal_array.NumericTypeCodeToGDALTypeCode(np.dtype(dtype))
+    ds = gdal.GetDriverByName('GTiff').Create(
+        path, size, size, bands, gdal_dtype,
+        ['COMPRESS=%s' % compression, 'BIGTIFF=IF_SAFER'])
+
+    # One arc second pixels around 77E 13N
+    ds.SetGeoTransform([77.0, 1 / 3600.0, 0, 13.0, 0, -1 / 3600.0])
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(int(default_config.EPSG_CODE))
+    ds.SetProjection(srs.ExportToWkt())
+    array = synthetic_array(size, dtype, bands, nodata_fraction, no_data)
+    for b in range(bands):
+        band = ds.GetRasterBand(b + 1)
+        band.SetNoDataValue(no_data)
+        band.WriteArray(array[b])
+    ds = None
+    return path
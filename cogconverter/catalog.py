@@ -0,0 +1,352 @@
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import glob
+import json
+import math
+import os
+import re
+import sqlite3
+import sys
+import time
+
+from cogconverter import validator
+from cogconverter.src.metadata import Metadata
+
+
+# Size in degrees of the grid cells used when SQLite has no R-tree module
+GRID_CELL = 1.0
+
+# Rows written per transaction while scanning
+BATCH_SIZE = 500
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    numband INTEGER,
+    epsgcode TEXT,
+    datatype TEXT,
+    nodata REAL,
+    width INTEGER,
+    height INTEGER,
+    min_lon REAL,
+    min_lat REAL,
+    max_lon REAL,
+    max_lat REAL,
+    valid INTEGER,
+    warnings TEXT,
+    errors TEXT,
+    metadata TEXT,
+    error TEXT,
+    scanned REAL
+);
+CREATE INDEX IF NOT EXISTS files_dtype ON files (datatype);
+CREATE INDEX IF NOT EXISTS files_epsg ON files (epsgcode);
+'''
+
+
+def catalog_entry(path, backend='header'):
+    """Extract metadata and validate one file, run in worker processes."""
+    entry = {'path': path}
+    try:
+        entry['metadata'] = Metadata(path).extract()
+    except Exception as e:
+        entry['metadata'] = None
+        entry['error'] = '%s' % e
+    entry['validation'] = validator.validate_record(path, backend=backend)
+    return entry
+
+
+def is_finite(bbox):
+    return all(value is not None and math.isfinite(value) for value in bbox)
+
+
+def grid_cells(bbox, cell=GRID_CELL):
+    """Keys of the grid cells intersecting ``bbox``.
+
+    Bounds are clamped to the world, infinite ones included. A bbox with a
+    NaN bound has no cells.
+    """
+    if any(math.isnan(value) for value in bbox):
+        return
+    bbox = [min(max(value, -limit), limit)
+            for value, limit in zip(bbox, (180, 90, 180, 90))]
+    min_x = int(math.floor(bbox[0] / cell))
+    min_y = int(math.floor(bbox[1] / cell))
+    max_x = int(math.floor(bbox[2] / cell))
+    max_y = int(math.floor(bbox[3] / cell))
+    for x in range(min_x, max_x + 1):
+        for y in range(min_y, max_y + 1):
+            # Single integer key, longitude and latitude cells packed
+            yield (x + 1000000) * 2000000 + (y + 1000000)
+
+
+def scan_roots(inputs):
+    """Absolute folders and files a scan of ``inputs`` covers.
+
+    A glob covers the folder before its first wildcard.
+    """
+    roots = []
+    for item in inputs or ():
+        if glob.has_magic(item):
+            item = os.path.dirname(re.split(r'[*?[]', item, 1)[0])
+        roots.append(os.path.abspath(item or os.curdir))
+    return roots
+
+
+class Catalog(object):
+    """Persistent metadata and validation catalog of raster files.
+
+    Rows are keyed by path and remember the file size and mtime, so a scan
+    only processes new or changed files. A spatial index (SQLite R-tree, or
+    a degree grid when the R-tree module is missing) serves bbox queries.
+    """
+
+    def __init__(self, path_db):
+        self.path_db = path_db
+        self.db = sqlite3.connect(path_db)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+        self.rtree = self._create_spatial_index()
+
+    def _create_spatial_index(self):
+        try:
+            self.db.execute(
+                'CREATE VIRTUAL TABLE IF NOT EXISTS files_rtree USING '
+                'rtree(id, min_lon, max_lon, min_lat, max_lat)')
+            return True
+        except sqlite3.OperationalError:
+            self.db.execute('CREATE TABLE IF NOT EXISTS files_grid '
+                            '(cell INTEGER NOT NULL, id INTEGER NOT NULL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS files_grid_cell '
+                            'ON files_grid (cell)')
+            return False
+
+    def close(self):
+        self.db.close()
+
+    def known(self):
+        """Map of path to (size, mtime) for every cataloged file."""
+        return {row[0]: (row[1], row[2]) for row in
+                self.db.execute('SELECT path, size, mtime FROM files')}
+
+    def _unindex(self, file_id):
+        if self.rtree:
+            self.db.execute('DELETE FROM files_rtree WHERE id = ?', (file_id,))
+        else:
+            self.db.execute('DELETE FROM files_grid WHERE id = ?', (file_id,))
+
+    def _index(self, file_id, bbox):
+        if self.rtree:
+            self.db.execute('INSERT INTO files_rtree VALUES (?, ?, ?, ?, ?)',
+                            (file_id, bbox[0], bbox[2], bbox[1], bbox[3]))
+        else:
+            self.db.executemany(
+                'INSERT INTO files_grid VALUES (?, ?)',
+                [(cell, file_id) for cell in grid_cells(bbox)])
+
+    def store(self, entry, size, mtime):
+        metadata = entry['metadata'] or {}
+        validation = entry['validation']
+        bbox = metadata.get('bbox') or [None] * 4
+        size_px = metadata.get('size') or [None, None]
+
+        row = self.db.execute('SELECT id FROM files WHERE path = ?',
+                              (entry['path'],)).fetchone()
+        if row is not None:
+            self._unindex(row[0])
+            self.db.execute('DELETE FROM files WHERE id = ?', (row[0],))
+
+        cursor = self.db.execute(
+            'INSERT INTO files (path, size, mtime, numband, epsgcode, '
+            'datatype, nodata, width, height, min_lon, min_lat, max_lon, '
+            'max_lat, valid, warnings, errors, metadata, error, scanned) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, '
+            '?)',
+            (entry['path'], size, mtime, metadata.get('numband'),
+             metadata.get('epsgcode'), metadata.get('datatype'),
+             metadata.get('nodata'), size_px[0], size_px[1],
+             bbox[0], bbox[1], bbox[2], bbox[3],
+             int(validation['valid']), json.dumps(validation['warnings']),
+             json.dumps(validation['errors']), json.dumps(metadata),
+             entry.get('error'), time.time()))
+        # Files whose corners did not project have no usable bbox
+        if is_finite(bbox):
+            self._index(cursor.lastrowid, bbox)
+
+    def prune(self, seen, roots):
+        """Remove files under ``roots`` that were not ``seen`` by a scan.
+
+        ``roots`` are absolute folders and files, rows outside of them were
+        cataloged by other scans and are kept.
+        """
+        removed = 0
+        folders = tuple(os.path.join(root, '') for root in roots)
+        roots = set(roots)
+        rows = self.db.execute('SELECT id, path FROM files').fetchall()
+        for file_id, path in rows:
+            if path in seen:
+                continue
+            if path in roots or path.startswith(folders):
+                self._unindex(file_id)
+                self.db.execute('DELETE FROM files WHERE id = ?', (file_id,))
+                removed += 1
+        self.db.commit()
+        return removed
+
+    def scan(self, paths, workers=None, backend='header', prune=False,
+             roots=()):
+        """Catalog new or changed files among ``paths``.
+
+        Unchanged files (same size and mtime) cost one stat call. Changed
+        files are extracted and validated in a process pool. Paths are
+        stored absolute. With ``prune``, cataloged files that are missing
+        from ``paths`` are removed when they sit under ``roots`` (see
+        scan_roots) or were given in ``paths`` but no longer exist.
+
+        Returns:
+          A summary dictionary.
+        """
+        workers = workers or os.cpu_count() or 1
+        known = self.known()
+        seen = set()
+        missing = set()
+        summary = {'files': 0, 'unchanged': 0, 'updated': 0}
+        start = time.time()
+        stats = {}
+        written = [0]
+
+        def store(futures):
+            for future in futures:
+                entry = future.result()
+                size, mtime = stats.pop(entry['path'])
+                self.store(entry, size, mtime)
+                summary['updated'] += 1
+                written[0] += 1
+                if written[0] % BATCH_SIZE == 0:
+                    self.db.commit()
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            for path in paths:
+                path = os.path.abspath(path)
+                # Inputs may overlap, e.g. a folder and a glob inside it
+                if path in seen or path in missing:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    missing.add(path)
+                    continue
+                summary['files'] += 1
+                seen.add(path)
+                if known.get(path) == (stat.st_size, stat.st_mtime):
+                    summary['unchanged'] += 1
+                    continue
+
+                if len(pending) >= workers * 4:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    store(done)
+                stats[path] = (stat.st_size, stat.st_mtime)
+                pending.add(executor.submit(catalog_entry, path, backend))
+            store(wait(pending).done)
+        self.db.commit()
+
+        if prune:
+            summary['removed'] = self.prune(seen, missing.union(roots))
+        summary['seconds'] = round(time.time() - start, 3)
+        return summary
+
+    def query(self, bbox=None, datatype=None, epsgcode=None, valid=None):
+        """Yield cataloged files matching every given filter.
+
+        Args:
+          bbox: [min_lon, min_lat, max_lon, max_lat] the file must intersect.
+          datatype: numpy dtype name, e.g. 'uint8'.
+          epsgcode: EPSG code of the file, e.g. '4326'.
+          valid: True or False to filter on the COG validation result.
+        """
+        sql = 'SELECT files.* FROM files'
+        where = []
+        params = []
+        if bbox is not None:
+            if self.rtree:
+                sql += ' JOIN files_rtree ON files_rtree.id = files.id'
+                where.append('files_rtree.max_lon >= ? AND '
+                             'files_rtree.min_lon <= ? AND '
+                             'files_rtree.max_lat >= ? AND '
+                             'files_rtree.min_lat <= ?')
+                params += [bbox[0], bbox[2], bbox[1], bbox[3]]
+            else:
+                # A NaN bound has no cells, cell 0 is never used
+                cells = list(grid_cells(bbox)) or [0]
+                where.append('files.id IN (SELECT id FROM files_grid WHERE '
+                             'cell IN (%s))' % ','.join('?' * len(cells)))
+                params += cells
+                where.append('files.max_lon >= ? AND files.min_lon <= ? AND '
+                             'files.max_lat >= ? AND files.min_lat <= ?')
+                params += [bbox[0], bbox[2], bbox[1], bbox[3]]
+        if datatype is not None:
+            where.append('files.datatype = ?')
+            params.append(datatype)
+        if epsgcode is not None:
+            where.append('files.epsgcode = ?')
+            params.append(str(epsgcode))
+        if valid is not None:
+            where.append('files.valid = ?')
+            params.append(int(valid))
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+
+        for row in self.db.execute(sql, params):
+            record = dict(row)
+            record['warnings'] = json.loads(record['warnings'])
+            record['errors'] = json.loads(record['errors'])
+            record['metadata'] = json.loads(record['metadata'])
+            yield record
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--database',
+                        help='Catalog SQLite file', required=True)
+    commands = parser.add_subparsers(dest='command')
+
+    scan = commands.add_parser('scan', help='Catalog new or changed files')
+    scan.add_argument('-i', '--inputs',
+                      help='Files, directories or globs', nargs='+')
+    scan.add_argument('-l', '--file-list',
+                      help='File with one path per line, - for stdin')
+    scan.add_argument('-w', '--workers', type=int,
+                      help='Number of worker processes, default all CPUs')
+    scan.add_argument('--prune', action='store_true',
+                      help='Remove cataloged files under the inputs that '
+                      'this scan did not find')
+
+    query = commands.add_parser('query', help='Print matching files as JSON')
+    query.add_argument('--bbox', type=float, nargs=4,
+                       metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'))
+    query.add_argument('--dtype')
+    query.add_argument('--epsg')
+    query.add_argument('--valid', choices=['yes', 'no'])
+
+    args = parser.parse_args()
+    catalog = Catalog(args.database)
+    try:
+        if args.command == 'scan':
+            paths = validator.iter_paths(args.inputs, args.file_list)
+            summary = catalog.scan(paths, workers=args.workers,
+                                   prune=args.prune,
+                                   roots=scan_roots(args.inputs))
+            sys.stderr.write('Summary: %s\n' % json.dumps(summary))
+        elif args.command == 'query':
+            valid = None if args.valid is None else args.valid == 'yes'
+            for record in catalog.query(bbox=args.bbox, datatype=args.dtype,
+                                        epsgcode=args.epsg, valid=valid):
+                sys.stdout.write(json.dumps(record) + '\n')
+        else:
+            parser.print_help()
+    finally:
+        catalog.close()
@@ -6,4 +6,89 @@ RESAMPLING = 'NEAREST'
 BLOCKSIZE = 256
 INTERMEDIATE_FORMAT = 'VRT'
 EPSG_CRS = 'EPSG:4326'
-EPSG_CODE = '4326'
\ No newline at end of file
+EPSG_CODE = '4326'
+
+# Conversion engine: 'parallel' tile encoding or 'createcopy' fallback
+ENGINE = 'parallel'
+# Number of worker processes, None for all CPUs
+WORKERS = None
+OVERVIEW_LEVELS = [2, 4, 8, 16, 32, 64]
+
+# Scratch raster holding the warped source, see src/scratch.py
+SCRATCH_DIR = None
+SCRATCH_MEMORY_MB = 1024
+SCRATCH_DISK_MB = None
+SCRATCH_COMPRESS = 'NONE'
+
+# Warper settings, see src/warp.py. None threads means all CPUs
+WARP_MEMORY_MB = 512
+WARP_THREADS = None
+
+# Transparency of create_alpha: 'mask' for an internal mask, 'band' for alpha
+ALPHA_MODE = 'mask'
+# Memory of the strips create_alpha holds at once
+ALPHA_MEMORY_MB = 512
+# Memory of the strips the overview build holds at once, see src/overview.py
+OVERVIEW_MEMORY_MB = 512
+
+# Codec auto selection, see src/codec.py
+COMPRESS_POLICY = 'lossless'
+CODEC_SAMPLES = 8
+LERC_MAX_Z_ERROR = 0
+JPEG_QUALITY = 85
+WEBP_LEVEL = 90
+
+# Layout planner, see src/layout.py. Uncompressed bytes allowed in one tile
+MAX_TILE_BYTES = 4 * 1024 * 1024
+
+# Skip tiles holding only nodata, written with zero offset and byte count
+SPARSE = True
+
+# Skip conversion of inputs that already are compliant COGs, see
+# src/preflight.py. Results are cached by content fingerprint
+PREFLIGHT_ACTION = 'link'
+PREFLIGHT_CACHE = os.path.join(os.path.expanduser('~'), '.cache',
+                               'cogconverter', 'preflight.json')
+PREFLIGHT_CACHE_ENTRIES = 10000
+
+# Tiles encoded between two checkpoints of a resumable conversion
+CHECKPOINT_TILES = 256
+
+# Per-band statistics and histograms gathered while encoding, see
+# src/stats.py
+STATISTICS = True
+HISTOGRAM_BINS = 256
+
+# Store values with the smallest lossless dtype, see src/narrow.py
+NARROW = False
+
+# Mosaic of many inputs, see src/mosaic.py: 'first', 'last' or 'fill'
+MOSAIC_OVERLAP = 'fill'
+MOSAIC_OPEN_FILES = 64
+
+# Grid split into many COGs, see src/split.py. Attempts per failed shard,
+# seconds between touches of a running shard and seconds without a touch
+# before a shard is taken back from its worker
+SPLIT_RETRIES = 2
+SPLIT_HEARTBEAT = 30
+SPLIT_STALE_SECONDS = 300
+
+# Tile reader, see reader.py. Decoded tiles cache, parsed headers cached and
+# largest gap in bytes between tiles read in one request
+READER_TILE_CACHE_MB = 256
+READER_HEADER_CACHE = 64
+READER_COALESCE_GAP = 64 * 1024
+
+# Output layout: 'row' or 'hilbert' tile order within each level, the
+# bytes a client fetches first, which should hold the whole header, and
+# whether a written header larger than that fails the conversion
+TILE_ORDER = 'row'
+HEADER_PREFETCH = 16384
+HEADER_STRICT = False
+
+# Output to s3:// urls, see src/sink.py. The endpoint is None for AWS, or the
+# url of an S3 compatible server
+S3_ENDPOINT_URL = os.environ.get('COGCONVERTER_S3_ENDPOINT')
+S3_PART_MB = 16
+S3_UPLOAD_WORKERS = 4
+S3_RETRIES = 3
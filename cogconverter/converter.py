@@ -10,10 +10,23 @@ except:
 import numpy as np
 import os
 import sys
-from tqdm import tqdm
 import argparse
+from cogconverter import validator
 from cogconverter.config import default_config
+from cogconverter.src import codec
+from cogconverter.src import copier
+from cogconverter.src import engine as tile_engine
+from cogconverter.src import instrument
+from cogconverter.src import layout
+from cogconverter.src import mosaic
+from cogconverter.src import narrow
+from cogconverter.src import overview
+from cogconverter.src import preflight
 from cogconverter.src import pyramid
+from cogconverter.src import scratch
+from cogconverter.src import sink
+from cogconverter.src import split
+from cogconverter.src import warp
 
 """
 -co TILED=YES -co COMPRESS=JPEG -co PHOTOMETRIC=YCBCR -co COPY_SRC_OVERVIEWS=YES \
@@ -69,6 +82,10 @@ class raster(object):
         # Check for pyramids and overviews, 0 if no overviews
         self.overview = self.ds.GetRasterBand(1).GetOverviewCount()
 
+        # Pixels and uncompressed bytes, for instrumentation
+        self.pixels = self.col * self.row * self.num_band
+        self.nbytes = self.pixels * self.dtype.itemsize
+
         # # Origin and pixel length
         # self.originX = self.geotransform[0]
         # self.originY = self.geotransform[3]
@@ -119,11 +136,25 @@ class raster(object):
         else:
             return gdal.GDT_Float32
 
-    def gdal_addo(self):
+    def gdal_addo(self, factors=None):
+        # Overview factors of the layout plan unless given
+        if factors is None:
+            factors = layout.plan_dataset(self.ds, self.compression).factors
+
         # 0 = read-only, 1 = read-write.
-        if self.overview == 0:
+        if not factors:
+            print('Raster fits in one tile. Thus skipping overviews!')
+        elif self.overview == 0:
             gdal.SetConfigOption('COMPRESS_OVERVIEW', 'LZW')
-            self.ds.BuildOverviews("NEAREST", [2, 4, 8, 16, 32, 64])
+            with instrument.stage('overview', pixels=self.pixels,
+                                  bytes_read=self.nbytes) as fields:
+                # Each level is resampled from the previous one
+                bytes_read = overview.build_overviews(self.ds, factors,
+                                                      "NEAREST")
+                if bytes_read is not None:
+                    fields['bytes_read'] = bytes_read
+                    fields['read_ratio'] = round(
+                        bytes_read / float(self.nbytes), 3)
             print('Completed: Generating overviews')
         else:
             print('Overviews already generated. Thus skipping!')
@@ -137,33 +168,9 @@ def write_blockwise(input_raster, output_raster):
     assert isinstance(input_raster, raster), __name__ + \
         'Excepted raster class type'
 
-    dimension = input_raster.num_band
-
-    for num_band in range(dimension):
-        print('Processing: Band %d' % (num_band))
-        input_band = input_raster.ds.GetRasterBand(num_band+1)
-        output_band = output_raster.GetRasterBand(num_band+1)
-        block_x, block_y = input_band.GetBlockSize()
-        # block_x, block_y = 5000, 5000
-
-        size_x = input_band.XSize
-        size_y = input_band.YSize
-
-        for x in tqdm(range(0, int(size_x), int(block_x))):
-            if x + block_x < size_x:
-                col = block_x
-            else:
-                col = size_x - x
-
-            for y in range(0, int(size_y), int(block_y)):
-                if y + block_y < size_y:
-                    row = block_y
-                else:
-                    row = size_y - y
-
-                array = input_band.ReadAsArray(x, y, col, row)
-                output_band.WriteArray(array, x, y)
-                del array
+    # Strips of every band are read ahead while earlier ones are written
+    print('Processing: Copying %d bands blockwise' % input_raster.num_band)
+    return copier.BlockCopier(input_raster.ds, output_raster).run()
 
 
 def checkdirs(path):
@@ -171,16 +178,50 @@ def checkdirs(path):
         os.makedirs(path)
 
 
-def convert2blocksize(ds, path_output):
+def convert2blocksize(ds, path_output, engine=default_config.ENGINE,
+                      workers=default_config.WORKERS, compression=None,
+                      policy=default_config.COMPRESS_POLICY,
+                      blocksize=None, dry_run=False, cascade=False,
+                      sparse=default_config.SPARSE, resume=False,
+                      statistics=default_config.STATISTICS,
+                      narrowing=default_config.NARROW, reader=None,
+                      tile_order=default_config.TILE_ORDER, inputs=None):
     '''
-    path_input is input file name
+    ds is the input gdal dataset
     path_output is output file name
+    engine is 'parallel' to encode tiles in a process pool, or 'createcopy'
+    to build overviews on the input and hand everything to one CreateCopy
+    workers is the number of processes of the parallel engine
+    compression is None to keep the input compression, a codec name, or
+    'auto' to trial-encode sampled tiles and pick a codec by policy. It can
+    also be a creation options list, like the one 'auto' picks
+    policy is 'smallest', 'lossless' or 'fastest-decode', used by 'auto'
+    blocksize is None to let the layout planner pick the tile size
+    dry_run returns the layout plan without writing anything
+    cascade builds the pyramid into ds first, each level from the previous
+    one, and lets the parallel engine read its overview tiles from it
+    sparse skips tiles holding only nodata, they are written with zero
+    offset and byte count
+    resume keeps a checkpoint journal next to the output, so a rerun after
+    a crash continues where the previous run stopped (parallel engine only)
+    statistics stores per-band statistics and histograms gathered while
+    encoding in the output metadata (parallel engine only)
+    narrowing scans the values once and stores them with the smallest
+    lossless dtype, remapping nodata if needed (parallel engine only). A
+    narrow.Narrowing decided beforehand is used as is, without a scan
+    reader replaces the tile reads from ds, a mosaic.Mosaic for example
+    (parallel engine only)
+    tile_order is 'row' or 'hilbert' to keep neighbouring tiles next to
+    each other in the file (parallel engine only)
+    inputs are the files ds was made from, a checkpoint journal is only
+    resumed while they are unchanged. By default the files behind ds,
+    which for a scratch copy is the scratch itself (parallel engine only)
+    path_output can be a s3:// url, the COG is then uploaded in parts while
+    it is assembled and None is returned (parallel engine only)
     '''
     assert isinstance(ds, osgeo.gdal.Dataset), __name__ + \
         'Excepted osgeo.gdal class type'
 
-    blocksize = default_config.BLOCKSIZE
-
     r = raster(ds)
     # Loading cnfiguration
     r.config()
@@ -189,25 +230,129 @@ def convert2blocksize(ds, path_output):
     if len(r.geoprojection) == 0:
         raise('Error: GeoProjection of input file is not defined')
 
-    # Building overviews
-    print('Processing: Building overviews')
-    r.gdal_addo()
-
-    # Creating tifs
-    print('Processing: Creating tiff dataset')
-    driver = gdal.GetDriverByName('Gtiff')
-    try:
-        dataset = driver.CreateCopy(path_output,
-                                    r.ds, 0,
-                                    ['NUM_THREADS=ALL_CPUS',
-                                     'COMPRESS=%s' % (r.compression),
-                                     'BIGTIFF=YES',
-                                     'TILED=YES',
-                                     'BLOCKXSIZE=%d' % (blocksize),
-                                     'BLOCKYSIZE=%d' % (blocksize),
-                                     'COPY_SRC_OVERVIEWS=YES'])
-    except Exception as e:
-        raise('Error: Unable to process %s' % e)
+    # Narrowing first, codec and layout suit the dtype tiles are stored with
+    r.narrowing = None
+    itemsize = None
+    if isinstance(narrowing, narrow.Narrowing):
+        # Decided for the whole raster, e.g. once for every shard of a split
+        r.narrowing = narrowing
+    elif narrowing and engine == 'parallel' and not dry_run:
+        print('Processing: Scanning value range')
+        r.narrowing = narrow.plan(r.ds)
+    if r.narrowing is not None:
+        print(r.narrowing)
+        if r.narrowing.changed:
+            itemsize = r.narrowing.target.itemsize
+        else:
+            r.narrowing = None
+
+    # Tile size, overview factors and interleave from raster size and codec
+    plan = layout.plan_dataset(r.ds, compression or r.compression, blocksize,
+                               itemsize)
+    blocksize = plan.blocksize
+
+    if isinstance(compression, str) and compression.upper() == 'AUTO':
+        if dry_run:
+            return plan
+        print('Processing: Trial encoding sampled tiles')
+        r.compression, r.codec_report = codec.select(
+            r.ds, policy=policy, blocksize=blocksize, workers=workers,
+            narrowing=r.narrowing)
+        plan = layout.plan_dataset(r.ds, r.compression, blocksize, itemsize)
+    elif compression is not None:
+        r.compression = compression
+
+    if dry_run:
+        return plan
+    print('Layout: %d px tiles, %s interleave, overviews %s' %
+          (plan.blocksize, plan.interleave, plan.factors))
+
+    if resume and engine != 'parallel':
+        raise ValueError('Resuming needs the parallel engine')
+    if reader is not None and engine != 'parallel':
+        raise ValueError('Mosaicking needs the parallel engine')
+    if tile_order != 'row' and engine != 'parallel':
+        raise ValueError('Tile orders other than row need the parallel '
+                         'engine')
+    if sink.is_remote(path_output) and engine != 'parallel':
+        raise ValueError('Remote outputs need the parallel engine')
+
+    if engine == 'parallel':
+        if cascade:
+            print('Processing: Building overviews')
+            r.gdal_addo(plan.factors)
+        print('Processing: Creating tiff dataset with parallel engine')
+        job = tile_engine.TileEngine(r.ds, path_output,
+                                     blocksize=blocksize,
+                                     compression=r.compression,
+                                     overview_levels=plan.factors,
+                                     workers=workers,
+                                     interleave=plan.interleave,
+                                     sparse=sparse,
+                                     resume=resume,
+                                     statistics=statistics,
+                                     narrowing=r.narrowing,
+                                     reader=reader,
+                                     tile_order=tile_order,
+                                     inputs=inputs)
+        job.run()
+        job.check()
+        print('Success: Creating tiff dataset completed')
+        if sink.is_remote(path_output):
+            return None
+        return gdal.Open(path_output)
+
+    if engine != 'createcopy':
+        raise ValueError('Unknown engine %s' % engine)
+
+    # Overviews are only built into a scratch copy we own, a source used
+    # as is gets a VRT wrapper so no .ovr is written next to the input
+    with scratch.VrtWrapper(r.ds, wrap=not cascade) as source:
+        r.ds = source
+
+        # Building overviews
+        print('Processing: Building overviews')
+        r.gdal_addo(plan.factors)
+
+        # Creating tifs
+        print('Processing: Creating tiff dataset')
+        gdal.SetConfigOption('GDAL_TIFF_OVR_BLOCKSIZE',
+                             str(plan.ovr_blocksize))
+        driver = gdal.GetDriverByName('Gtiff')
+        try:
+            with instrument.stage('createcopy', pixels=r.pixels,
+                                  bytes_read=r.nbytes) as fields:
+                dataset = driver.CreateCopy(
+                    path_output,
+                    r.ds, 0,
+                    ['NUM_THREADS=ALL_CPUS'] +
+                    codec.as_options(r.compression) +
+                    ['BIGTIFF=YES',
+                     'TILED=YES',
+                     'BLOCKXSIZE=%d' % (blocksize),
+                     'BLOCKYSIZE=%d' % (blocksize),
+                     'INTERLEAVE=%s' % plan.interleave,
+                     'SPARSE_OK=%s' % ('TRUE' if sparse else 'FALSE'),
+                     'COPY_SRC_OVERVIEWS=YES'],
+                    callback=instrument.progress('createcopy', r.pixels))
+                if dataset is None:
+                    raise RuntimeError(gdal.GetLastErrorMsg())
+                # Size and header are only final once the file is closed
+                dataset.FlushCache()
+                dataset = None
+                fields['bytes_written'] = os.path.getsize(path_output)
+                if sparse:
+                    # Count the blocks GDAL skipped from the written header
+                    _, _, details = validator.validate(path_output,
+                                                       backend='header')
+                    fields['sparse_tiles'] = sum(
+                        details['sparse_tiles'].values())
+        except Exception as e:
+            raise RuntimeError('Error: Unable to process %s' % e)
+        r.ds = source = None
+
+    # Reopen the closed output for the caller
+    dataset = gdal.Open(path_output)
 
     print('Success: Creating tiff dataset completed')
     return dataset
@@ -250,16 +395,152 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
     parser.add_argument('-p', '--payload',
-                        help='Pass input file',
+                        help='Pass input file, several to mosaic them',
+                        nargs='+',
                         required=True)
 
     parser.add_argument('-o', '--output',
-                        help='Pass output file',
+                        help='Pass output file, or a s3://bucket/key url',
                         default=None,
                         required=False)
 
+    parser.add_argument('-e', '--engine',
+                        help='Conversion engine',
+                        choices=['parallel', 'createcopy'],
+                        default=default_config.ENGINE,
+                        required=False)
+
+    parser.add_argument('-w', '--workers',
+                        help='Number of worker processes, default all CPUs',
+                        type=int,
+                        default=default_config.WORKERS,
+                        required=False)
+
+    parser.add_argument('-c', '--compression',
+                        help='Codec, default the input one. auto to pick '
+                        'one by trial encoding sampled tiles',
+                        default=None,
+                        required=False)
+
+    parser.add_argument('--policy',
+                        help='Codec choice of --compression auto',
+                        choices=codec.POLICIES,
+                        default=default_config.COMPRESS_POLICY,
+                        required=False)
+
+    parser.add_argument('--scratch-dir',
+                        help='Folder of the warped scratch raster',
+                        default=default_config.SCRATCH_DIR,
+                        required=False)
+
+    parser.add_argument('--scratch-memory',
+                        help='Memory budget of the scratch raster in MB',
+                        type=int,
+                        default=default_config.SCRATCH_MEMORY_MB,
+                        required=False)
+
+    parser.add_argument('--scratch-disk',
+                        help='Disk budget of the scratch raster in MB',
+                        type=int,
+                        default=default_config.SCRATCH_DISK_MB,
+                        required=False)
+
+    parser.add_argument('--warp-memory',
+                        help='Warp memory limit in MB',
+                        type=int,
+                        default=default_config.WARP_MEMORY_MB,
+                        required=False)
+
+    parser.add_argument('--warp-threads',
+                        help='Number of warp threads, default all CPUs',
+                        type=int,
+                        default=default_config.WARP_THREADS,
+                        required=False)
+
+    parser.add_argument('-b', '--blocksize',
+                        help='Tile size, default picked from the raster size',
+                        type=int,
+                        default=None,
+                        required=False)
+
+    parser.add_argument('--overlap',
+                        help='Input kept where mosaicked inputs overlap',
+                        choices=mosaic.OVERLAPS,
+                        default=default_config.MOSAIC_OVERLAP,
+                        required=False)
+
+    parser.add_argument('--no-sparse',
+                        help='Write tiles holding only nodata too',
+                        dest='sparse',
+                        action='store_false',
+                        default=default_config.SPARSE,
+                        required=False)
+
+    parser.add_argument('--narrow',
+                        help='Store values with the smallest lossless dtype',
+                        action='store_true',
+                        default=default_config.NARROW,
+                        required=False)
+
+    parser.add_argument('--no-stats',
+                        help='Do not store band statistics and histograms',
+                        dest='statistics',
+                        action='store_false',
+                        default=default_config.STATISTICS,
+                        required=False)
+
+    parser.add_argument('--resume',
+                        help='Checkpoint encoded tiles and continue an '
+                        'interrupted conversion',
+                        action='store_true',
+                        required=False)
+
+    parser.add_argument('--on-compliant',
+                        help='What to do when the input already is a COG '
+                        'with the requested settings',
+                        choices=preflight.ACTIONS,
+                        default=default_config.PREFLIGHT_ACTION,
+                        required=False)
+
+    parser.add_argument('--force',
+                        help='Convert even if the input already is compliant',
+                        action='store_true',
+                        required=False)
+
+    parser.add_argument('--tile-order',
+                        help='Order of the tiles within each level',
+                        choices=tile_engine.TILE_ORDERS,
+                        default=default_config.TILE_ORDER,
+                        required=False)
+
+    parser.add_argument('--split-px',
+                        help='Split into shard COGs of this side in pixels, '
+                        'output is a folder',
+                        type=int,
+                        default=None,
+                        required=False)
+
+    parser.add_argument('--split-geo',
+                        help='Split into shard COGs of this side in SRS '
+                        'units, output is a folder',
+                        type=float,
+                        default=None,
+                        required=False)
+
+    parser.add_argument('--queue',
+                        help='Work queue folder of a split, default '
+                        '<output>/.queue',
+                        default=None,
+                        required=False)
+
+    parser.add_argument('--dry-run',
+                        help='Print the layout plan and exit',
+                        action='store_true',
+                        required=False)
+
     args = parser.parse_args()
-    path_input = args.payload
+    paths_input = args.payload
+    path_input = paths_input[0]
     path_output = args.output
 
     # Standard parameters
@@ -268,20 +549,131 @@ if __name__ == '__main__':
 
     # Reading raster
     # ds = gdal.Open(path_input)
-    if not os.path.exists(path_input):
-        raise('Error: File not found')
-    
-    ds = gdal.Warp('', path_input, dstSRS=coordinate,
-              format=intermediate_format)
-
-    ds1 = convert2blocksize(ds, path_output)
+    for path in paths_input:
+        if not os.path.exists(path):
+            raise FileNotFoundError('Error: File not found %s' % path)
+
+    # Many inputs are mosaicked tile by tile straight into the encoder
+    if len(paths_input) > 1:
+        with instrument.job(path_input, output=path_output,
+                            inputs=len(paths_input)), \
+                mosaic.Mosaic(paths_input, coordinate, overlap=args.overlap,
+                              folder=args.scratch_dir,
+                              warp_memory_mb=args.warp_memory,
+                              warp_threads=args.warp_threads) as source:
+            ds1 = convert2blocksize(source.ds, path_output,
+                                    engine=args.engine,
+                                    workers=args.workers,
+                                    compression=args.compression,
+                                    policy=args.policy,
+                                    blocksize=args.blocksize,
+                                    dry_run=args.dry_run,
+                                    sparse=args.sparse,
+                                    resume=args.resume,
+                                    statistics=args.statistics,
+                                    narrowing=args.narrow,
+                                    reader=source,
+                                    tile_order=args.tile_order,
+                                    inputs=paths_input)
+            if args.dry_run:
+                print(ds1)
+            ds1 = None
+        sys.exit()
+
+    # Huge rasters are split into shard COGs converted in parallel
+    if args.split_px or args.split_geo:
+        if sink.is_remote(path_output):
+            parser.error('Split outputs must be a local folder')
+        checkdirs(path_output)
+        with instrument.job(path_input, output=path_output):
+            queue = split.plan(path_input, path_output, coordinate,
+                               blocksize=args.blocksize or
+                               default_config.BLOCKSIZE,
+                               shard_px=args.split_px,
+                               shard_geo=args.split_geo,
+                               options={'compression': args.compression,
+                                        'policy': args.policy,
+                                        'sparse': args.sparse,
+                                        'statistics': args.statistics,
+                                        'narrowing': args.narrow,
+                                        'tile_order': args.tile_order},
+                               folder_queue=args.queue)
+            failed = split.run(queue, args.workers)
+            path_json, path_vrt = split.manifest(queue, path_output)
+        print('Success: Manifest %s, mosaic %s' % (path_json, path_vrt))
+        if failed:
+            print('Error: %d shards failed, rerun to retry them' % failed)
+        sys.exit()
+
+    # Nothing to do when the input already is what we would write
+    if not args.force:
+        result = preflight.check(path_input, coordinate,
+                                 compression=args.compression,
+                                 blocksize=args.blocksize,
+                                 cache=preflight.PreflightCache(),
+                                 sparse=args.sparse,
+                                 narrowing=args.narrow,
+                                 statistics=args.statistics)
+        print(result)
+        instrument.emit(dict({'event': 'preflight', 'job': path_input,
+                              'cached': result.cached}, **result.as_dict()))
+        if result.compliant and not args.dry_run:
+            if preflight.deliver(path_input, path_output, args.on_compliant):
+                print('Success: %s provided as %s' % (path_input, path_output))
+            sys.exit()
+
+    # Reproject only when the source is not already in the target SRS
+    warp_plan = warp.plan(path_input, coordinate)
+    print(warp_plan)
+    instrument.emit({'event': 'warp_plan', 'job': path_input,
+                     'action': warp_plan.action,
+                     'reason': warp_plan.reason})
+    ds = warp.open_source(warp_plan, warp_memory_mb=args.warp_memory,
+                          threads=args.warp_threads,
+                          intermediate_format=intermediate_format)
+
+    if args.dry_run:
+        print(convert2blocksize(ds, path_output, engine=args.engine,
+                                compression=args.compression,
+                                blocksize=args.blocksize, dry_run=True))
+        sys.exit()
+
+    # Warp once, overviews and encoding both read the scratch copy. It is
+    # tiled like the output before narrowing, which only grows the tiles
+    blocksize = convert2blocksize(ds, path_output,
+                                  compression=args.compression,
+                                  blocksize=args.blocksize,
+                                  dry_run=True).blocksize
+    scratch_raster = scratch.ScratchRaster(
+        ds, folder=args.scratch_dir, memory_mb=args.scratch_memory,
+        disk_mb=args.scratch_disk, blocksize=blocksize,
+        workers=args.workers if args.engine == 'parallel' else 1)
+    with instrument.job(path_input, output=path_output), \
+            scratch_raster as scratch_ds:
+        # Overviews can only be cascaded into a scratch copy we own
+        ds1 = convert2blocksize(scratch_ds, path_output, engine=args.engine,
+                                workers=args.workers,
+                                compression=args.compression,
+                                policy=args.policy,
+                                blocksize=args.blocksize,
+                                cascade=scratch_raster.path is not None,
+                                sparse=args.sparse,
+                                resume=args.resume,
+                                statistics=args.statistics,
+                                narrowing=args.narrow,
+                                tile_order=args.tile_order,
+                                inputs=[path_input])
+        try:
+            print('Processing: Flushing')
+            with instrument.stage('flush'):
+                # Remote outputs are complete once uploaded
+                if ds1 is not None:
+                    ds1.FlushCache()
+                ds1 = None
+            print('Success: Process Completed')
+        except Exception as e:
+            raise IOError('Error: Unable to save to %s %s' % (path_output,
+                                                              e))
     ds = None
-    try:
-        print('Processing: Flushing')
-        ds1.FlushCache()
-        ds1 = None
-        print('Success: Process Completed')
-    except Exception as e:
-        raise('Error: Unable to save to %s %s' % (path_output, e))
 
     sys.exit()
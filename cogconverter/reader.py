@@ -0,0 +1,337 @@
+from osgeo import gdal
+import array
+import collections
+import itertools
+import numpy as np
+import os
+import struct
+import threading
+
+from cogconverter import validator
+from cogconverter.config import default_config
+from cogconverter.src import tiff
+
+
+# TIFF SampleFormat to numpy kind
+SAMPLE_KINDS = {1: 'u', 2: 'i', 3: 'f'}
+
+# Tags describing the pixels, copied into the one-tile TIFF used to decode
+DECODE_TAGS = (tiff.BITS_PER_SAMPLE, tiff.COMPRESSION, tiff.PHOTOMETRIC,
+               tiff.SAMPLES_PER_PIXEL, tiff.PLANAR_CONFIG, tiff.PREDICTOR,
+               tiff.TILE_WIDTH, tiff.TILE_LENGTH, tiff.EXTRA_SAMPLES,
+               tiff.SAMPLE_FORMAT, tiff.JPEG_TABLES, tiff.GDAL_NODATA)
+
+# YCbCr and LERC parameters, needed by GDAL to decode as well
+YCBCR_SUBSAMPLING = 530
+REFERENCE_BLACK_WHITE = 532
+LERC_PARAMETERS = 50674
+
+_decode_ids = itertools.count()
+
+
+class CogReaderException(Exception):
+    pass
+
+
+class LruCache(object):
+    """Least recently used cache bounded by the total size of its values.
+
+    ``sizeof`` gives the size of a value, 1 makes ``max_size`` a number of
+    entries. Safe to share between threads.
+    """
+
+    def __init__(self, max_size, sizeof=lambda value: 1):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= self.sizeof(old)
+            self.entries[key] = value
+            self.size += size
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= self.sizeof(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+# Parsed headers shared by every reader of the process
+HEADERS = LruCache(default_config.READER_HEADER_CACHE)
+
+
+class Level(object):
+    """Tile tables of one resolution level, kept in compact arrays."""
+
+    def __init__(self, ifd):
+        if not ifd.is_tiled:
+            raise CogReaderException('Image at offset %d is not tiled' %
+                                     ifd.offset)
+        self.width = ifd.width
+        self.height = ifd.height
+        self.tile_width = ifd.value(tiff.TILE_WIDTH)
+        self.tile_height = ifd.value(tiff.TILE_LENGTH)
+        self.tiles_x = -(-self.width // self.tile_width)
+        self.tiles_y = -(-self.height // self.tile_height)
+        self.bands = ifd.value(tiff.SAMPLES_PER_PIXEL, 1)
+        self.separate = ifd.value(tiff.PLANAR_CONFIG, 1) == 2
+        self.offsets = array.array('Q', ifd.block_offsets())
+        self.byte_counts = array.array('Q', ifd.block_byte_counts())
+        if len(self.offsets) != self.tiles_x * self.tiles_y * self.planes:
+            raise CogReaderException('Image at offset %d has %d tiles, '
+                                     'expected %d' % (
+                                         ifd.offset, len(self.offsets),
+                                         self.tiles_x * self.tiles_y *
+                                         self.planes))
+
+        bits = ifd.value(tiff.BITS_PER_SAMPLE, 8)
+        kind = SAMPLE_KINDS.get(ifd.value(tiff.SAMPLE_FORMAT, 1))
+        if kind is None or bits % 8:
+            raise CogReaderException('Unsupported samples of %d bits' % bits)
+        self.dtype = np.dtype('%s%d' % (kind, bits // 8))
+
+        no_data = ifd.get(tiff.GDAL_NODATA)
+        self.no_data = float(no_data.rstrip(b'\0')) if no_data else None
+
+        tags = dict((tag, ifd.tags[tag]) for tag in
+                    DECODE_TAGS + (YCBCR_SUBSAMPLING, REFERENCE_BLACK_WHITE,
+                                   LERC_PARAMETERS)
+                    if tag in ifd.tags)
+        tags[tiff.IMAGE_WIDTH] = (tiff.LONG, (self.tile_width,))
+        tags[tiff.IMAGE_LENGTH] = (tiff.LONG, (self.tile_height,))
+        self.tags = tags
+
+    @property
+    def planes(self):
+        return self.bands if self.separate else 1
+
+    def index(self, x, y, plane=0):
+        return (plane * self.tiles_y + y) * self.tiles_x + x
+
+    def window_tiles(self, xoff, yoff, xsize, ysize):
+        """``(x, y)`` of the tiles intersecting a window, row by row."""
+        tw, th = self.tile_width, self.tile_height
+        return [(x, y)
+                for y in range(yoff // th, (yoff + ysize - 1) // th + 1)
+                for x in range(xoff // tw, (xoff + xsize - 1) // tw + 1)]
+
+    def ranges(self, x, y):
+        """``(offset, byte count)`` of every plane of a tile."""
+        return [(self.offsets[i], self.byte_counts[i]) for i in
+                (self.index(x, y, p) for p in range(self.planes))]
+
+
+def read_levels(read):
+    """Parse the IFD chain into Levels, full resolution first."""
+    endian, _, ifds = tiff.read_ifds(read)
+    if endian != '<':
+        raise CogReaderException('Big endian TIFF files are not supported')
+    images = [ifd for ifd in ifds if not ifd.is_mask]
+    if not images:
+        raise CogReaderException('The file has no image')
+    return [Level(images[0])] + [Level(ifd) for ifd in images[1:]
+                                 if ifd.is_overview]
+
+
+def coalesce(ranges, gap=default_config.READER_COALESCE_GAP):
+    """Merge ``(offset, size)`` ranges closer than ``gap`` bytes.
+
+    Returns:
+      A list of ``(offset, size, members)`` where members are the indices
+      of the input ranges held by the merged range.
+    """
+    merged = []
+    order = sorted((r for r in range(len(ranges)) if ranges[r][1]),
+                   key=lambda r: ranges[r][0])
+    for r in order:
+        offset, size = ranges[r]
+        if merged and offset <= merged[-1][0] + merged[-1][1] + gap:
+            start, length, members = merged[-1]
+            merged[-1] = (start, max(length, offset + size - start),
+                          members + [r])
+        else:
+            merged.append((offset, size, [r]))
+    return merged
+
+
+def decode(level, blocks):
+    """Decode the compressed planes of one tile to a ``(bands, h, w)`` array.
+
+    The blocks are wrapped in a one-tile TIFF in /vsimem carrying the pixel
+    tags of the level, so every codec GDAL reads can be decoded.
+    """
+    header, offsets = tiff.build_header([level.tags],
+                                        [[len(b) for b in blocks]])
+    path = '/vsimem/cogconverter_read_%d_%d.tif' % (os.getpid(),
+                                                    next(_decode_ids))
+    gdal.FileFromMemBuffer(path, header + b''.join(blocks))
+    try:
+        ds = gdal.Open(path)
+        if ds is None:
+            raise CogReaderException('Unable to decode tile : %s' %
+                                     gdal.GetLastErrorMsg())
+        data = ds.ReadAsArray()
+        ds = None
+    finally:
+        gdal.Unlink(path)
+    if data.ndim == 2:
+        data = data[np.newaxis]
+    return data
+
+
+class CogReader(object):
+    """Read tiles and windows of a COG with byte range reads.
+
+    The header and IFDs are parsed once, through the same tiff module as
+    the 'header' backend of validator.validate, and cached per file. Tiles
+    are addressed by ``(level, x, y)``, level 0 being full resolution.
+    Reading several tiles merges the byte ranges that are close in the file
+    into one request, and decoded tiles are kept in an LRU cache bounded in
+    bytes. The file is never opened with GDAL, it only decodes the tiles.
+
+    Usage:
+        with CogReader(path) as cog:
+            tile = cog.tile(0, 3, 2)
+            window = cog.read(0, 1000, 2000, 512, 512)
+    """
+
+    def __init__(self, path, reader=None,
+                 cache_mb=default_config.READER_TILE_CACHE_MB,
+                 gap=default_config.READER_COALESCE_GAP,
+                 prefetch=validator.HEADER_PREFETCH):
+        self.path = path
+        self.gap = gap
+        self.own_reader = reader is None
+        self.reader = reader if reader is not None else \
+            tiff.MmapReader(path, prefetch=prefetch)
+        self.cache = LruCache(cache_mb * 1024 * 1024,
+                              sizeof=lambda tile: tile.nbytes)
+
+        # Only local files have a key telling whether they changed
+        key = None
+        if self.own_reader:
+            stat = os.stat(path)
+            key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+        self.levels = HEADERS.get(key) if key is not None else None
+        if self.levels is None:
+            try:
+                self.levels = read_levels(self.reader)
+            except (tiff.TiffException, struct.error) as e:
+                self.close()
+                raise CogReaderException('Invalid COG %s : %s' % (path, e))
+            if key is not None:
+                HEADERS.put(key, self.levels)
+
+    @property
+    def bytes_read(self):
+        return self.reader.bytes_read
+
+    @property
+    def requests(self):
+        return self.reader.requests
+
+    def empty(self, level):
+        fill = level.no_data if level.no_data is not None else 0
+        return np.full((level.bands, level.tile_height, level.tile_width),
+                       fill, dtype=level.dtype)
+
+    def tiles(self, level, coords):
+        """Decoded tiles of ``level`` at the ``(x, y)`` in ``coords``.
+
+        Tiles not in the cache are fetched with coalesced range reads.
+        Tiles are full size, edge tiles included.
+
+        Returns:
+          A list of ``(bands, tile height, tile width)`` arrays.
+        """
+        info = self.levels[level]
+        result = [self.cache.get((level, x, y)) for x, y in coords]
+        missing = [i for i, tile in enumerate(result) if tile is None]
+        if not missing:
+            return result
+
+        ranges = []
+        for i in missing:
+            x, y = coords[i]
+            if not (0 <= x < info.tiles_x and 0 <= y < info.tiles_y):
+                raise CogReaderException('No tile %d, %d at level %d' %
+                                         (x, y, level))
+            ranges.extend(info.ranges(x, y))
+        data = [b''] * len(ranges)
+        for offset, size, members in coalesce(ranges, self.gap):
+            chunk = self.reader.fetch_range(offset, size)
+            for r in members:
+                start = ranges[r][0] - offset
+                data[r] = chunk[start:start + ranges[r][1]]
+
+        planes = info.planes
+        for n, i in enumerate(missing):
+            blocks = data[n * planes:(n + 1) * planes]
+            # Sparse tiles are not written and read back as nodata
+            if not any(blocks):
+                tile = self.empty(info)
+            else:
+                tile = decode(info, blocks)
+            self.cache.put((level,) + tuple(coords[i]), tile)
+            result[i] = tile
+        return result
+
+    def tile(self, level, x, y):
+        return self.tiles(level, [(x, y)])[0]
+
+    def read(self, level, xoff, yoff, xsize, ysize):
+        """Read a window of ``level`` like Dataset.ReadAsArray.
+
+        Returns:
+          A ``(bands, ysize, xsize)`` array.
+        """
+        info = self.levels[level]
+        if xoff < 0 or yoff < 0 or xoff + xsize > info.width or \
+                yoff + ysize > info.height:
+            raise CogReaderException('Window outside the %dx%d level %d' %
+                                     (info.width, info.height, level))
+        tw, th = info.tile_width, info.tile_height
+        coords = info.window_tiles(xoff, yoff, xsize, ysize)
+        out = np.empty((info.bands, ysize, xsize), dtype=info.dtype)
+        for (x, y), tile in zip(coords, self.tiles(level, coords)):
+            # Part of the tile inside the window, in level pixels
+            x0, y0 = max(xoff, x * tw), max(yoff, y * th)
+            x1 = min(xoff + xsize, (x + 1) * tw)
+            y1 = min(yoff + ysize, (y + 1) * th)
+            out[:, y0 - yoff:y1 - yoff, x0 - xoff:x1 - xoff] = \
+                tile[:, y0 - y * th:y1 - y * th, x0 - x * tw:x1 - x * tw]
+        return out
+
+    def close(self):
+        if self.own_reader:
+            self.reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
@@ -0,0 +1,354 @@
+import argparse
+import json
+import os
+import re
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from cogconverter import reader
+from cogconverter import validator
+from cogconverter.config import default_config
+from cogconverter.src import tiff
+
+
+# Header prefetch sizes compared by default, in bytes
+PREFETCH_SIZES = (4096, validator.HEADER_PREFETCH, 65536, 262144)
+
+# Screen size in pixels of the simulated viewer
+VIEWPORT = (1024, 768)
+
+# Full resolution window read after the overview, in pixels
+WINDOW = (2048, 2048)
+
+# 3x3 tile neighbourhoods sampled by neighbourhoods
+NEIGHBOURHOOD_SAMPLES = 1000
+
+RANGE_PATTERN = re.compile(r'bytes=(\d+)-(\d*)')
+
+
+class SimulatorException(Exception):
+    pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class RangeServer(object):
+    """Local HTTP server answering range requests for one file.
+
+    A stand-in for object storage, it counts the requests and bytes it
+    serves.
+
+    Usage:
+        with RangeServer(path) as server:
+            fetch = http_fetch(server.url)
+    """
+
+    def __init__(self, path, host='127.0.0.1', port=0):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.requests = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header('Content-Length', str(server.size))
+                self.send_header('Accept-Ranges', 'bytes')
+                self.end_headers()
+
+            def do_GET(self):
+                match = RANGE_PATTERN.match(self.headers.get('Range', ''))
+                if match is None:
+                    start, end = 0, server.size - 1
+                else:
+                    start = int(match.group(1))
+                    end = int(match.group(2)) if match.group(2) else \
+                        server.size - 1
+                    end = min(end, server.size - 1)
+                if start >= server.size:
+                    self.send_response(416)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                with open(server.path, 'rb') as f:
+                    f.seek(start)
+                    data = f.read(end - start + 1)
+                with server.lock:
+                    server.requests += 1
+                    server.bytes_sent += len(data)
+                self.send_response(206 if match else 200)
+                if match:
+                    self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                        start, end, server.size))
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = _ThreadingHTTPServer((host, port), Handler)
+        self.url = 'http://%s:%d/%s' % (host, self.httpd.server_address[1],
+                                        os.path.basename(path))
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+
+def http_fetch(url):
+    """``fetch(offset, size)`` doing one HTTP range request per call."""
+    def fetch(offset, size):
+        request = Request(url, headers={
+            'Range': 'bytes=%d-%d' % (offset, offset + size - 1)})
+        try:
+            response = urlopen(request)
+        except HTTPError as e:
+            # Range past the end of the file
+            if e.code == 416:
+                return b''
+            raise
+        try:
+            return response.read()
+        finally:
+            response.close()
+    return fetch
+
+
+class Tracker(object):
+    """Read callable recording the byte ranges a parser actually uses."""
+
+    def __init__(self, read):
+        self.read = read
+        self.ranges = []
+
+    def __call__(self, offset, size):
+        self.ranges.append((offset, size))
+        return self.read(offset, size)
+
+    def useful_bytes(self):
+        """Size of the union of the recorded ranges."""
+        total = 0
+        end = 0
+        for offset, size in sorted(self.ranges):
+            if offset + size > end:
+                total += offset + size - max(offset, end)
+                end = offset + size
+        return total
+
+
+def viewport_level(levels, viewport):
+    """Level a viewer fitting the raster in ``viewport`` opens at.
+
+    The coarsest level at least as large as the viewport, full resolution
+    when the raster is smaller than the viewport.
+    """
+    for i in range(len(levels) - 1, -1, -1):
+        if levels[i].width >= viewport[0] and \
+                levels[i].height >= viewport[1]:
+            return i
+    return 0
+
+
+def centered(level, size):
+    """Window ``(xoff, yoff, xsize, ysize)`` of ``size`` in the middle."""
+    xsize = min(size[0], level.width)
+    ysize = min(size[1], level.height)
+    return ((level.width - xsize) // 2, (level.height - ysize) // 2,
+            xsize, ysize)
+
+
+def fetch_window(client, levels, level, window, gap):
+    """Fetch the tiles of a window like reader.CogReader, without decoding.
+
+    Returns:
+      A tuple ``(tiles, useful_bytes)``.
+    """
+    info = levels[level]
+    coords = info.window_tiles(*window)
+    ranges = []
+    for x, y in coords:
+        ranges.extend(info.ranges(x, y))
+    for offset, size, _ in reader.coalesce(ranges, gap):
+        client.fetch_range(offset, size)
+    return len(coords), sum(size for _, size in ranges)
+
+
+def replay(fetch, prefetch, viewport=VIEWPORT, window=WINDOW, bbox=None,
+           gap=default_config.READER_COALESCE_GAP):
+    """Replay the access pattern of a viewer through ``fetch``.
+
+    The viewer reads the header and IFDs, then the overview tiles covering
+    ``viewport`` and finally a full resolution window, ``bbox`` as
+    ``(xoff, yoff, xsize, ysize)`` or ``window`` pixels in the middle.
+
+    Returns:
+      A list of steps, each with the requests, bytes fetched, bytes used
+      and bytes wasted by over-fetching.
+    """
+    client = tiff.RangeReader(fetch, prefetch=prefetch)
+    steps = []
+
+    def step(name, useful, **fields):
+        requests = client.requests - sum(s['requests'] for s in steps)
+        fetched = client.bytes_read - sum(s['bytes'] for s in steps)
+        steps.append(dict({'step': name, 'requests': requests,
+                           'bytes': fetched, 'useful_bytes': useful,
+                           'wasted_bytes': fetched - useful}, **fields))
+
+    tracker = Tracker(client)
+    levels = reader.read_levels(tracker)
+    step('header', tracker.useful_bytes())
+
+    level = viewport_level(levels, viewport)
+    tiles, useful = fetch_window(client, levels, level,
+                                 centered(levels[level], viewport), gap)
+    step('overview', useful, level=level, tiles=tiles)
+
+    full = bbox or centered(levels[0], window)
+    if full[0] < 0 or full[1] < 0 or full[0] + full[2] > levels[0].width \
+            or full[1] + full[3] > levels[0].height:
+        raise SimulatorException('Window %s outside the %dx%d raster' % (
+            list(full), levels[0].width, levels[0].height))
+    tiles, useful = fetch_window(client, levels, 0, full, gap)
+    step('window', useful, level=0, tiles=tiles)
+    return steps
+
+
+def simulate(path, prefetch_sizes=PREFETCH_SIZES, viewport=VIEWPORT,
+             window=WINDOW, bbox=None,
+             gap=default_config.READER_COALESCE_GAP):
+    """Measure the HTTP range requests a viewer needs to display a COG.
+
+    ``path`` is served by a local RangeServer and the access pattern of
+    ``replay`` runs once per header prefetch size.
+
+    Returns:
+      One result per prefetch size, with its steps and totals.
+    """
+    results = []
+    with RangeServer(path) as server:
+        for prefetch in prefetch_sizes:
+            requests_before = server.requests
+            try:
+                steps = replay(http_fetch(server.url), prefetch, viewport,
+                               window, bbox, gap)
+            except (tiff.TiffException, reader.CogReaderException) as e:
+                raise SimulatorException('Unable to read %s : %s' %
+                                         (path, e))
+            results.append({
+                'path': path,
+                'prefetch': prefetch,
+                'requests': sum(s['requests'] for s in steps),
+                'bytes': sum(s['bytes'] for s in steps),
+                'wasted_bytes': sum(s['wasted_bytes'] for s in steps),
+                'server_requests': server.requests - requests_before,
+                'steps': steps,
+            })
+    return results
+
+
+def neighbourhoods(path, level=0, gap=default_config.READER_COALESCE_GAP,
+                   samples=NEIGHBOURHOOD_SAMPLES):
+    """Coalesced requests needed to read 3x3 tile neighbourhoods.
+
+    Up to ``samples`` neighbourhoods spread over ``level`` are read the
+    way reader.CogReader merges ranges. A larger gap means fewer requests
+    but more wasted bytes, so both are reported.
+
+    Returns:
+      A dictionary with the neighbourhoods read, the total requests and
+      wasted bytes, and both per neighbourhood.
+    """
+    with tiff.MmapReader(path) as source:
+        info = reader.read_levels(source)[level]
+    centres = [(x, y) for y in range(1, info.tiles_y - 1)
+               for x in range(1, info.tiles_x - 1)]
+    centres = centres[::max(1, len(centres) // samples)]
+    requests = 0
+    wasted = 0
+    for x, y in centres:
+        ranges = []
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                ranges.extend(info.ranges(x + dx, y + dy))
+        merged = reader.coalesce(ranges, gap)
+        requests += len(merged)
+        wasted += sum(size for _, size, _ in merged) - \
+            sum(size for _, size in ranges)
+    count = float(len(centres)) or None
+    return {'neighbourhoods': len(centres), 'requests': requests,
+            'wasted_bytes': wasted,
+            'requests_per_read': round(requests / count, 3)
+            if count else None,
+            'wasted_bytes_per_read': round(wasted / count, 1)
+            if count else None}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-p', '--payload',
+                        help='COG to simulate remote reads of',
+                        required=True)
+
+    parser.add_argument('--prefetch',
+                        help='Header prefetch sizes in bytes',
+                        nargs='+', type=int, default=list(PREFETCH_SIZES))
+
+    parser.add_argument('--viewport',
+                        help='Viewer size in pixels',
+                        nargs=2, type=int, default=list(VIEWPORT))
+
+    parser.add_argument('--window',
+                        help='Full resolution window read in the middle',
+                        nargs=2, type=int, default=list(WINDOW))
+
+    parser.add_argument('--bbox',
+                        help='Full resolution window as xoff yoff xsize '
+                        'ysize, instead of --window',
+                        nargs=4, type=int, default=None)
+
+    parser.add_argument('--gap',
+                        help='Largest gap in bytes merged into one request',
+                        type=int, default=default_config.READER_COALESCE_GAP)
+
+    parser.add_argument('--neighbourhoods',
+                        help='Also count the requests of 3x3 tile '
+                        'neighbourhoods at full resolution',
+                        action='store_true')
+
+    args = parser.parse_args()
+    if args.neighbourhoods:
+        print(json.dumps(dict({'path': args.payload, 'gap': args.gap},
+                              **neighbourhoods(args.payload,
+                                               gap=args.gap))))
+    for result in simulate(args.payload, args.prefetch, args.viewport,
+                           args.window, args.bbox, args.gap):
+        print(json.dumps(result))
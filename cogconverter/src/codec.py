@@ -0,0 +1,250 @@
+from osgeo import gdal
+from osgeo import gdal_array
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import os
+import time
+
+from cogconverter.config import default_config
+from cogconverter.src import instrument
+from cogconverter.src import tiff
+
+
+POLICIES = ('smallest', 'lossless', 'fastest-decode')
+
+
+class CodecException(Exception):
+    pass
+
+
+class Candidate(object):
+    """A codec and its settings, as GTiff creation options."""
+
+    def __init__(self, name, options, lossless):
+        self.name = name
+        self.options = options
+        self.lossless = lossless
+
+    def __repr__(self):
+        return 'Candidate(%s)' % self.name
+
+
+def as_options(compression):
+    """Creation options for a codec name or an options list."""
+    if isinstance(compression, Candidate):
+        return list(compression.options)
+    if isinstance(compression, str):
+        return ['COMPRESS=%s' % compression]
+    return list(compression)
+
+
+def available_codecs():
+    """Codecs the GTiff driver of this GDAL build can write."""
+    options = gdal.GetDriverByName('GTiff').GetMetadataItem(
+        'DMD_CREATIONOPTIONLIST') or ''
+    return set(name for name in ('LZW', 'DEFLATE', 'ZSTD', 'LERC',
+                                 'LERC_ZSTD', 'JPEG', 'WEBP')
+               if '<Value>%s</Value>' % name in options)
+
+
+def candidates(dtype, bands, max_z_error=default_config.LERC_MAX_Z_ERROR,
+               codecs=None):
+    """Codecs and settings worth trying for a dtype and band count."""
+    codecs = available_codecs() if codecs is None else codecs
+    dtype = np.dtype(dtype)
+    predictor = 3 if dtype.kind == 'f' else 2
+    lerc_lossless = max_z_error == 0
+
+    found = []
+    for codec in ('LZW', 'DEFLATE', 'ZSTD'):
+        if codec in codecs:
+            found.append(Candidate(codec, ['COMPRESS=%s' % codec], True))
+            found.append(Candidate(
+                '%s+PREDICTOR=%d' % (codec, predictor),
+                ['COMPRESS=%s' % codec, 'PREDICTOR=%d' % predictor], True))
+
+    for codec in ('LERC', 'LERC_ZSTD'):
+        if codec in codecs and dtype.kind in 'uif':
+            found.append(Candidate(
+                '%s+MAX_Z_ERROR=%g' % (codec, max_z_error),
+                ['COMPRESS=%s' % codec, 'MAX_Z_ERROR=%g' % max_z_error],
+                lerc_lossless))
+
+    if dtype == np.uint8 and bands == 3:
+        if 'JPEG' in codecs:
+            quality = 'JPEG_QUALITY=%d' % default_config.JPEG_QUALITY
+            found.append(Candidate(
+                'JPEG+YCBCR',
+                ['COMPRESS=JPEG', 'PHOTOMETRIC=YCBCR', quality], False))
+        if 'WEBP' in codecs:
+            found.append(Candidate(
+                'WEBP', ['COMPRESS=WEBP',
+                         'WEBP_LEVEL=%d' % default_config.WEBP_LEVEL], False))
+            found.append(Candidate(
+                'WEBP+LOSSLESS', ['COMPRESS=WEBP', 'WEBP_LOSSLESS=TRUE'],
+                True))
+    return found
+
+
+def sample_tiles(ds, blocksize, count=default_config.CODEC_SAMPLES):
+    """Read ``count`` tiles spread evenly over the raster.
+
+    Tiles holding only nodata are skipped, they say nothing about the codec.
+    """
+    no_data = ds.GetRasterBand(1).GetNoDataValue()
+    width = min(blocksize, ds.RasterXSize)
+    height = min(blocksize, ds.RasterYSize)
+    side = int(np.ceil(np.sqrt(count * 2)))
+
+    samples = []
+    for j in range(side):
+        for i in range(side):
+            xoff = int((ds.RasterXSize - width) * (i + 0.5) / side)
+            yoff = int((ds.RasterYSize - height) * (j + 0.5) / side)
+            array = ds.ReadAsArray(xoff, yoff, width, height)
+            if array.ndim == 2:
+                array = array[np.newaxis]
+            if no_data is not None and np.all(array == no_data):
+                continue
+            samples.append(array)
+
+    # Interleave the grid so a short list still covers the whole raster
+    samples = samples[::2] + samples[1::2]
+    return samples[:count]
+
+
+def trial(candidate, samples):
+    """Encode and decode the samples with a candidate.
+
+    Returns:
+      A dictionary with the candidate, encoded bytes, compression ratio,
+      encode and decode speed in MB/s and the maximum decode error.
+    """
+    raw = sum(sample.nbytes for sample in samples)
+    encoded = 0
+    encode_seconds = 0.0
+    decode_seconds = 0.0
+    max_error = 0.0
+
+    for n, sample in enumerate(samples):
+        bands, height, width = sample.shape
+        gdal_dtype = gdal_array.NumericTypeCodeToGDALTypeCode(sample.dtype)
+        path = '/vsimem/cogconverter_trial_%d_%s_%d.tif' % (
+            os.getpid(), candidate.name, n)
+        options = candidate.options + ['TILED=YES',
+                                       'BLOCKXSIZE=%d' % _block(width),
+                                       'BLOCKYSIZE=%d' % _block(height)]
+
+        start = time.time()
+        ds = gdal.GetDriverByName('GTiff').Create(path, width, height, bands,
+                                                  gdal_dtype, options)
+        if ds is None:
+            raise CodecException('%s cannot encode %s' %
+                                 (candidate.name, sample.dtype))
+        for b in range(bands):
+            ds.GetRasterBand(b + 1).WriteArray(sample[b])
+        ds = None
+        encode_seconds += time.time() - start
+
+        start = time.time()
+        ds = gdal.Open(path)
+        decoded = ds.ReadAsArray()
+        ds = None
+        decode_seconds += time.time() - start
+
+        f = gdal.VSIFOpenL(path, 'rb')
+        data = gdal.VSIFReadL(1, gdal.VSIStatL(path).size, f)
+        gdal.VSIFCloseL(f)
+        gdal.Unlink(path)
+        _, _, ifds = tiff.read_ifds(tiff.bytes_reader(data))
+        encoded += sum(ifds[0].block_byte_counts())
+
+        if not candidate.lossless:
+            error = np.abs(decoded.astype(np.float64).reshape(sample.shape) -
+                           sample.astype(np.float64))
+            max_error = max(max_error, float(error.max()))
+
+    megabytes = raw / 1024.0 / 1024.0
+    return {
+        'name': candidate.name,
+        'options': candidate.options,
+        'lossless': candidate.lossless,
+        'bytes': encoded,
+        'ratio': round(raw / float(encoded), 3) if encoded else None,
+        'encode_mb_per_s': round(megabytes / encode_seconds, 2)
+        if encode_seconds else None,
+        'decode_mb_per_s': round(megabytes / decode_seconds, 2)
+        if decode_seconds else None,
+        'max_error': max_error,
+    }
+
+
+def _block(size):
+    # TIFF tile dimensions must be multiples of 16
+    return max(16, (size + 15) // 16 * 16)
+
+
+def _trial(args):
+    candidate, samples = args
+    try:
+        return trial(candidate, samples)
+    except Exception as e:
+        return {'name': candidate.name, 'options': candidate.options,
+                'lossless': candidate.lossless, 'error': '%s' % e}
+
+
+def choose(results, policy=default_config.COMPRESS_POLICY):
+    """Pick a trial result according to ``policy``.
+
+    smallest: smallest output, lossy codecs allowed.
+    lossless: smallest output among lossless codecs.
+    fastest-decode: fastest decoding among lossless codecs.
+    """
+    if policy not in POLICIES:
+        raise CodecException('Unknown policy %s, use one of %s' %
+                             (policy, ', '.join(POLICIES)))
+    usable = [r for r in results if 'error' not in r and r['bytes']]
+    if policy != 'smallest':
+        usable = [r for r in usable if r['lossless']]
+    if not usable:
+        raise CodecException('No codec could encode the samples')
+
+    if policy == 'fastest-decode':
+        return max(usable, key=lambda r: r['decode_mb_per_s'] or 0)
+    return min(usable, key=lambda r: r['bytes'])
+
+
+def select(ds, policy=default_config.COMPRESS_POLICY,
+           blocksize=default_config.BLOCKSIZE,
+           samples=default_config.CODEC_SAMPLES,
+           max_z_error=default_config.LERC_MAX_Z_ERROR,
+           workers=default_config.WORKERS, narrowing=None):
+    """Trial-encode sampled tiles with every candidate and pick one.
+
+    With a ``narrowing`` (see narrow.plan) the samples are narrowed first,
+    so candidates and predictors suit the dtype the tiles are stored with.
+
+    Returns:
+      A tuple ``(options, report)``: the creation options of the chosen
+      codec and a report with the decision and every candidate's measured
+      ratio and speed. The report is also emitted as a 'codec' event.
+    """
+    tiles = sample_tiles(ds, blocksize, samples)
+    if not tiles:
+        raise CodecException('Raster holds only nodata, nothing to sample')
+    if narrowing is not None:
+        tiles = [narrowing.apply(tile) for tile in tiles]
+
+    found = candidates(tiles[0].dtype, tiles[0].shape[0], max_z_error)
+    workers = min(workers or os.cpu_count() or 1, len(found))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_trial, [(c, tiles) for c in found]))
+
+    chosen = choose(results, policy)
+    report = {'event': 'codec', 'policy': policy, 'chosen': chosen['name'],
+              'options': chosen['options'], 'samples': len(tiles),
+              'candidates': results}
+    instrument.emit(report)
+    print('Codec: %s (ratio %s) chosen by %s policy' %
+          (chosen['name'], chosen['ratio'], policy))
+    return chosen['options'], report
@@ -0,0 +1,154 @@
+from osgeo import gdal
+from osgeo import gdal_array
+import numpy as np
+import queue
+import threading
+import time
+
+from cogconverter.src import instrument
+
+
+# Strips read ahead of the one being written
+QUEUE_DEPTH = 2
+
+# Seconds the reader waits on a queue before checking whether to stop
+POLL_SECONDS = 0.1
+
+
+class CopierException(Exception):
+    pass
+
+
+def create_like(src_ds, path, options):
+    """Empty GTiff with the size, dtype, georeferencing, nodata and colour
+    interpretation of ``src_ds``, to copy its pixels into."""
+    band = src_ds.GetRasterBand(1)
+    dst_ds = gdal.GetDriverByName('GTiff').Create(
+        path, src_ds.RasterXSize, src_ds.RasterYSize, src_ds.RasterCount,
+        band.DataType, options)
+    if dst_ds is None:
+        raise CopierException('Unable to create %s : %s' %
+                              (path, gdal.GetLastErrorMsg()))
+    dst_ds.SetGeoTransform(src_ds.GetGeoTransform())
+    dst_ds.SetProjection(src_ds.GetProjection())
+    dst_ds.SetMetadata(src_ds.GetMetadata())
+    for i in range(src_ds.RasterCount):
+        src_band = src_ds.GetRasterBand(i + 1)
+        dst_band = dst_ds.GetRasterBand(i + 1)
+        no_data = src_band.GetNoDataValue()
+        if no_data is not None:
+            dst_band.SetNoDataValue(no_data)
+        dst_band.SetColorInterpretation(src_band.GetColorInterpretation())
+    return dst_ds
+
+
+class BlockCopier(object):
+    """Copy a dataset into another in storage order, reading ahead.
+
+    The destination is walked in strips one block high, top to bottom, so
+    blocks are produced in row-major tile order. A reader thread fills
+    preallocated strip buffers with every band in one call while the
+    calling thread writes the previous strips, the two sides meeting in a
+    queue ``depth`` strips deep. Memory is bounded by ``depth + 2`` strip
+    buffers whatever the raster size. Timing and progress are reported as
+    ``stage``. When writing fails, the reader is stopped and joined before
+    the error is raised.
+    """
+
+    def __init__(self, src_ds, dst_ds, depth=QUEUE_DEPTH, stage='copy'):
+        self.src = src_ds
+        self.dst = dst_ds
+        self.depth = depth
+        self.stage = stage
+        self.bands = src_ds.RasterCount
+        self.col = src_ds.RasterXSize
+        self.row = src_ds.RasterYSize
+        self.strip = dst_ds.GetRasterBand(1).GetBlockSize()[1]
+        self.dtype = gdal_array.GDALTypeCodeToNumericTypeCode(
+            src_ds.GetRasterBand(1).DataType)
+
+    def view(self, buffer, height):
+        n = self.bands * height * self.col
+        return buffer[:n].reshape(self.bands, height, self.col)
+
+    @staticmethod
+    def _get(q, stop):
+        """``q.get()`` giving up with None once ``stop`` is set."""
+        while not stop.is_set():
+            try:
+                return q.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                continue
+        return None
+
+    @staticmethod
+    def _put(q, item, stop):
+        """``q.put(item)`` giving up with False once ``stop`` is set."""
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=POLL_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read(self, free, full, stop):
+        """Producer: read every strip into a free buffer until ``stop``."""
+        try:
+            for yoff in range(0, self.row, self.strip):
+                height = min(self.strip, self.row - yoff)
+                buffer = self._get(free, stop)
+                if buffer is None:
+                    return
+                self.src.ReadAsArray(0, yoff, self.col, height,
+                                     buf_obj=self.view(buffer, height))
+                if not self._put(full, (yoff, height, buffer), stop):
+                    return
+        except Exception as e:
+            self._put(full, e, stop)
+            return
+        self._put(full, None, stop)
+
+    def run(self):
+        """Copy the pixels, return the number of bytes copied."""
+        free = queue.Queue()
+        for _ in range(self.depth + 2):
+            free.put(np.empty(self.bands * self.strip * self.col,
+                              dtype=self.dtype))
+        full = queue.Queue(maxsize=self.depth)
+        band_list = list(range(1, self.bands + 1))
+
+        pixels = self.bands * self.col * self.row
+        nbytes = pixels * np.dtype(self.dtype).itemsize
+        start = time.time()
+        progress = instrument.progress(self.stage, pixels)
+        with instrument.stage(self.stage, pixels=pixels, bytes_read=nbytes,
+                              bytes_written=nbytes):
+            stop = threading.Event()
+            reader = threading.Thread(target=self.read,
+                                      args=(free, full, stop))
+            reader.daemon = True
+            reader.start()
+            try:
+                while True:
+                    item = full.get()
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    yoff, height, buffer = item
+                    self.dst.WriteRaster(0, yoff, self.col, height,
+                                         self.view(buffer, height),
+                                         band_list=band_list)
+                    free.put(buffer)
+                    progress((yoff + height) / float(self.row), '', None)
+            finally:
+                # Also releases a reader blocked on a queue after an error
+                stop.set()
+                reader.join()
+
+        seconds = time.time() - start
+        if seconds > 0:
+            print('Copied %.1f MB at %.1f MB/s' % (
+                nbytes / 1024.0 / 1024.0, nbytes / 1024.0 / 1024.0 / seconds))
+        return nbytes
@@ -1,79 +1,288 @@
-import gdal
+from osgeo import gdal
+from osgeo import gdal_array
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
 import numpy as np
 import os
-from cogconverter.src.pyramid import pyramid
+import queue
+import threading
 
-# Remappping array to
-def remap_array(arr):
+from cogconverter.config import default_config
+from cogconverter.src import codec
+from cogconverter.src import instrument
+from cogconverter.src import layout
+from cogconverter.src.engine import source_spec
+
+
+def strip_height(blocksize, factors):
+    """Smallest multiple of the block size that every overview factor divides.
+
+    Strips then start on an overview row for every level, so each strip's
+    share of every overview is computed from that strip alone.
     """
-    Remapping [4, 256,256] to [256,256, 4]
+    height = blocksize
+    for factor in factors:
+        while height % factor:
+            height += blocksize
+    return height
+
+
+def plan_strips(blocksize, factors, row_bytes, workers,
+                memory_mb=default_config.ALPHA_MEMORY_MB):
+    """Strip height and number of strip buffers fitting ``memory_mb``.
+
+    Strips are block aligned when two of them fit the budget, otherwise as
+    tall as the budget allows while staying aligned on every overview
+    factor, which sets the smallest strip. Up to two buffers per worker are
+    kept, fewer when the budget is tight.
+
+    Args:
+      row_bytes: bytes of one buffered row, pixels, validity and mask.
+
+    Returns:
+      A tuple ``(height, buffers)``.
     """
-    return np.moveaxis(arr, 0, 2)
+    budget = memory_mb * 1024 * 1024
+    height = strip_height(blocksize, factors)
+    if 2 * height * row_bytes > budget:
+        step = strip_height(1, factors)
+        height = max(step, budget // (2 * row_bytes) // step * step)
+    buffers = max(1, min(workers * 2, budget // (height * row_bytes)))
+    return height, buffers
 
 
-def create_alpha(raster):
-    r = raster
-    blocksize = 256
-    # Creating a copy in mem
-    path_alpha = os.path.join(os.path.dirname(r.path_input), 'alpha.tif')
+@contextlib.contextmanager
+def _config_option(key, value):
+    """Set a GDAL config option, restoring the previous value on exit."""
+    previous = gdal.GetConfigOption(key)
+    gdal.SetConfigOption(key, value)
+    try:
+        yield
+    finally:
+        gdal.SetConfigOption(key, previous)
+
 
-    # Creating a copy in mem
+def decimation_index(start, stop, size, factor, limit):
+    """Source indices (relative to ``start``) GDAL NEAREST picks for a level.
 
-    vrt_ds = gdal.GetDriverByName('mem').CreateCopy('', r.ds, 0)
+    Level pixel ``j`` samples source pixel ``j * factor + factor // 2``,
+    clamped to the last source pixel.
+    """
+    first = start // factor
+    last = min((stop + factor - 1) // factor, size)
+    index = np.arange(first, last) * factor + factor // 2
+    return first, np.minimum(index, limit - 1) - start
 
-    print('Number of bands : %s' % (vrt_ds.RasterCount))
-    vrt_ds.AddBand()
-    vrt_ds.GetRasterBand(4).SetColorInterpretation(gdal.GCI_AlphaBand)
 
-    print('Processing: Creating alpha tiff dataset')
+class StripBuffers(object):
+    """Reusable buffers for one strip: pixels, validity and mask."""
+
+    def __init__(self, bands, height, width, dtype):
+        self.pixels = np.empty(bands * height * width, dtype=dtype)
+        self.valid = np.empty(bands * height * width, dtype=bool)
+        self.mask = np.empty(height * width, dtype=np.uint8)
+        self.bands = bands
+        self.width = width
+
+    def views(self, height):
+        """Contiguous views sized for a strip of ``height`` rows."""
+        n = height * self.width
+        shape = (self.bands, height, self.width)
+        return (self.pixels[:self.bands * n].reshape(shape),
+                self.valid[:self.bands * n].reshape(shape),
+                self.mask[:n].reshape(height, self.width))
+
+
+class AlphaStream(object):
+    """Stream a raster into a copy carrying an alpha band or internal mask.
+
+    A pixel is opaque (255) when every band is non zero. The raster is read
+    in strips with reusable buffers, so memory is bounded by ``memory_mb``
+    whatever the raster size, see plan_strips. Worker threads read and
+    compute strips, each with its own dataset handle, while the calling
+    thread writes them in order. With NEAREST resampling, data and mask
+    overviews are written from the same strips in the same pass.
+
+    The tile size and overview factors default to layout.plan_dataset, so
+    the pyramid matches the one of an output without alpha.
+    """
+
+    def __init__(self, ds, path_output, mode=default_config.ALPHA_MODE,
+                 compression=default_config.COMPRESS,
+                 blocksize=None, factors=None,
+                 resampling=default_config.RESAMPLING,
+                 workers=default_config.WORKERS,
+                 memory_mb=default_config.ALPHA_MEMORY_MB):
+        if mode not in ('mask', 'band'):
+            raise ValueError('Unknown alpha mode %s' % mode)
 
-    driver = gdal.GetDriverByName('Gtiff')
-    dataset = driver.CreateCopy(path_alpha,
-                                vrt_ds, 0,
-                                ['NUM_THREADS=ALL_CPUS',
-                                 'COMPRESS=%s' % (r.compression),
-                                 'BIGTIFF=YES',
-                                 'TILED=YES',
-                                 'BLOCKXSIZE=%d' % (blocksize),
-                                 'BLOCKYSIZE=%d' % (blocksize),
-                                 'COPY_SRC_OVERVIEWS=YES'])
+        plan = layout.plan_dataset(ds, compression, blocksize)
+        self.ds = ds
+        self.path_output = path_output
+        self.mode = mode
+        self.compression = compression
+        self.blocksize = plan.blocksize
+        self.factors = list(plan.factors if factors is None else factors)
+        self.resampling = resampling
+        self.workers = workers or os.cpu_count() or 1
 
-    vrt_ds = None
+        self.num_band = ds.RasterCount
+        self.col = ds.RasterXSize
+        self.row = ds.RasterYSize
+        self.gdal_dtype = ds.GetRasterBand(1).DataType
+        self.dtype = gdal_array.GDALTypeCodeToNumericTypeCode(self.gdal_dtype)
 
-    output_band = dataset.GetRasterBand(4)
+        # Threads open their own handle, GDAL datasets are not thread safe
+        self.spec = source_spec(ds, processes=False)
+        if self.spec is None:
+            self.workers = 1
 
-    # block_x, block_y = input_band.GetBlockSize()
-    block_x, block_y = 256, 256
+        # Pixels, validity per band and the mask of one row
+        row_bytes = self.col * (self.num_band *
+                                (np.dtype(self.dtype).itemsize + 1) + 1)
+        self.strip, self.buffers = plan_strips(
+            self.blocksize, self.factors, row_bytes, self.workers, memory_mb)
+        self.local = threading.local()
 
-    size_x = r.ds.RasterXSize
-    size_y = r.ds.RasterYSize
+    def create_output(self):
+        bands = self.num_band + (1 if self.mode == 'band' else 0)
+        options = ['NUM_THREADS=ALL_CPUS'] + \
+            codec.as_options(self.compression) + \
+            ['BIGTIFF=YES',
+             'TILED=YES',
+             'BLOCKXSIZE=%d' % self.blocksize,
+             'BLOCKYSIZE=%d' % self.blocksize]
+        if self.mode == 'band':
+            options.append('ALPHA=YES')
 
-    for x in range(0, int(size_x), int(block_x)):
-        if x + block_x < size_x:
-            col = block_x
+        dataset = gdal.GetDriverByName('GTiff').Create(
+            self.path_output, self.col, self.row, bands, self.gdal_dtype,
+            options)
+        dataset.SetGeoTransform(self.ds.GetGeoTransform())
+        dataset.SetProjection(self.ds.GetProjection())
+        for i in range(self.num_band):
+            no_data = self.ds.GetRasterBand(i + 1).GetNoDataValue()
+            if no_data is not None:
+                dataset.GetRasterBand(i + 1).SetNoDataValue(no_data)
+
+        if self.mode == 'band':
+            dataset.GetRasterBand(bands).SetColorInterpretation(
+                gdal.GCI_AlphaBand)
         else:
-            col = size_x - x
-
-        for y in range(0, int(size_y), int(block_y)):
-            if y + block_y < size_y:
-                row = block_y
-            else:
-                row = size_y - y
-
-            array = r.ds.ReadAsArray(x, y, col, row)
-            all_zeros = array != 0
-            zeros_image = remap_array(all_zeros)
-            mask = np.all(zeros_image, axis=2) * 255
-            output_band.WriteArray(mask, x, y)
-
-    print('Added extra band, Number of bands : %s' % (dataset.RasterCount))
-
-    # Creating alpha pyramids
-    print('Generating alpha Overviews')
-    addo = pyramid(dataset)
-    addo.gdal_addo()
-    
-    print('Saving to Disk')
-    dataset.FlushCache()
-    dataset = None
+            with _config_option('GDAL_TIFF_INTERNAL_MASK', 'YES'):
+                dataset.CreateMaskBand(gdal.GMF_PER_DATASET)
+
+        # Allocate overviews without computing them, strips fill them in
+        if self.factors:
+            with _config_option('COMPRESS_OVERVIEW',
+                                default_config.COMPRESS):
+                dataset.BuildOverviews('NONE', self.factors)
+        return dataset
+
+    def source(self):
+        if self.workers == 1:
+            return self.ds
+        if not hasattr(self.local, 'ds'):
+            self.local.ds = gdal.Open(self.spec)
+        return self.local.ds
+
+    def compute(self, yoff, buffers):
+        """Read one strip of all bands and compute its mask."""
+        height = min(self.strip, self.row - yoff)
+        pixels, valid, mask = buffers.views(height)
+        self.source().ReadAsArray(0, yoff, self.col, height, buf_obj=pixels)
+
+        # All bands non zero, reduced along the band axis in place
+        np.not_equal(pixels, 0, out=valid)
+        for i in range(1, self.num_band):
+            np.logical_and(valid[0], valid[i], out=valid[0])
+        np.multiply(valid[0], 255, out=mask, casting='unsafe')
+        return yoff, height, buffers
+
+    def mask_band(self, dataset):
+        if self.mode == 'band':
+            return dataset.GetRasterBand(self.num_band + 1)
+        return dataset.GetRasterBand(1).GetMaskBand()
+
+    def write(self, dataset, yoff, height, buffers):
+        pixels, _, mask = buffers.views(height)
+        for i in range(self.num_band):
+            dataset.GetRasterBand(i + 1).WriteArray(pixels[i], 0, yoff)
+        mask_band = self.mask_band(dataset)
+        mask_band.WriteArray(mask, 0, yoff)
+
+        for level in range(mask_band.GetOverviewCount()):
+            factor = self.factors[level]
+            ovr = mask_band.GetOverview(level)
+            first, rows = decimation_index(yoff, yoff + height, ovr.YSize,
+                                           factor, self.row)
+            if len(rows) == 0:
+                continue
+            _, columns = decimation_index(0, self.col, ovr.XSize,
+                                          factor, self.col)
+            ovr.WriteArray(mask[np.ix_(rows, columns)], 0, first)
+
+            if self.resampling.upper() == 'NEAREST':
+                for i in range(self.num_band):
+                    band_ovr = dataset.GetRasterBand(i + 1).GetOverview(level)
+                    band_ovr.WriteArray(pixels[i][np.ix_(rows, columns)],
+                                        0, first)
+
+    def run(self):
+        dataset = self.create_output()
+
+        # Bounded pool of strip buffers, reused once a strip is written
+        pool = queue.Queue()
+        for _ in range(self.buffers):
+            pool.put(StripBuffers(self.num_band, self.strip, self.col,
+                                  self.dtype))
+
+        offsets = list(range(0, self.row, self.strip))
+        print('Processing: Streaming %d strips of %d rows' %
+              (len(offsets), self.strip))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = []
+            for yoff in offsets:
+                if pool.empty():
+                    # Write the oldest strip before reading further
+                    done = pending.pop(0).result()
+                    self.write(dataset, *done)
+                    pool.put(done[2])
+                pending.append(executor.submit(self.compute, yoff, pool.get()))
+            for future in pending:
+                done = future.result()
+                self.write(dataset, *done)
+                pool.put(done[2])
+
+        if self.resampling.upper() != 'NEAREST':
+            # Data overviews need neighbours across strips
+            for i in range(self.num_band):
+                band = dataset.GetRasterBand(i + 1)
+                gdal.RegenerateOverviews(
+                    band, [band.GetOverview(j)
+                           for j in range(band.GetOverviewCount())],
+                    self.resampling.lower())
+
+        print('Saving to Disk')
+        dataset.FlushCache()
+        dataset = None
+        return self.path_output
+
+
+def create_alpha(raster, path_alpha=None, mode=default_config.ALPHA_MODE,
+                 workers=default_config.WORKERS, blocksize=None):
+    r = raster
+    if path_alpha is None:
+        path_alpha = os.path.join(os.path.dirname(r.path_input), 'alpha.tif')
+
+    print('Processing: Creating alpha tiff dataset')
+    stream = AlphaStream(r.ds, path_alpha, mode=mode,
+                         compression=r.compression, blocksize=blocksize,
+                         workers=workers)
+    pixels = stream.col * stream.row * stream.num_band
+    nbytes = pixels * np.dtype(stream.dtype).itemsize
+    with instrument.stage('alpha', pixels=pixels,
+                          bytes_read=nbytes) as fields:
+        stream.run()
+        fields['bytes_written'] = os.path.getsize(path_alpha)
     return path_alpha
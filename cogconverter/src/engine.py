@@ -0,0 +1,730 @@
+from osgeo import gdal
+import base64
+import json
+import math
+import multiprocessing
+import numpy as np
+import os
+import tempfile
+from tqdm import tqdm
+
+from cogconverter.config import default_config
+from cogconverter.src import codec
+from cogconverter.src import instrument
+from cogconverter.src import overview
+from cogconverter.src import sink
+from cogconverter.src import stats
+from cogconverter.src import tiff
+
+
+class EngineException(Exception):
+    pass
+
+
+# GDAL resampling names to RasterIO resampling algorithms
+RESAMPLING = {
+    'NEAREST': 'GRIORA_NearestNeighbour',
+    'BILINEAR': 'GRIORA_Bilinear',
+    'CUBIC': 'GRIORA_Cubic',
+    'CUBICSPLINE': 'GRIORA_CubicSpline',
+    'LANCZOS': 'GRIORA_Lanczos',
+    'AVERAGE': 'GRIORA_Average',
+    'MODE': 'GRIORA_Mode',
+    'GAUSS': 'GRIORA_Gauss',
+}
+
+# Order of the tiles within a level, see tiff.hilbert_order
+TILE_ORDERS = ('row', 'hilbert')
+
+# Per process state of pool workers
+_worker = {}
+
+
+def source_spec(ds, processes=True):
+    """Return a string a worker process can pass to gdal.Open to get ``ds``.
+
+    Warped VRTs built with ``gdal.Warp('', ..., format='VRT')`` have no file
+    on disk, so their XML definition is used instead. None is returned for
+    datasets that only exist in this process (MEM, unnamed), and for
+    /vsimem files unless ``processes`` is False: they are private to the
+    process and only threads of this process can open them.
+    """
+    driver = ds.GetDriver().ShortName
+    if driver == 'VRT':
+        xml = ds.GetMetadata('xml:VRT')
+        if xml:
+            return xml[0]
+
+    if driver.upper() == 'MEM':
+        return None
+
+    path = ds.GetDescription()
+    if path and path.startswith('/vsimem/') and processes:
+        return None
+    if path and (os.path.exists(path) or path.startswith('/vsi')):
+        return path
+    return None
+
+
+def source_identity(paths):
+    """Absolute path, size and mtime of every file, to tell whether the
+    input of a job changed between two runs."""
+    identity = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            identity.append([path, None, None])
+            continue
+        identity.append([os.path.abspath(path), stat.st_size,
+                         stat.st_mtime])
+    return identity
+
+
+def resample_alg(name):
+    try:
+        return getattr(gdal, RESAMPLING[name.upper()])
+    except KeyError:
+        raise EngineException('Unsupported resampling %s' % name)
+
+
+class Level(object):
+    """One resolution level of the output pyramid."""
+
+    def __init__(self, factor, src_width, src_height, blocksize):
+        self.factor = factor
+        self.src_width = src_width
+        self.src_height = src_height
+        self.blocksize = blocksize
+
+        # Same rounding as GDAL uses for overview dimensions
+        self.width = (src_width + factor - 1) // factor
+        self.height = (src_height + factor - 1) // factor
+        self.tiles_x = int(math.ceil(self.width / float(blocksize)))
+        self.tiles_y = int(math.ceil(self.height / float(blocksize)))
+
+    @property
+    def tile_count(self):
+        return self.tiles_x * self.tiles_y
+
+    def window(self, index):
+        """Source window and output size of a tile, in row-major index."""
+        ty, tx = divmod(index, self.tiles_x)
+        x0 = tx * self.blocksize
+        y0 = ty * self.blocksize
+        buf_w = min(self.blocksize, self.width - x0)
+        buf_h = min(self.blocksize, self.height - y0)
+
+        xoff = x0 * self.factor
+        yoff = y0 * self.factor
+        xsize = min((x0 + buf_w) * self.factor, self.src_width) - xoff
+        ysize = min((y0 + buf_h) * self.factor, self.src_height) - yoff
+        return xoff, yoff, xsize, ysize, buf_w, buf_h
+
+
+def plan_levels(width, height, blocksize, factors):
+    """Full resolution level followed by every overview level that exists."""
+    levels = [Level(1, width, height, blocksize)]
+    for factor in factors:
+        level = Level(factor, width, height, blocksize)
+        # Stop once an overview would collapse to a single pixel
+        if level.width < 1 or level.height < 1 or \
+                (level.width == 1 and level.height == 1):
+            break
+        levels.append(level)
+    return levels
+
+
+def creation_options(ds, compression, blocksize, interleave='PIXEL'):
+    """GTiff creation options shared by the skeleton and every tile.
+
+    ``compression`` is a codec name or a list of creation options, as
+    chosen by codec.select.
+    """
+    options = codec.as_options(compression) + [
+        'TILED=YES',
+        'INTERLEAVE=%s' % interleave,
+        'BLOCKXSIZE=%d' % blocksize,
+        'BLOCKYSIZE=%d' % blocksize]
+
+    # CreateCopy detects RGB(A) from the source, Create needs to be told
+    interps = [ds.GetRasterBand(i + 1).GetColorInterpretation()
+               for i in range(ds.RasterCount)]
+    photometric = any(o.upper().startswith('PHOTOMETRIC=') for o in options)
+    if not photometric and interps[:3] == [gdal.GCI_RedBand,
+                                           gdal.GCI_GreenBand,
+                                           gdal.GCI_BlueBand]:
+        options.append('PHOTOMETRIC=RGB')
+    if ds.RasterCount > 1 and interps[-1] == gdal.GCI_AlphaBand:
+        options.append('ALPHA=YES')
+    return options
+
+
+def _vsimem_bytes(path):
+    size = gdal.VSIStatL(path).size
+    f = gdal.VSIFOpenL(path, 'rb')
+    try:
+        return gdal.VSIFReadL(1, size, f)
+    finally:
+        gdal.VSIFCloseL(f)
+        gdal.Unlink(path)
+
+
+def empty_tile(array, no_data=None, alpha=None):
+    """True when a tile holds only nodata or is fully transparent.
+
+    Without a nodata value, 0 is the empty value, as with GDAL SPARSE_OK.
+    """
+    if alpha is not None and not array[alpha].any():
+        return True
+    if no_data is None:
+        return not array.any()
+    if np.isnan(no_data):
+        return bool(np.isnan(array).all())
+    return bool((array == no_data).all())
+
+
+def encode_tile(ds, level, index, settings):
+    """Read, resample and compress one tile of ``level``.
+
+    The tile is encoded by GDAL as a single-tile GTiff in /vsimem so every
+    codec GDAL supports is available, then the compressed tile bytes are
+    cut out of it.
+
+    Returns:
+      A tuple ``(blocks, jpeg_tables, tile_stats)``. ``blocks`` holds the
+      tile bytes, one entry per band for band interleaved output. In sparse
+      mode empty tiles are not encoded and their blocks are empty.
+      ``tile_stats`` is the stats.Stats of a full resolution tile when
+      statistics are requested, None otherwise.
+    """
+    xoff, yoff, xsize, ysize, buf_w, buf_h = level.window(index)
+    blocksize = level.blocksize
+
+    # A reader such as mosaic.Mosaic replaces the dataset reads
+    read = settings['reader'].read if settings['reader'] is not None \
+        else ds.ReadAsArray
+    array = read(xoff, yoff, xsize, ysize, buf_xsize=buf_w, buf_ysize=buf_h,
+                 resample_alg=settings['resampling'])
+    if array.ndim == 2:
+        array = array[np.newaxis]
+    if settings['narrowing'] is not None:
+        array = settings['narrowing'].apply(array)
+
+    tile_stats = None
+    if settings['ranges'] is not None and level.factor == 1:
+        tile_stats = stats.Stats(settings['ranges'])
+        tile_stats.add(array, overview.valid_mask(array, settings['nodata'],
+                                                  settings['alpha']))
+
+    if settings['sparse'] and empty_tile(array, settings['nodata'],
+                                         settings['alpha']):
+        return [b''] * settings['planes'], None, tile_stats
+
+    # TIFF tiles are always full size, pad edge tiles
+    if buf_w != blocksize or buf_h != blocksize:
+        fill = settings['nodata'] if settings['nodata'] is not None else 0
+        padded = np.full((array.shape[0], blocksize, blocksize), fill,
+                         dtype=array.dtype)
+        padded[:, :buf_h, :buf_w] = array
+        array = padded
+
+    path = '/vsimem/cogconverter_tile_%d_%d_%d.tif' % (
+        os.getpid(), level.factor, index)
+    tile_ds = gdal.GetDriverByName('GTiff').Create(
+        path, blocksize, blocksize, array.shape[0], settings['dtype'],
+        settings['options'])
+    for i in range(array.shape[0]):
+        band = tile_ds.GetRasterBand(i + 1)
+        if settings['nodata'] is not None:
+            band.SetNoDataValue(settings['nodata'])
+        band.WriteArray(array[i])
+    tile_ds = None
+
+    data = _vsimem_bytes(path)
+    _, _, ifds = tiff.read_ifds(tiff.bytes_reader(data))
+    blocks = [bytes(data[offset:offset + size]) for offset, size in
+              zip(ifds[0].block_offsets(), ifds[0].block_byte_counts())]
+    tables = ifds[0].tags.get(tiff.JPEG_TABLES)
+    return blocks, tables, tile_stats
+
+
+def _init_worker(spec, levels, settings):
+    gdal.UseExceptions()
+    _worker['ds'] = gdal.Open(spec)
+    _worker['levels'] = levels
+    _worker['settings'] = settings
+
+
+def _encode_job(job):
+    level, index = job
+    blocks, tables, tile_stats = encode_tile(
+        _worker['ds'], _worker['levels'][level], index, _worker['settings'])
+    return level, index, blocks, tables, tile_stats
+
+
+def _encode_tables(tables):
+    if tables is None:
+        return None
+    field_type, value = tables
+    return [field_type, base64.b64encode(value).decode('ascii')]
+
+
+def _decode_tables(tables):
+    if tables is None:
+        return None
+    return tables[0], base64.b64decode(tables[1])
+
+
+class Journal(object):
+    """Checkpoint journal of the tiles a TileEngine has spooled.
+
+    The first line describes the job, every following line is a batch of
+    tiles appended to the spool. A batch is only written once the spool is
+    synced to disk, and records the spool size it is consistent with, so
+    after a crash every complete line points at tiles really on disk.
+    """
+
+    def __init__(self, path, job):
+        self.path = path
+        # Round trip so a reloaded header compares equal
+        self.job = json.loads(json.dumps(job))
+        self.done = {}
+        self.tables = {}
+        self.batch = []
+        self.batch_tables = {}
+        self.stats = None
+        self.batch_stats = None
+
+    def load(self, spool_size):
+        """Load the completed tiles of a previous run of the same job.
+
+        Returns:
+          The spool size the loaded tiles are consistent with, 0 when
+          there is nothing to resume.
+        """
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path) as f:
+            lines = f.read().split('\n')
+        try:
+            # Compared as text, NaN nodata never equals itself
+            if json.dumps(json.loads(lines[0]), sort_keys=True) != \
+                    json.dumps(self.job, sort_keys=True):
+                print('Checkpoint journal belongs to another job or '
+                      'input. Starting over')
+                return 0
+        except ValueError:
+            return 0
+
+        end = 0
+        for line in lines[1:]:
+            try:
+                batch = json.loads(line)
+            except ValueError:
+                # Torn last line of a crashed run
+                break
+            if batch['end'] > spool_size:
+                break
+            for level, index, offset, sizes in batch['tiles']:
+                self.done[(level, index)] = (offset, sizes)
+            for level, tables in batch['tables'].items():
+                self.tables[int(level)] = _decode_tables(tables)
+            if batch.get('stats'):
+                batch_stats = stats.Stats.from_state(batch['stats'])
+                self.stats = batch_stats.merge(self.stats)
+            end = batch['end']
+        return end
+
+    def start(self):
+        self.done = {}
+        self.tables = {}
+        self.stats = None
+        with open(self.path, 'w') as f:
+            f.write(json.dumps(self.job) + '\n')
+
+    def add(self, level, index, offset, sizes, tables, tile_stats=None):
+        self.batch.append((level, index, offset, sizes))
+        if tables is not None and level not in self.tables:
+            self.tables[level] = tables
+            self.batch_tables[level] = _encode_tables(tables)
+        if tile_stats is not None:
+            if self.batch_stats is None:
+                self.batch_stats = stats.Stats(tile_stats.ranges,
+                                               tile_stats.bins)
+            self.batch_stats.merge(tile_stats)
+
+    def commit(self, spool):
+        """Sync the spool, then record the pending batch."""
+        if not self.batch:
+            return
+        spool.flush()
+        os.fsync(spool.fileno())
+        line = json.dumps({'end': spool.tell(), 'tiles': self.batch,
+                           'tables': self.batch_tables,
+                           'stats': self.batch_stats.state()
+                           if self.batch_stats is not None else None})
+        with open(self.path, 'a') as f:
+            f.write(line + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.batch = []
+        self.batch_tables = {}
+        self.batch_stats = None
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class TileEngine(object):
+    """Convert a dataset to a COG by encoding tiles in a process pool.
+
+    The full resolution grid and every overview level are split into tile
+    jobs. Workers reopen the source, read (and so warp, for warped VRTs),
+    resample and compress their tiles, which are spooled to a scratch file
+    next to the output. The tiles are then laid out as a COG: all IFDs
+    first, smallest overview data first and full resolution data last.
+
+    With ``resume`` the spool is kept as ``<output>.spool`` along with a
+    checkpoint journal ``<output>.journal``, so a rerun after a crash only
+    encodes the tiles that were not checkpointed yet. The journal records
+    the size and mtime of ``inputs``, by default the files behind ``ds``,
+    and is not resumed once they changed.
+    """
+
+    def __init__(self, ds, path_output, blocksize=default_config.BLOCKSIZE,
+                 compression=default_config.COMPRESS,
+                 resampling=default_config.RESAMPLING,
+                 overview_levels=default_config.OVERVIEW_LEVELS,
+                 workers=default_config.WORKERS, interleave='PIXEL',
+                 sparse=default_config.SPARSE, resume=False,
+                 statistics=default_config.STATISTICS, narrowing=None,
+                 reader=None, tile_order=default_config.TILE_ORDER,
+                 header_prefetch=default_config.HEADER_PREFETCH,
+                 header_strict=default_config.HEADER_STRICT, inputs=None):
+        assert isinstance(ds, gdal.Dataset), __name__ + \
+            'Excepted osgeo.gdal class type'
+
+        self.ds = ds
+        self.path_output = path_output
+        self.blocksize = blocksize
+        self.compression = compression
+        self.resampling = resampling
+        self.workers = workers or os.cpu_count() or 1
+        # Band interleaved TIFFs store one block per band for every tile
+        self.planes = ds.RasterCount if interleave.upper() == 'BAND' else 1
+        self.levels = plan_levels(ds.RasterXSize, ds.RasterYSize,
+                                  blocksize, overview_levels)
+
+        band = ds.GetRasterBand(1)
+        # A narrower dtype chosen by narrow.plan, applied to every tile
+        if narrowing is not None and not narrowing.changed:
+            narrowing = None
+        self.narrowing = narrowing
+        self.settings = {
+            'dtype': band.DataType if narrowing is None
+            else narrowing.gdal_type,
+            'nodata': band.GetNoDataValue() if narrowing is None
+            else narrowing.target_no_data,
+            'narrowing': narrowing,
+            'reader': reader,
+            'resampling': resample_alg(resampling),
+            'options': creation_options(ds, compression, blocksize,
+                                        interleave),
+            'sparse': sparse,
+            'alpha': overview.alpha_index(ds),
+            'planes': self.planes,
+            # Histogram ranges, None when no statistics are wanted
+            'ranges': stats.ranges(ds) if statistics else None,
+        }
+        self.stats = None
+        # Empty tiles skipped per level, filled by encode
+        self.sparse_tiles = [0] * len(self.levels)
+        if resume and sink.is_remote(path_output):
+            raise EngineException('Resuming needs a local output, the '
+                                  'checkpoint is kept next to it')
+        self.resume = resume
+        self.path_spool = path_output + '.spool'
+        self.path_journal = path_output + '.journal'
+        if tile_order not in TILE_ORDERS:
+            raise EngineException('Unknown tile order %s, use one of %s' %
+                                  (tile_order, ', '.join(TILE_ORDERS)))
+        self.tile_order = tile_order
+        self.header_prefetch = header_prefetch
+        self.header_strict = header_strict
+        # Files identifying the source in the checkpoint journal
+        self.inputs = inputs if inputs is not None else \
+            (ds.GetFileList() or [])
+
+    def job(self):
+        """Settings a checkpoint journal is only valid for."""
+        return {
+            'size': [self.ds.RasterXSize, self.ds.RasterYSize],
+            'bands': self.ds.RasterCount,
+            'levels': [[level.factor, level.width, level.height]
+                       for level in self.levels],
+            'blocksize': self.blocksize,
+            'resampling': self.resampling,
+            'dtype': self.settings['dtype'],
+            'nodata': self.settings['nodata'],
+            'options': self.settings['options'],
+            'sparse': self.settings['sparse'],
+            'planes': self.planes,
+            'ranges': self.settings['ranges'],
+            'source': source_identity(self.inputs),
+            'geotransform': list(self.ds.GetGeoTransform()),
+            'projection': self.ds.GetProjection(),
+        }
+
+    def skeleton_tags(self):
+        """Tags of the full resolution IFD, taken from an empty GTiff."""
+        path = '/vsimem/cogconverter_skeleton_%d.tif' % os.getpid()
+        skeleton = gdal.GetDriverByName('GTiff').Create(
+            path, self.ds.RasterXSize, self.ds.RasterYSize,
+            self.ds.RasterCount, self.settings['dtype'],
+            self.settings['options'] + ['SPARSE_OK=YES', 'BIGTIFF=YES'])
+        skeleton.SetGeoTransform(self.ds.GetGeoTransform())
+        skeleton.SetProjection(self.ds.GetProjection())
+        if self.settings['nodata'] is not None:
+            for i in range(skeleton.RasterCount):
+                skeleton.GetRasterBand(i + 1).SetNoDataValue(
+                    self.settings['nodata'])
+        if self.narrowing is not None:
+            skeleton.SetMetadataItem('SOURCE_DATATYPE',
+                                     str(self.narrowing.source))
+        # Statistics gathered while encoding go to the GDAL_METADATA tag
+        if self.stats is not None:
+            stats.write(skeleton, self.stats,
+                        self.ds.RasterXSize * self.ds.RasterYSize)
+        skeleton = None
+
+        _, _, ifds = tiff.read_ifds(tiff.bytes_reader(_vsimem_bytes(path)))
+        return ifds[0].tags
+
+    def level_tags(self, base_tags, tables):
+        """Tag dictionaries for every level, full resolution first."""
+        all_tags = []
+        for i, level in enumerate(self.levels):
+            tags = dict(base_tags)
+            if i > 0:
+                for tag in tiff.GEO_TAGS + (tiff.GDAL_METADATA,):
+                    tags.pop(tag, None)
+                tags[tiff.NEW_SUBFILE_TYPE] = (tiff.LONG, (1,))
+            tags[tiff.IMAGE_WIDTH] = (tiff.LONG, (level.width,))
+            tags[tiff.IMAGE_LENGTH] = (tiff.LONG, (level.height,))
+            if tables[i] is not None:
+                tags[tiff.JPEG_TABLES] = tables[i]
+            all_tags.append(tags)
+        return all_tags
+
+    def tile_orders(self):
+        """Per level order of the tile data, None for row-major."""
+        if self.tile_order == 'row':
+            return None
+        return [tiff.hilbert_order(level.tiles_x, level.tiles_y,
+                                   self.planes) for level in self.levels]
+
+    def jobs(self, done=()):
+        for i, level in enumerate(self.levels):
+            for index in range(level.tile_count):
+                if (i, index) not in done:
+                    yield i, index
+
+    def encode(self, spool, journal=None):
+        """Encode every tile into ``spool``; return offsets, sizes, tables.
+
+        Offsets and sizes are indexed like the TIFF tile tables, that is
+        band by band for band interleaved output. Tiles already in
+        ``journal`` are not encoded again, new ones are checkpointed to it.
+        """
+        spool_offsets = [[0] * (level.tile_count * self.planes)
+                         for level in self.levels]
+        tile_sizes = [[0] * (level.tile_count * self.planes)
+                      for level in self.levels]
+        tables = [None] * len(self.levels)
+        total = sum(level.tile_count for level in self.levels)
+
+        done = journal.done if journal is not None else {}
+        for (level, index), (offset, sizes) in done.items():
+            count = self.levels[level].tile_count
+            if not any(sizes):
+                self.sparse_tiles[level] += 1
+            for plane, size in enumerate(sizes):
+                spool_offsets[level][plane * count + index] = offset
+                tile_sizes[level][plane * count + index] = size
+                offset += size
+        if journal is not None:
+            for level, level_tables in journal.tables.items():
+                tables[level] = level_tables
+            if journal.stats is not None:
+                self.stats = stats.Stats(journal.stats.ranges,
+                                         journal.stats.bins)
+                self.stats.merge(journal.stats)
+        total -= len(done)
+
+        spec = source_spec(self.ds)
+        if spec is None or self.workers == 1:
+            # Source only reachable from this process, encode in place
+            results = (
+                (level, index) + encode_tile(self.ds, self.levels[level],
+                                             index, self.settings)
+                for level, index in self.jobs(done))
+            pool = None
+        else:
+            pool = multiprocessing.Pool(
+                self.workers, initializer=_init_worker,
+                initargs=(spec, self.levels, self.settings))
+            results = pool.imap_unordered(_encode_job, self.jobs(done),
+                                          chunksize=16)
+
+        try:
+            for level, index, blocks, level_tables, tile_stats in tqdm(
+                    results, total=total):
+                count = self.levels[level].tile_count
+                if not any(blocks):
+                    self.sparse_tiles[level] += 1
+                offset = spool.tell()
+                for plane, data in enumerate(blocks):
+                    spool_offsets[level][plane * count + index] = spool.tell()
+                    tile_sizes[level][plane * count + index] = len(data)
+                    spool.write(data)
+                if tables[level] is None:
+                    tables[level] = level_tables
+                if tile_stats is not None:
+                    if self.stats is None:
+                        self.stats = stats.Stats(tile_stats.ranges,
+                                                 tile_stats.bins)
+                    self.stats.merge(tile_stats)
+                if journal is not None:
+                    journal.add(level, index, offset,
+                                [len(data) for data in blocks], level_tables,
+                                tile_stats)
+                    if len(journal.batch) >= default_config.CHECKPOINT_TILES:
+                        journal.commit(spool)
+        finally:
+            if journal is not None:
+                journal.commit(spool)
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        return spool_offsets, tile_sizes, tables
+
+    def run(self):
+        print('Processing: Encoding %d levels with %d workers' %
+              (len(self.levels), self.workers))
+
+        # The spool of remote outputs goes to the temporary folder
+        folder = None if sink.is_remote(self.path_output) else \
+            os.path.dirname(os.path.abspath(self.path_output))
+        pixels = sum(level.width * level.height for level in self.levels) * \
+            self.ds.RasterCount
+        journal = None
+        if self.resume:
+            spool, journal = self.open_checkpoint()
+        else:
+            spool = tempfile.TemporaryFile(dir=folder)
+
+        with spool:
+            with instrument.stage('encode', pixels=pixels,
+                                  workers=self.workers,
+                                  tiles=sum(level.tile_count
+                                            for level in self.levels)) \
+                    as fields:
+                if journal is not None:
+                    fields['resumed_tiles'] = len(journal.done)
+                spool_offsets, tile_sizes, tables = self.encode(spool,
+                                                                journal)
+                fields['bytes_written'] = spool.tell()
+                fields['sparse_tiles'] = sum(self.sparse_tiles)
+                fields['sparse_tiles_per_level'] = self.sparse_tiles
+            if any(self.sparse_tiles):
+                print('Processing: Skipped %d empty tiles' %
+                      sum(self.sparse_tiles))
+
+            print('Processing: Assembling COG layout')
+            with instrument.stage('assemble') as fields:
+                orders = self.tile_orders()
+                header, _ = tiff.build_header(
+                    self.level_tags(self.skeleton_tags(), tables), tile_sizes,
+                    orders)
+                fields['header_bytes'] = len(header)
+                fields['tile_order'] = self.tile_order
+
+                # Remote outputs are uploaded in parts while being written,
+                # the size picks parts within the S3 part count limit
+                expected_size = len(header) + sum(sum(sizes)
+                                                  for sizes in tile_sizes)
+                with sink.open_sink(self.path_output,
+                                    expected_size=expected_size) as out:
+                    out.write(header)
+                    for level, index in tiff.data_order(tile_sizes, orders):
+                        size = tile_sizes[level][index]
+                        if size == 0:
+                            continue
+                        spool.seek(spool_offsets[level][index])
+                        out.write(spool.read(size))
+                    fields['bytes_written'] = out.bytes_written
+
+        # The output is complete, the checkpoint is not needed anymore
+        if journal is not None:
+            journal.remove()
+            os.remove(self.path_spool)
+
+        print('Success: Encoded %s' % self.path_output)
+        return self.path_output
+
+    def open_checkpoint(self):
+        """Open the spool and journal, keeping what a previous run did.
+
+        The spool is cut back to the last batch the journal recorded, which
+        drops tiles written after the last checkpoint of a crashed run.
+        """
+        journal = Journal(self.path_journal, self.job())
+        mode = 'r+b' if os.path.exists(self.path_spool) else 'w+b'
+        spool = open(self.path_spool, mode)
+        spool.seek(0, os.SEEK_END)
+        end = journal.load(spool.tell())
+        if end == 0:
+            journal.start()
+        else:
+            print('Resuming: %d tiles already encoded' % len(journal.done))
+        spool.truncate(end)
+        spool.seek(end)
+        return spool, journal
+
+    def check(self):
+        """Raise if the written output is not a valid COG.
+
+        The header written, everything before the first tile, is also
+        compared with the header prefetch. Clients reading a larger header
+        need more requests, which is only an error with ``header_strict``.
+        """
+        from cogconverter import validator
+        if sink.is_remote(self.path_output):
+            # Only the header is fetched back from object storage
+            reader = tiff.RangeReader(sink.s3_fetch(self.path_output),
+                                      prefetch=self.header_prefetch)
+            _, errors, details = validator.validate(self.path_output,
+                                                    backend='header',
+                                                    reader=reader)
+        else:
+            _, errors, details = validator.validate(self.path_output)
+
+        written = [offset for offset in
+                   details.get('data_offsets', {}).values() if offset]
+        header_bytes = min(written) if written else None
+        instrument.emit({'event': 'header', 'header_bytes': header_bytes,
+                         'prefetch': self.header_prefetch})
+        if header_bytes is not None and \
+                header_bytes > self.header_prefetch:
+            message = '%d bytes of header exceed the %d bytes prefetch' % (
+                header_bytes, self.header_prefetch)
+            if self.header_strict:
+                errors = errors + [message]
+            else:
+                print('Warning: %s' % message)
+        if errors:
+            raise EngineException('Output is not a valid COG: %s' %
+                                  '; '.join(errors))
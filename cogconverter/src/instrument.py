@@ -0,0 +1,152 @@
+from osgeo import gdal
+import contextlib
+import json
+import logging
+import resource
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Callables receiving every event dictionary, see add_hook
+_hooks = []
+
+# Fields added to every event of the current job
+_job = {}
+
+# Minimum completion step between two progress events of a stage
+PROGRESS_STEP = 0.05
+
+
+def add_hook(hook):
+    """Register ``hook(event)`` to be called with every event dictionary."""
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+
+def emit(event):
+    """Send an event to the package logger as JSON and to every hook."""
+    event = dict(_job, **event)
+    logger.info(json.dumps(event, default=str))
+    for hook in list(_hooks):
+        hook(event)
+
+
+@contextlib.contextmanager
+def job(job_id, **fields):
+    """Tag every event emitted inside the block with ``job_id``."""
+    previous = dict(_job)
+    _job.clear()
+    _job.update(fields, job=job_id)
+    start = time.time()
+    emit({'event': 'job_start'})
+    try:
+        yield
+    finally:
+        emit(dict({'event': 'job_end',
+                   'seconds': round(time.time() - start, 3)},
+                  **memory()))
+        _job.clear()
+        _job.update(previous)
+
+
+def process_io():
+    """Bytes read and written by this process, from /proc/self/io.
+
+    ``read_bytes`` only counts reads that reached the storage layer, while
+    ``rchar`` counts every read call, page cache hits included.
+    """
+    counters = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                name, value = line.split(':')
+                counters[name.strip()] = int(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return counters
+
+
+def memory():
+    """Peak resident memory of this process and its finished children."""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {'peak_rss_mb': round(own / 1024.0, 1),
+            'peak_rss_children_mb': round(children / 1024.0, 1)}
+
+
+def cache():
+    """Usage of the GDAL block cache."""
+    return {'cache_used_mb': round(gdal.GetCacheUsed() / 1024.0 / 1024.0, 1),
+            'cache_max_mb': round(gdal.GetCacheMax() / 1024.0 / 1024.0, 1)}
+
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    """Time a pipeline stage and emit a 'stage' event when it ends.
+
+    The yielded dictionary can be updated inside the block, for example
+    with 'pixels', 'bytes_read' or 'bytes_written' the stage knows about.
+    I/O counters of this process are added as 'io_read_bytes' and
+    'io_write_bytes'. When the stage reports the pixel bytes it requested
+    ('bytes_read'), 'cache_hit_rate' estimates the share of them that did
+    not have to be read from storage (GDAL block cache or OS page cache).
+    """
+    io_before = process_io()
+    start = time.time()
+    emit({'event': 'stage_start', 'stage': name})
+    try:
+        yield fields
+    finally:
+        seconds = time.time() - start
+        io_after = process_io()
+        event = {'event': 'stage', 'stage': name,
+                 'seconds': round(seconds, 3)}
+        event.update(fields)
+        if io_after:
+            event['io_read_bytes'] = \
+                io_after['read_bytes'] - io_before.get('read_bytes', 0)
+            event['io_write_bytes'] = \
+                io_after['write_bytes'] - io_before.get('write_bytes', 0)
+        if fields.get('bytes_read') and 'io_read_bytes' in event:
+            event['cache_hit_rate'] = round(max(
+                0.0, 1.0 - event['io_read_bytes'] /
+                float(fields['bytes_read'])), 3)
+        if seconds > 0:
+            if fields.get('pixels'):
+                event['pixels_per_s'] = round(fields['pixels'] / seconds)
+            if fields.get('bytes_written'):
+                event['write_mb_per_s'] = round(
+                    fields['bytes_written'] / 1024.0 / 1024.0 / seconds, 2)
+        event.update(memory())
+        event.update(cache())
+        emit(event)
+
+
+def progress(name, pixels=None):
+    """GDAL progress callback emitting 'progress' events for a stage.
+
+    Pass it as ``callback`` to CreateCopy, BuildOverviews, Translate or
+    Warp. Events are throttled to one every PROGRESS_STEP of completion.
+    """
+    start = time.time()
+    state = {'last': -1.0}
+
+    def callback(complete, message, data):
+        if complete - state['last'] < PROGRESS_STEP and complete < 1.0:
+            return 1
+        state['last'] = complete
+        seconds = time.time() - start
+        event = {'event': 'progress', 'stage': name,
+                 'complete': round(complete, 3),
+                 'seconds': round(seconds, 3)}
+        if pixels and seconds > 0:
+            event['pixels_per_s'] = round(pixels * complete / seconds)
+        emit(event)
+        return 1
+
+    return callback
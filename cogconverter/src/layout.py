@@ -0,0 +1,126 @@
+from osgeo import gdal
+import json
+
+from cogconverter.config import default_config
+
+
+TILE_SIZES = (256, 512, 1024)
+
+
+class Layout(object):
+    """Tile size, overview factors and interleave planned for a raster."""
+
+    def __init__(self, width, height, bands, itemsize, compression,
+                 blocksize, factors, interleave):
+        self.width = width
+        self.height = height
+        self.bands = bands
+        self.itemsize = itemsize
+        self.compression = compression
+        self.blocksize = blocksize
+        self.factors = factors
+        self.interleave = interleave
+
+    @property
+    def ovr_blocksize(self):
+        """Value for the GDAL_TIFF_OVR_BLOCKSIZE config option."""
+        return self.blocksize
+
+    def creation_options(self):
+        return ['TILED=YES',
+                'BLOCKXSIZE=%d' % self.blocksize,
+                'BLOCKYSIZE=%d' % self.blocksize,
+                'INTERLEAVE=%s' % self.interleave]
+
+    def as_dict(self):
+        levels = [{'factor': 1, 'size': [self.width, self.height]}]
+        for factor in self.factors:
+            levels.append({'factor': factor,
+                           'size': [-(-self.width // factor),
+                                    -(-self.height // factor)]})
+        return {
+            'size': [self.width, self.height],
+            'bands': self.bands,
+            'compression': self.compression,
+            'blocksize': self.blocksize,
+            'GDAL_TIFF_OVR_BLOCKSIZE': self.ovr_blocksize,
+            'interleave': self.interleave,
+            'overview_factors': self.factors,
+            'levels': levels,
+        }
+
+    def __str__(self):
+        return json.dumps(self.as_dict(), indent=4)
+
+
+def codec_name(compression):
+    """Codec of a compression name or creation options list."""
+    if isinstance(compression, str):
+        return compression.upper()
+    for option in compression or ():
+        if option.upper().startswith('COMPRESS='):
+            return option.split('=', 1)[1].upper()
+    return 'NONE'
+
+
+def choose_blocksize(width, height, bands, itemsize,
+                     max_tile_bytes=default_config.MAX_TILE_BYTES):
+    """Larger tiles for larger rasters, within an uncompressed tile budget.
+
+    Large tiles keep the tile offset tables and the request count of huge
+    mosaics manageable, small tiles keep small rasters and partial reads
+    cheap.
+    """
+    longest = max(width, height)
+    if longest >= 131072:
+        wanted = 1024
+    elif longest >= 32768:
+        wanted = 512
+    else:
+        wanted = 256
+
+    for size in sorted(TILE_SIZES, reverse=True):
+        if size <= wanted and size * size * bands * itemsize <= max_tile_bytes:
+            return size
+    return TILE_SIZES[0]
+
+
+def overview_factors(width, height, blocksize):
+    """Power of two factors until the smallest overview fits in one tile."""
+    factors = []
+    factor = 2
+    while -(-width // (factor // 2)) > blocksize or \
+            -(-height // (factor // 2)) > blocksize:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def choose_interleave(bands, compression):
+    """PIXEL for imagery codecs and few bands, BAND for many band stacks."""
+    if codec_name(compression) in ('JPEG', 'WEBP') or bands <= 4:
+        return 'PIXEL'
+    return 'BAND'
+
+
+def plan(width, height, bands, itemsize, compression=default_config.COMPRESS,
+         blocksize=None):
+    """Plan the layout of a COG. ``blocksize`` forces the tile size."""
+    interleave = choose_interleave(bands, compression)
+    if blocksize is None:
+        # A band interleaved block holds a single band
+        blocksize = choose_blocksize(
+            width, height, bands if interleave == 'PIXEL' else 1, itemsize)
+    return Layout(width, height, bands, itemsize, codec_name(compression),
+                  blocksize, overview_factors(width, height, blocksize),
+                  interleave)
+
+
+def plan_dataset(ds, compression=default_config.COMPRESS, blocksize=None,
+                 itemsize=None):
+    """Plan the layout of ``ds``. ``itemsize`` overrides the one of its
+    dtype, for tiles stored narrowed."""
+    if itemsize is None:
+        itemsize = gdal.GetDataTypeSize(ds.GetRasterBand(1).DataType) // 8
+    return plan(ds.RasterXSize, ds.RasterYSize, ds.RasterCount, itemsize,
+                compression, blocksize)
@@ -5,12 +5,86 @@ import utm
 import gdal
 import datetime
 
+from cogconverter.src import stats
+
+
+# Number of points sampled along each edge for the lat/lon bbox
+DENSIFY_POINTS = 21
+
+
+def local_time():
+    """Default timestamp source, never blocks."""
+    return str(datetime.datetime.utcnow()).split('.')[0], 'local'
+
+
+def ntp_time(server='europe.pool.ntp.org', timeout=1):
+    """Timestamp from an NTP server, falling back to the local clock."""
+    try:
+        import ntplib
+        x = ntplib.NTPClient()
+        timestamp = str(datetime.datetime.utcfromtimestamp(
+            x.request(server, timeout=timeout).tx_time))
+        return timestamp, 'internet'
+    except Exception:
+        print('Could not sync with time server. Taking Local TimeStamp')
+        return local_time()
+
+
+def lonlat_srs():
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    if hasattr(srs, 'SetAxisMappingStrategy'):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def edge_points(col, row, densify=DENSIFY_POINTS):
+    """Pixel coordinates sampled along the four edges of a raster."""
+    steps = [i / float(densify - 1) for i in range(densify)]
+    points = []
+    for t in steps:
+        points += [(t * col, 0), (t * col, row), (0, t * row), (col, t * row)]
+    return points
+
+
+def bbox_lonlat(ds, densify=DENSIFY_POINTS):
+    """[min_lon, min_lat, max_lon, max_lat] of ``ds`` without warping it.
+
+    Points along the edges are transformed, rather than only the corners,
+    so that edges curving in the target projection are covered.
+    """
+    gt = ds.GetGeoTransform()
+    points = []
+    for px, py in edge_points(ds.RasterXSize, ds.RasterYSize, densify):
+        points.append((gt[0] + px * gt[1] + py * gt[2],
+                       gt[3] + px * gt[4] + py * gt[5]))
+
+    # Without a projection the native extent is the best available
+    wkt = ds.GetProjection()
+    if wkt:
+        source = osr.SpatialReference(wkt=wkt)
+        if hasattr(source, 'SetAxisMappingStrategy'):
+            source.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        target = lonlat_srs()
+        if not source.IsSame(target):
+            transform = osr.CoordinateTransformation(source, target)
+            points = [p[:2] for p in transform.TransformPoints(points)]
+
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    return [min(xs), min(ys), max(xs), max(ys)]
+
 
 # Metadata class
 class Metadata(object):
 
-    def __init__(self, payload):
+    def __init__(self, payload, clock=local_time):
+        """
+        payload is the raster file name
+        clock returns a (timestamp, source) tuple, see local_time and ntp_time
+        """
         self.payload = payload
+        self.clock = clock
 
     # Check directory
     def checkdirs(self, output_folder):
@@ -72,8 +146,6 @@ class Metadata(object):
     # Extracting metadata
     def extract(self):
         metadata = {}
-        ds_geo = gdal.Warp('', self.payload, dstSRS='EPSG:4326', format='VRT')
-
         ds = gdal.Open(self.payload)
 
         num_band = ds.RasterCount
@@ -99,19 +171,10 @@ class Metadata(object):
         px_height = geotransform[5]
 
         # Generate bbox in latitude and longitude only
-        bbox = self.GetExtent(ds_geo, row, col)
+        bbox = bbox_lonlat(ds)
 
         # Getting time information
-        try:
-            import ntplib
-            x = ntplib.NTPClient()
-            timestamp = str(datetime.datetime.utcfromtimestamp(
-                x.request('europe.pool.ntp.org').tx_time))
-            time_source = 'internet'
-        except:
-            print('Could not sync with time server. Taking Local TimeStamp')
-            timestamp = str(datetime.datetime.utcnow()).split('.')[0]
-            time_source = 'local'
+        timestamp, time_source = self.clock()
 
         # Generating metadata
         metadata['bbox'] = bbox
@@ -127,5 +190,7 @@ class Metadata(object):
         metadata['file'] = os.path.basename(self.payload)
         metadata['time'] = timestamp
         metadata['timesource'] = time_source
+        # Band statistics stored by the converter, None if not computed
+        metadata['statistics'] = stats.read(ds)
 
-        return metadata
\ No newline at end of file
+        return metadata
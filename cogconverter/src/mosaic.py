@@ -0,0 +1,258 @@
+from osgeo import gdal
+from osgeo import gdal_array
+import collections
+import math
+import numpy as np
+import os
+import shutil
+import tempfile
+
+from cogconverter.config import default_config
+from cogconverter.src import warp
+
+
+OVERLAPS = ('first', 'last', 'fill')
+
+# Cell size in output pixels of the footprint index
+INDEX_CELL = 4096
+
+
+class MosaicException(Exception):
+    pass
+
+
+class Source(object):
+    """Footprint of one input in output pixel coordinates."""
+
+    def __init__(self, order, path, ds, geotransform):
+        gt = ds.GetGeoTransform()
+        self.order = order
+        # VRT of the input on the mosaic grid, see Mosaic.build
+        self.path = path
+        self.width = ds.RasterXSize
+        self.height = ds.RasterYSize
+        self.no_data = ds.GetRasterBand(1).GetNoDataValue()
+
+        # Output pixels per source pixel, both grids are north up
+        self.scale_x = gt[1] / geotransform[1]
+        self.scale_y = gt[5] / geotransform[5]
+        self.x0 = (gt[0] - geotransform[0]) / geotransform[1]
+        self.y0 = (gt[3] - geotransform[3]) / geotransform[5]
+        self.x1 = self.x0 + self.width * self.scale_x
+        self.y1 = self.y0 + self.height * self.scale_y
+
+    def valid(self, array):
+        """Pixels where any band holds data."""
+        if self.no_data is None:
+            return np.ones(array.shape[1:], dtype=bool)
+        if np.isnan(self.no_data):
+            return ~np.isnan(array).all(axis=0)
+        return (array != self.no_data).any(axis=0)
+
+
+class Mosaic(object):
+    """Mosaic many inputs into one virtual raster read tile by tile.
+
+    Inputs not in the target SRS are warped into VRT files. A VRT of all
+    inputs gives the output grid, SRS and band layout, while reads go
+    through ``read``. A grid index over the footprints finds the inputs
+    intersecting a tile, and only those are read. Overlaps are resolved in
+    input order. 'first' keeps the first input covering a pixel and 'last'
+    the last valid one. 'fill' keeps the first valid (not nodata) value, so
+    the nodata collars of a tile are filled by the inputs below it.
+
+    Every input is read through a VRT placing it on the mosaic grid, so
+    GDAL resamples it from fractional source windows instead of windows
+    snapped to whole source pixels.
+
+    Usage:
+        with Mosaic(paths) as mosaic:
+            convert2blocksize(mosaic.ds, path_output, reader=mosaic)
+    """
+
+    def __init__(self, paths, dst_srs=default_config.EPSG_CRS,
+                 overlap=default_config.MOSAIC_OVERLAP, folder=None,
+                 warp_memory_mb=default_config.WARP_MEMORY_MB,
+                 warp_threads=default_config.WARP_THREADS,
+                 open_files=default_config.MOSAIC_OPEN_FILES):
+        if overlap not in OVERLAPS:
+            raise MosaicException('Unknown overlap %s, use one of %s' %
+                                  (overlap, ', '.join(OVERLAPS)))
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.dst_srs = dst_srs
+        self.overlap = overlap
+        self.folder = folder
+        self.warp_memory_mb = warp_memory_mb
+        self.warp_threads = warp_threads
+        self.open_files = open_files
+        self.ds = None
+        self.sources = []
+        self.index = {}
+        self._handles = collections.OrderedDict()
+
+    def __getstate__(self):
+        # Datasets stay in the process that opened them
+        state = dict(self.__dict__)
+        state['ds'] = None
+        state['_handles'] = collections.OrderedDict()
+        return state
+
+    def build(self):
+        self.folder = tempfile.mkdtemp(prefix='cogconverter_mosaic_',
+                                       dir=self.folder)
+        specs = []
+        for i, path in enumerate(self.paths):
+            warp_plan = warp.plan(path, self.dst_srs)
+            if warp_plan.action == 'direct':
+                specs.append(path)
+                continue
+            path_warped = os.path.join(self.folder, 'warped_%d.vrt' % i)
+            ds = warp.open_source(warp_plan,
+                                  warp_memory_mb=self.warp_memory_mb,
+                                  threads=self.warp_threads,
+                                  intermediate_format='VRT',
+                                  path_warped=path_warped)
+            ds = None
+            specs.append(path_warped)
+
+        first = gdal.Open(specs[0])
+        no_data = first.GetRasterBand(1).GetNoDataValue()
+        if no_data is None:
+            dtype = gdal_array.GDALTypeCodeToNumericTypeCode(
+                first.GetRasterBand(1).DataType)
+            no_data = 0 if np.dtype(dtype).kind == 'u' else \
+                default_config.NO_DATA
+        first = None
+
+        path_vrt = os.path.join(self.folder, 'mosaic.vrt')
+        vrt = gdal.BuildVRT(path_vrt, specs, resolution='highest',
+                            VRTNodata=no_data)
+        if vrt is None:
+            raise MosaicException('Unable to build the mosaic VRT')
+        vrt = None
+        self.ds = gdal.Open(path_vrt)
+        self.no_data = no_data
+        self.bands = self.ds.RasterCount
+        self.dtype = gdal_array.GDALTypeCodeToNumericTypeCode(
+            self.ds.GetRasterBand(1).DataType)
+
+        geotransform = self.ds.GetGeoTransform()
+        bounds = (geotransform[0],
+                  geotransform[3] + self.ds.RasterYSize * geotransform[5],
+                  geotransform[0] + self.ds.RasterXSize * geotransform[1],
+                  geotransform[3])
+        for i, spec in enumerate(specs):
+            ds = gdal.Open(spec)
+            if ds.RasterCount != self.bands:
+                raise MosaicException('%s has %d bands, expected %d' % (
+                    self.paths[i], ds.RasterCount, self.bands))
+            # Same grid as the mosaic, output pixels address the input
+            path_grid = os.path.join(self.folder, 'grid_%d.vrt' % i)
+            grid = gdal.BuildVRT(path_grid, [spec], outputBounds=bounds,
+                                 xRes=geotransform[1],
+                                 yRes=-geotransform[5])
+            if grid is None:
+                raise MosaicException('Unable to place %s on the mosaic '
+                                      'grid' % self.paths[i])
+            grid = None
+            source = Source(i, path_grid, ds, geotransform)
+            self.sources.append(source)
+            for cell in self.cells(source.x0, source.y0, source.x1,
+                                   source.y1):
+                self.index.setdefault(cell, []).append(i)
+            ds = None
+
+        print('Mosaic: %d inputs into %dx%d (%s overlap)' % (
+            len(self.sources), self.ds.RasterXSize, self.ds.RasterYSize,
+            self.overlap))
+        return self.ds
+
+    def cells(self, x0, y0, x1, y1):
+        for cy in range(int(math.floor(y0 / INDEX_CELL)),
+                        int(math.floor(y1 / INDEX_CELL)) + 1):
+            for cx in range(int(math.floor(x0 / INDEX_CELL)),
+                            int(math.floor(x1 / INDEX_CELL)) + 1):
+                yield cx, cy
+
+    def candidates(self, x0, y0, x1, y1):
+        """Inputs intersecting a window, in input order."""
+        found = set()
+        for cell in self.cells(x0, y0, x1, y1):
+            found.update(self.index.get(cell, ()))
+        sources = [self.sources[i] for i in sorted(found)]
+        return [s for s in sources
+                if s.x0 < x1 and s.x1 > x0 and s.y0 < y1 and s.y1 > y0]
+
+    def handle(self, source):
+        """Dataset of an input, keeping at most ``open_files`` open."""
+        ds = self._handles.pop(source.path, None)
+        if ds is None:
+            ds = gdal.Open(source.path)
+            if len(self._handles) >= self.open_files:
+                self._handles.popitem(last=False)
+        self._handles[source.path] = ds
+        return ds
+
+    def read(self, xoff, yoff, xsize, ysize, buf_xsize, buf_ysize,
+             resample_alg=gdal.GRIORA_NearestNeighbour):
+        """Read a window of the mosaic, like Dataset.ReadAsArray."""
+        out = np.full((self.bands, buf_ysize, buf_xsize), self.no_data,
+                      dtype=self.dtype)
+        taken = np.zeros((buf_ysize, buf_xsize), dtype=bool)
+        step_x = xsize / float(buf_xsize)
+        step_y = ysize / float(buf_ysize)
+
+        for source in self.candidates(xoff, yoff, xoff + xsize,
+                                      yoff + ysize):
+            # Buffer pixels whose centre falls in the source
+            dx0 = max(0, int(math.ceil((source.x0 - xoff) / step_x - 0.5)))
+            dx1 = min(buf_xsize,
+                      int(math.ceil((source.x1 - xoff) / step_x - 0.5)))
+            dy0 = max(0, int(math.ceil((source.y0 - yoff) / step_y - 0.5)))
+            dy1 = min(buf_ysize,
+                      int(math.ceil((source.y1 - yoff) / step_y - 0.5)))
+            if dx1 <= dx0 or dy1 <= dy0:
+                continue
+
+            array = self.handle(source).ReadAsArray(
+                xoff, yoff, xsize, ysize, buf_xsize=buf_xsize,
+                buf_ysize=buf_ysize, resample_alg=resample_alg)
+            if array.ndim == 2:
+                array = array[np.newaxis]
+            array = array[:, dy0:dy1, dx0:dx1]
+
+            region = taken[dy0:dy1, dx0:dx1]
+            valid = source.valid(array)
+            if self.overlap == 'last':
+                # Nodata of a later input never hides valid pixels
+                write = valid
+            elif self.overlap == 'first':
+                write = ~region
+            else:
+                write = ~region & valid
+
+            # Source nodata becomes the mosaic nodata
+            array = np.where(valid, array, self.no_data).astype(self.dtype)
+            window = out[:, dy0:dy1, dx0:dx1]
+            window[:, write] = array[:, write]
+            region |= write if self.overlap == 'first' else valid
+
+            if self.overlap != 'last' and taken.all():
+                break
+        return out
+
+    def cleanup(self):
+        self.ds = None
+        self._handles.clear()
+        if self.folder and os.path.isdir(self.folder) and \
+                os.path.basename(self.folder).startswith(
+                    'cogconverter_mosaic_'):
+            shutil.rmtree(self.folder, ignore_errors=True)
+
+    def __enter__(self):
+        self.build()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+        return False
@@ -0,0 +1,198 @@
+from osgeo import gdal_array
+import numpy as np
+
+from cogconverter.src import instrument
+
+
+# Lossless targets by increasing size
+INTEGER_TYPES = [np.uint8, np.uint16, np.int16, np.uint32, np.int32]
+
+
+class ValueRange(object):
+    """Range and integrality of the valid pixels of a raster."""
+
+    def __init__(self):
+        self.minimum = None
+        self.maximum = None
+        self.integral = True
+        self.float32_exact = True
+        self.has_nan = False
+        self.count = 0
+
+    def add(self, values):
+        """Add valid pixel values, NaN included."""
+        if values.dtype.kind == 'f':
+            nan = np.isnan(values)
+            if nan.any():
+                self.has_nan = True
+                values = values[~nan]
+        if not values.size:
+            return
+        self.count += values.size
+        low = values.min()
+        high = values.max()
+        self.minimum = low if self.minimum is None else min(self.minimum, low)
+        self.maximum = high if self.maximum is None else \
+            max(self.maximum, high)
+        if values.dtype.kind == 'f':
+            if self.integral:
+                self.integral = bool(np.all(np.floor(values) == values))
+            if self.float32_exact and values.dtype.itemsize > 4:
+                self.float32_exact = bool(np.all(
+                    values.astype(np.float32).astype(values.dtype) == values))
+
+
+def scan(ds):
+    """Stream ``ds`` once in block rows and collect its value range."""
+    value_range = ValueRange()
+    band = ds.GetRasterBand(1)
+    no_data = band.GetNoDataValue()
+    rows = band.GetBlockSize()[1]
+    pixels = ds.RasterXSize * ds.RasterYSize * ds.RasterCount
+
+    with instrument.stage('narrow_scan', pixels=pixels, bytes_read=0) \
+            as fields:
+        for i in range(ds.RasterCount):
+            band = ds.GetRasterBand(i + 1)
+            for y in range(0, ds.RasterYSize, rows):
+                array = band.ReadAsArray(0, y, ds.RasterXSize,
+                                         min(rows, ds.RasterYSize - y))
+                fields['bytes_read'] += array.nbytes
+                if no_data is None:
+                    array = array.ravel()
+                elif np.isnan(no_data):
+                    array = array[~np.isnan(array)]
+                else:
+                    array = array[array != no_data]
+                value_range.add(array)
+    return value_range
+
+
+def _free_value(dtype, value_range):
+    """A value of ``dtype`` outside the data range, to hold nodata."""
+    info = np.iinfo(dtype)
+    if value_range.maximum is None:
+        return info.max
+    if value_range.maximum < info.max:
+        return info.max
+    if value_range.minimum > info.min:
+        return info.min
+    return None
+
+
+def _same_value(a, b):
+    """Equality of two nodata values, NaN equal to NaN."""
+    if a is None or b is None:
+        return a is b
+    return a == b or (np.isnan(a) and np.isnan(b))
+
+
+class Narrowing(object):
+    """Decision of the dtype a raster is stored with."""
+
+    def __init__(self, source, target, no_data, target_no_data, reason):
+        self.source = np.dtype(source)
+        self.target = np.dtype(target)
+        self.no_data = no_data
+        self.target_no_data = target_no_data
+        self.reason = reason
+
+    @property
+    def changed(self):
+        return self.source != self.target or \
+            not _same_value(self.no_data, self.target_no_data)
+
+    @property
+    def gdal_type(self):
+        return gdal_array.NumericTypeCodeToGDALTypeCode(self.target)
+
+    @classmethod
+    def from_dict(cls, values):
+        """Narrowing of an ``as_dict`` result, e.g. read back from JSON."""
+        return cls(values['source'], values['target'], values['nodata'],
+                   values['target_nodata'], values['reason'])
+
+    def as_dict(self):
+        return {'source': str(self.source), 'target': str(self.target),
+                'nodata': self.no_data, 'target_nodata': self.target_no_data,
+                'reason': self.reason}
+
+    def __str__(self):
+        return 'Narrowing: %s -> %s (%s)' % (self.source, self.target,
+                                             self.reason)
+
+    def apply(self, array, valid=None):
+        """Cast a tile to the target dtype, remapping nodata.
+
+        ``valid`` marks the pixels that are not nodata in the source, it is
+        computed from the source nodata when not given.
+        """
+        if not self.changed:
+            return array
+        if valid is None and self.no_data is not None:
+            if np.isnan(self.no_data):
+                valid = ~np.isnan(array)
+            else:
+                valid = array != self.no_data
+        if self.target.kind in 'iu' and array.dtype.kind == 'f':
+            # Resampled overviews may not be integral anymore
+            array = np.rint(array)
+        out = array.astype(self.target)
+        if valid is not None and self.target_no_data is not None:
+            out[~valid] = self.target_no_data
+        return out
+
+
+def choose(dtype, value_range, no_data=None):
+    """Smallest dtype holding every valid value of ``value_range`` exactly.
+
+    Nodata keeps its value when the narrower dtype can hold it outside the
+    data range, otherwise it moves to the largest (or smallest) value of
+    the dtype.
+
+    Returns:
+      A Narrowing.
+    """
+    dtype = np.dtype(dtype)
+    if value_range.count == 0:
+        return Narrowing(dtype, dtype, no_data, no_data, 'only nodata')
+
+    if value_range.integral and not value_range.has_nan:
+        for candidate in INTEGER_TYPES:
+            candidate = np.dtype(candidate)
+            if candidate.itemsize >= dtype.itemsize:
+                break
+            info = np.iinfo(candidate)
+            if value_range.minimum < info.min or \
+                    value_range.maximum > info.max:
+                continue
+            if no_data is None:
+                return Narrowing(dtype, candidate, None, None,
+                                 'integral values in [%s, %s]' %
+                                 (value_range.minimum, value_range.maximum))
+            if not np.isnan(no_data) and float(no_data).is_integer() and \
+                    info.min <= no_data <= info.max:
+                target_no_data = no_data
+            else:
+                target_no_data = _free_value(candidate, value_range)
+                if target_no_data is None:
+                    continue
+                target_no_data = int(target_no_data)
+            return Narrowing(dtype, candidate, no_data, target_no_data,
+                             'integral values in [%s, %s]' %
+                             (value_range.minimum, value_range.maximum))
+
+    if dtype == np.float64 and value_range.float32_exact:
+        return Narrowing(dtype, np.float32, no_data, no_data,
+                         'values exact in float32')
+    return Narrowing(dtype, dtype, no_data, no_data,
+                     'no smaller lossless dtype')
+
+
+def plan(ds):
+    """Scan ``ds`` and choose its narrowest lossless dtype."""
+    band = ds.GetRasterBand(1)
+    dtype = gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType)
+    narrowing = choose(dtype, scan(ds), band.GetNoDataValue())
+    instrument.emit(dict({'event': 'narrowing'}, **narrowing.as_dict()))
+    return narrowing
@@ -0,0 +1,261 @@
+from osgeo import gdal
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import numpy as np
+import os
+
+from cogconverter.config import default_config
+from cogconverter.src import instrument
+
+
+# Resampling methods computed with NumPy, others are left to GDAL
+METHODS = ('NEAREST', 'AVERAGE', 'MODE', 'MIN', 'MAX')
+
+
+class OverviewException(Exception):
+    pass
+
+
+def _blocks(array, ratio):
+    """View ``(bands, h, w)`` as ``(bands, h/ratio, w/ratio, ratio**2)``."""
+    bands, height, width = array.shape
+    blocks = array.reshape(bands, height // ratio, ratio,
+                           width // ratio, ratio)
+    return blocks.transpose(0, 1, 3, 2, 4).reshape(
+        bands, height // ratio, width // ratio, ratio * ratio)
+
+
+def _pad(array, ratio, value):
+    bands, height, width = array.shape
+    pad_h = -height % ratio
+    pad_w = -width % ratio
+    if not pad_h and not pad_w:
+        return array
+    return np.pad(array, ((0, 0), (0, pad_h), (0, pad_w)),
+                  mode='constant', constant_values=value)
+
+
+def valid_mask(array, no_data=None, alpha=None):
+    """Pixels taking part in the resampling, per band.
+
+    A pixel is invalid in a band when it holds the nodata value, and in
+    every band when the alpha band is 0. The alpha band itself is only
+    valid where it is not 0.
+    """
+    if no_data is None:
+        valid = np.ones(array.shape, dtype=bool)
+    elif np.isnan(no_data):
+        valid = ~np.isnan(array)
+    else:
+        valid = array != no_data
+    if alpha is not None:
+        opaque = array[alpha] > 0
+        valid &= opaque
+        valid[alpha] = opaque
+    return valid
+
+
+def reduce(array, valid, ratio, method, fill=0):
+    """Downsample ``array`` by ``ratio`` using only ``valid`` pixels.
+
+    Args:
+      array: ``(bands, h, w)`` array of the finer level.
+      valid: boolean array of the same shape, see valid_mask.
+      ratio: integer reduction factor.
+      method: one of METHODS.
+      fill: value of output pixels without any valid input pixel.
+
+    Returns:
+      A tuple ``(array, valid)`` of the coarser level.
+    """
+    array = _blocks(_pad(array, ratio, fill), ratio)
+    valid = _blocks(_pad(valid, ratio, False), ratio)
+    out_valid = valid.any(axis=-1)
+
+    if method == 'NEAREST':
+        # Centre pixel of every block like GDAL, the first valid pixel of
+        # the block when the centre is nodata or padding
+        centre = (ratio // 2) * ratio + ratio // 2
+        index = np.where(valid[..., centre], centre,
+                         np.argmax(valid, axis=-1))[..., np.newaxis]
+        out = np.take_along_axis(array, index, axis=-1)[..., 0]
+    elif method == 'AVERAGE':
+        total = np.where(valid, array, 0).sum(axis=-1, dtype=np.float64)
+        count = np.maximum(valid.sum(axis=-1), 1)
+        out = total / count
+        if array.dtype.kind in 'iu':
+            out = np.rint(out)
+        out = out.astype(array.dtype)
+    elif method == 'MODE':
+        # ratio**2 samples per block, so pairwise comparison is cheap
+        counts = ((array[..., :, np.newaxis] == array[..., np.newaxis, :]) &
+                  valid[..., np.newaxis, :]).sum(axis=-1)
+        counts = np.where(valid, counts, -1)
+        index = np.argmax(counts, axis=-1)[..., np.newaxis]
+        out = np.take_along_axis(array, index, axis=-1)[..., 0]
+    elif method in ('MIN', 'MAX'):
+        if array.dtype.kind == 'f':
+            info = np.finfo(array.dtype)
+        else:
+            info = np.iinfo(array.dtype)
+        if method == 'MIN':
+            out = np.where(valid, array, info.max).min(axis=-1)
+        else:
+            out = np.where(valid, array, info.min).max(axis=-1)
+    else:
+        raise OverviewException('Unsupported resampling %s' % method)
+
+    out[~out_valid] = fill
+    return out, out_valid
+
+
+def overview_bands(ds, factor):
+    """Overview bands of ``ds`` matching ``factor``, one per band."""
+    width = (ds.RasterXSize + factor - 1) // factor
+    height = (ds.RasterYSize + factor - 1) // factor
+    bands = []
+    for i in range(ds.RasterCount):
+        band = ds.GetRasterBand(i + 1)
+        for j in range(band.GetOverviewCount()):
+            overview = band.GetOverview(j)
+            if overview.XSize == width and overview.YSize == height:
+                bands.append(overview)
+                break
+        else:
+            raise OverviewException('No overview of factor %d' % factor)
+    return bands
+
+
+def alpha_index(ds):
+    """Index of the alpha band of ``ds``, or None."""
+    if ds.RasterCount < 2:
+        return None
+    last = ds.GetRasterBand(ds.RasterCount)
+    if last.GetColorInterpretation() == gdal.GCI_AlphaBand:
+        return ds.RasterCount - 1
+    return None
+
+
+def plan_strips(width, bands, itemsize, ratio, method, blocksize, workers,
+                memory_mb=default_config.OVERVIEW_MEMORY_MB):
+    """Output rows per strip and strips in flight fitting ``memory_mb``.
+
+    A source pixel costs its value, the padded and regrouped copies made by
+    reduce and its validity, plus the pairwise comparisons of MODE. Strips
+    are ``blocksize`` rows when two of them fit the budget, otherwise as
+    tall as the budget allows. Up to ``workers`` strips are resampled while
+    the next one is read, fewer when the budget is tight.
+
+    Args:
+      width: pixels per row of the finer level.
+
+    Returns:
+      A tuple ``(rows, in_flight)``.
+    """
+    pixel = 4 * itemsize + 2
+    if method == 'MODE':
+        pixel += ratio * ratio + 8
+    # One output row is ``ratio`` rows of the finer level
+    row_bytes = width * ratio * bands * pixel
+    budget = memory_mb * 1024 * 1024
+    rows = blocksize
+    if 2 * rows * row_bytes > budget:
+        rows = max(1, budget // (2 * row_bytes))
+    in_flight = max(1, min(workers, budget // (rows * row_bytes) - 1))
+    return rows, in_flight
+
+
+def _read(bands, yoff, ysize):
+    return np.stack([band.ReadAsArray(0, yoff, band.XSize, ysize)
+                     for band in bands])
+
+
+def _reduce_strip(array, no_data, alpha, ratio, method, fill):
+    out, out_valid = reduce(array, valid_mask(array, no_data, alpha),
+                            ratio, method, fill)
+    if alpha is not None:
+        out[alpha][~out_valid[alpha]] = 0
+    return out
+
+
+def build_overviews(ds, factors, resampling=default_config.RESAMPLING,
+                    workers=default_config.WORKERS,
+                    blocksize=default_config.BLOCKSIZE,
+                    memory_mb=default_config.OVERVIEW_MEMORY_MB):
+    """Build overviews of ``ds``, each level from the previous one.
+
+    Empty overviews are created by GDAL, then filled level by level in
+    strips of up to ``blocksize`` output rows. Strips are read and written
+    by this thread while a thread pool resamples them with NumPy, so every
+    level except the first is computed from the level just written and
+    the pyramid costs about 1.33x the base size of reads. The strips held
+    at once fit ``memory_mb``, see plan_strips.
+
+    NEAREST takes the centre pixel of each block like GDAL. As levels are
+    cascaded, levels after the first may pick a pixel one source pixel away
+    from the one GDAL picks from the base.
+
+    Resampling methods outside METHODS are handed to GDAL BuildOverviews.
+    ``ds`` is flushed before returning, so other processes opening it by
+    path see the overviews.
+
+    Returns:
+      The number of bytes read from ``ds`` and its overviews.
+    """
+    method = resampling.upper()
+    pixels = ds.RasterXSize * ds.RasterYSize * ds.RasterCount
+    if method not in METHODS:
+        ds.BuildOverviews(resampling, factors,
+                          callback=instrument.progress('overview', pixels))
+        ds.FlushCache()
+        return None
+
+    ratios = [factors[0]] + [b // a for a, b in zip(factors, factors[1:])]
+    if any(r < 2 for r in ratios) or \
+            any(b % a for a, b in zip(factors, factors[1:])):
+        raise OverviewException('Overview factors %s are not successive '
+                                'multiples' % factors)
+
+    ds.BuildOverviews('NONE', factors)
+    no_data = ds.GetRasterBand(1).GetNoDataValue()
+    alpha = alpha_index(ds)
+    fill = no_data if no_data is not None else 0
+    workers = workers or os.cpu_count() or 1
+    itemsize = gdal.GetDataTypeSize(ds.GetRasterBand(1).DataType) // 8
+    bytes_read = 0
+
+    source = [ds.GetRasterBand(i + 1) for i in range(ds.RasterCount)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for factor, ratio in zip(factors, ratios):
+            target = overview_bands(ds, factor)
+            height = target[0].YSize
+            strip, in_flight = plan_strips(source[0].XSize, len(source),
+                                           itemsize, ratio, method,
+                                           blocksize, workers, memory_mb)
+            pending = collections.deque()
+
+            for y in range(0, height, strip):
+                rows = min(strip, height - y)
+                yoff = y * ratio
+                ysize = min(rows * ratio, source[0].YSize - yoff)
+                array = _read(source, yoff, ysize)
+                bytes_read += array.nbytes
+                pending.append((y, executor.submit(
+                    _reduce_strip, array, no_data, alpha, ratio, method,
+                    fill)))
+
+                # Bound the strips held in memory
+                while len(pending) > in_flight or \
+                        (pending and y + rows >= height):
+                    y_done, future = pending.popleft()
+                    out = future.result()
+                    for band, plane in zip(target, out):
+                        band.WriteArray(plane, 0, y_done)
+
+            for band in target:
+                band.FlushCache()
+            source = target
+            print('Completed: Overview level %d' % factor)
+
+    ds.FlushCache()
+    return bytes_read
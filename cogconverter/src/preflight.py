@@ -0,0 +1,259 @@
+from osgeo import gdal
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from cogconverter import validator
+from cogconverter.config import default_config
+from cogconverter.src import layout
+from cogconverter.src import narrow
+from cogconverter.src import sink
+from cogconverter.src import stats
+from cogconverter.src import warp
+
+
+# Bytes hashed at the start and at the end of a file for its fingerprint
+FINGERPRINT_CHUNK = 1024 * 1024
+
+ACTIONS = ('report', 'link', 'copy')
+
+
+class PreflightException(Exception):
+    pass
+
+
+def fingerprint(path, chunk=FINGERPRINT_CHUNK):
+    """Content fingerprint of a file from its size, head and tail.
+
+    The head holds the TIFF header and IFDs, the tail the last tiles
+    written, so any re-encoding changes the fingerprint while a 100 GB
+    file still only costs two reads.
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha1(str(size).encode('utf-8'))
+    with open(path, 'rb') as f:
+        digest.update(f.read(chunk))
+        if size > chunk:
+            f.seek(max(chunk, size - chunk))
+            digest.update(f.read(chunk))
+    return digest.hexdigest()
+
+
+def codec_of(ds):
+    compression = ds.GetMetadata('IMAGE_STRUCTURE').get('COMPRESSION',
+                                                        'NONE')
+    if compression.upper() == 'YCbCr JPEG'.upper():
+        compression = 'JPEG'
+    return compression.upper()
+
+
+class Preflight(object):
+    """Whether a file already is a COG with the requested settings."""
+
+    def __init__(self, path, compliant, reasons, key, cached=False):
+        self.path = path
+        self.compliant = compliant
+        self.reasons = reasons
+        self.key = key
+        self.cached = cached
+
+    def as_dict(self):
+        return {'compliant': self.compliant, 'reasons': self.reasons}
+
+    def __str__(self):
+        if self.compliant:
+            return 'Preflight: already compliant%s' % (
+                ' (cached)' if self.cached else '')
+        return 'Preflight: conversion needed (%s)' % '; '.join(self.reasons)
+
+
+def inspect(path, dst_srs=default_config.EPSG_CRS, compression=None,
+            blocksize=None, sparse=default_config.SPARSE,
+            narrowing=default_config.NARROW,
+            statistics=default_config.STATISTICS):
+    """Compare a file with the conversion it would get.
+
+    Args:
+      path: Input file.
+      dst_srs: Target SRS of the conversion.
+      compression: Requested codec, None or 'auto' accept any codec.
+      blocksize: Requested tile size, None for the planned one.
+      sparse: False when sparse tiles must be written out.
+      narrowing: True to require the narrowest lossless dtype, this scans
+        the values once.
+      statistics: True to require stored band statistics.
+
+    Returns:
+      A list of reasons why the file has to be converted, empty when it is
+      already compliant.
+    """
+    reasons = []
+    try:
+        _, errors, details = validator.validate(path, backend='header')
+    except validator.ValidateCloudOptimizedGeoTIFFException as e:
+        return ['not a cloud optimized GeoTIFF: %s' % e]
+    reasons += errors
+
+    warp_plan = warp.plan(path, dst_srs)
+    if warp_plan.action != 'direct':
+        reasons.append(warp_plan.reason)
+
+    ds = gdal.Open(path)
+    codec = codec_of(ds)
+    plan = layout.plan_dataset(ds, compression or codec, blocksize)
+
+    wanted = layout.codec_name(compression) if compression else None
+    if wanted not in (None, 'AUTO') and wanted != codec:
+        reasons.append('codec is %s instead of %s' % (codec, wanted))
+
+    band = ds.GetRasterBand(1)
+    block = band.GetBlockSize()
+    if block != [plan.blocksize, plan.blocksize]:
+        reasons.append('blocks are %dx%d instead of %dx%d' % (
+            block[0], block[1], plan.blocksize, plan.blocksize))
+
+    interleave = ds.GetMetadata('IMAGE_STRUCTURE').get('INTERLEAVE', 'PIXEL')
+    if ds.RasterCount > 1 and interleave.upper() != plan.interleave:
+        reasons.append('interleave is %s instead of %s' %
+                       (interleave, plan.interleave))
+
+    sizes = [[band.GetOverview(i).XSize, band.GetOverview(i).YSize]
+             for i in range(band.GetOverviewCount())]
+    planned = [level['size'] for level in plan.as_dict()['levels'][1:]]
+    if sizes != planned:
+        reasons.append('overview levels %s instead of %s' %
+                       (len(sizes), len(planned)))
+
+    if not sparse and sum(details.get('sparse_tiles', {}).values()):
+        reasons.append('has sparse tiles')
+    if statistics and stats.read(ds) is None:
+        reasons.append('no band statistics')
+    if narrowing and not reasons:
+        # Only worth a full scan when nothing else needs a conversion
+        narrowed = narrow.plan(ds)
+        if narrowed.changed:
+            reasons.append('values fit %s' % narrowed.target)
+    ds = None
+    return reasons
+
+
+class PreflightCache(object):
+    """JSON file of preflight results by fingerprint and settings.
+
+    At most ``max_entries`` results are kept, the least recently used are
+    evicted first. Every put merges with the file on disk, so concurrent
+    jobs do not drop each other's results.
+    """
+
+    def __init__(self, path=default_config.PREFLIGHT_CACHE,
+                 max_entries=default_config.PREFLIGHT_CACHE_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except ValueError:
+            # A corrupt cache is only a lost optimization
+            return {}
+
+    def get(self, key):
+        result = self.entries.pop(key, None)
+        if result is not None:
+            self.entries[key] = result
+        return result
+
+    def put(self, key, result):
+        if self.path:
+            # Results only other jobs know about count as older than ours
+            entries = dict((k, v) for k, v in self.load().items()
+                           if k not in self.entries)
+            entries.update(self.entries)
+            self.entries = entries
+        self.entries.pop(key, None)
+        self.entries[key] = result
+        while len(self.entries) > self.max_entries:
+            del self.entries[next(iter(self.entries))]
+        if not self.path:
+            return
+        folder = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        # Write aside and rename so concurrent jobs never read half a file
+        fd, path_tmp = tempfile.mkstemp(dir=folder)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(path_tmp, self.path)
+        except Exception:
+            os.remove(path_tmp)
+            raise
+
+
+def check(path, dst_srs=default_config.EPSG_CRS, compression=None,
+          blocksize=None, cache=None, sparse=default_config.SPARSE,
+          narrowing=default_config.NARROW,
+          statistics=default_config.STATISTICS):
+    """Preflight ``path``, reusing a cached result for the same content.
+
+    The cache key holds the content fingerprint, every setting and the
+    nodata value, which a sidecar file can change without touching the
+    content.
+
+    Returns:
+      A Preflight.
+    """
+    ds = gdal.Open(path)
+    if ds is None:
+        raise PreflightException('Input file %s cannot be loaded' % path)
+    no_data = ds.GetRasterBand(1).GetNoDataValue()
+    ds = None
+    settings = json.dumps([dst_srs, compression, blocksize, no_data, sparse,
+                           narrowing, statistics])
+    key = '%s:%s' % (fingerprint(path), settings)
+    if cache is not None:
+        result = cache.get(key)
+        if result is not None:
+            return Preflight(path, result['compliant'], result['reasons'],
+                             key, cached=True)
+
+    reasons = inspect(path, dst_srs, compression, blocksize, sparse,
+                      narrowing, statistics)
+    result = Preflight(path, not reasons, reasons, key)
+    if cache is not None:
+        cache.put(key, result.as_dict())
+    return result
+
+
+def deliver(path_input, path_output, action='link'):
+    """Provide a compliant input as the output without converting it.
+
+    'link' hard-links and falls back to a copy across file systems, 'copy'
+    copies and 'report' leaves the output alone. Remote outputs are always
+    uploaded.
+    """
+    if action not in ACTIONS:
+        raise PreflightException('Unknown action %s, use one of %s' %
+                                 (action, ', '.join(ACTIONS)))
+    if action == 'report' or path_output is None:
+        return None
+    if sink.is_remote(path_output):
+        return sink.copy_file(path_input, path_output)
+    if os.path.abspath(path_input) == os.path.abspath(path_output):
+        return path_output
+    if os.path.exists(path_output):
+        os.remove(path_output)
+    if action == 'link':
+        try:
+            os.link(path_input, path_output)
+            return path_output
+        except OSError:
+            pass
+    shutil.copy2(path_input, path_output)
+    return path_output
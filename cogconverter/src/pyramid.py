@@ -1,6 +1,8 @@
 import gdal
 import osgeo
 from cogconverter.config import default_config
+from cogconverter.src import layout
+from cogconverter.src import overview
 
 
 # Creating pyramids/overviews
@@ -18,9 +20,13 @@ class pyramid(object):
 
         # 0 = read-only, 1 = read-write
         overviews = self.dataset.GetRasterBand(1).GetOverviewCount()
-        if overviews == 0:
+        plan = layout.plan_dataset(self.dataset)
+        if not plan.factors:
+            print('Raster fits in one tile. Thus skipping overviews!')
+        elif overviews == 0:
             gdal.SetConfigOption('COMPRESS_OVERVIEW', default_config.COMPRESS)
-            self.dataset.BuildOverviews(default_config.RESAMPLING, [2, 4, 8, 16, 32, 64])
+            overview.build_overviews(self.dataset, plan.factors,
+                                     default_config.RESAMPLING)
             print('Completed: Generating overviews')
         else:
             print('Overviews already generated. Thus skipping!')
@@ -0,0 +1,176 @@
+from osgeo import gdal
+import os
+import shutil
+import tempfile
+import uuid
+
+from cogconverter.config import default_config
+from cogconverter.src import copier
+
+
+class ScratchException(Exception):
+    pass
+
+
+def estimate_size(ds):
+    """Uncompressed size in bytes of ``ds``, an upper bound for the scratch."""
+    band = ds.GetRasterBand(1)
+    itemsize = gdal.GetDataTypeSize(band.DataType) // 8
+    return ds.RasterXSize * ds.RasterYSize * ds.RasterCount * itemsize
+
+
+def needs_scratch(ds):
+    """Only lazy datasets (VRT, warped VRT) recompute pixels on every read."""
+    return ds.GetDriver().ShortName == 'VRT'
+
+
+class ScratchRaster(object):
+    """Materialize a lazy dataset once into a tiled scratch GTiff.
+
+    Warped VRTs reproject and resample on every read, so building overviews
+    and then encoding the COG would warp every pixel at least twice. The
+    scratch copy is written once and read by every later stage. It is kept
+    in /vsimem when it fits the memory budget and a single process reads
+    it, otherwise on disk within the disk budget, and is removed when the
+    context exits. Pool ``workers`` reopen it by path and cannot see the
+    /vsimem files of this process. ``blocksize`` should be the planned COG
+    tile size, so tile reads line up with the scratch blocks.
+
+    Usage:
+        with ScratchRaster(ds) as scratch_ds:
+            convert2blocksize(scratch_ds, path_output)
+    """
+
+    def __init__(self, ds, folder=default_config.SCRATCH_DIR,
+                 memory_mb=default_config.SCRATCH_MEMORY_MB,
+                 disk_mb=default_config.SCRATCH_DISK_MB,
+                 compression=default_config.SCRATCH_COMPRESS,
+                 blocksize=default_config.BLOCKSIZE, workers=1):
+        self.ds = ds
+        self.folder = folder or tempfile.gettempdir()
+        self.memory_mb = memory_mb
+        self.disk_mb = disk_mb
+        self.compression = compression
+        self.blocksize = blocksize
+        self.workers = workers or os.cpu_count() or 1
+        self.path = None
+        self.dataset = None
+
+    def choose_path(self):
+        """Pick /vsimem or disk according to the budgets."""
+        name = 'cogconverter_scratch_%s.tif' % uuid.uuid4().hex
+        size_mb = estimate_size(self.ds) / 1024.0 / 1024.0
+
+        if self.memory_mb and size_mb <= self.memory_mb and \
+                self.workers == 1:
+            return '/vsimem/' + name
+
+        free_mb = shutil.disk_usage(self.folder).free / 1024.0 / 1024.0
+        limit_mb = min(free_mb, self.disk_mb) if self.disk_mb else free_mb
+        if size_mb > limit_mb:
+            return None
+        return os.path.join(self.folder, name)
+
+    def materialize(self):
+        if not needs_scratch(self.ds):
+            self.dataset = self.ds
+            return self.dataset
+
+        self.path = self.choose_path()
+        if self.path is None:
+            print('Scratch raster does not fit the budget. '
+                  'Reading the source lazily')
+            self.dataset = self.ds
+            return self.dataset
+
+        print('Processing: Materializing source into %s' % self.path)
+        options = ['TILED=YES',
+                   'BLOCKXSIZE=%d' % self.blocksize,
+                   'BLOCKYSIZE=%d' % self.blocksize,
+                   'COMPRESS=%s' % self.compression,
+                   'BIGTIFF=IF_SAFER',
+                   'NUM_THREADS=ALL_CPUS']
+        # The warp of the next strips overlaps the write of the previous
+        try:
+            result = copier.create_like(self.ds, self.path, options)
+            copier.BlockCopier(self.ds, result, stage='warp').run()
+            result.FlushCache()
+        except Exception as e:
+            result = None
+            self.cleanup()
+            raise ScratchException('Unable to write scratch raster %s : %s'
+                                   % (self.path, e))
+        result = None
+
+        # Reopen in update mode so overviews are built inside the scratch
+        self.dataset = gdal.Open(self.path, gdal.GA_Update)
+        print('Success: Source materialized')
+        return self.dataset
+
+    def cleanup(self):
+        self.dataset = None
+        if self.path is None:
+            return
+
+        for path in (self.path, self.path + '.ovr', self.path + '.aux.xml'):
+            if path.startswith('/vsimem/'):
+                gdal.Unlink(path)
+            elif os.path.exists(path):
+                os.remove(path)
+        self.path = None
+
+    def __enter__(self):
+        return self.materialize()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+        return False
+
+
+class VrtWrapper(object):
+    """VRT over a dataset we do not own, in a temporary folder.
+
+    Overviews built on a read-only GTiff are written next to it as an
+    ``.ovr`` file. Built on the wrapper they end up in the temporary folder
+    instead, which is removed when the context exits. With ``wrap`` False
+    the dataset is used as is, for scratch copies we own.
+
+    Usage:
+        with VrtWrapper(ds) as wrapped_ds:
+            wrapped_ds.BuildOverviews('NEAREST', [2, 4])
+    """
+
+    def __init__(self, ds, folder=default_config.SCRATCH_DIR, wrap=True):
+        self.ds = ds
+        self.folder = folder
+        self.wrap = wrap
+        self.path = None
+        self.dataset = None
+
+    def open(self):
+        if not self.wrap:
+            self.dataset = self.ds
+            return self.dataset
+
+        self.path = tempfile.mkdtemp(prefix='cogconverter_', dir=self.folder)
+        self.dataset = gdal.Translate(os.path.join(self.path, 'source.vrt'),
+                                      self.ds, format='VRT')
+        if self.dataset is None:
+            self.cleanup()
+            raise ScratchException('Unable to wrap %s in a VRT' %
+                                   self.ds.GetDescription())
+        return self.dataset
+
+    def cleanup(self):
+        self.dataset = None
+        if self.path is None:
+            return
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.path = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+        return False
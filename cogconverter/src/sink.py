@@ -0,0 +1,231 @@
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cogconverter.config import default_config
+from cogconverter.src import instrument
+
+try:
+    import boto3
+except ImportError:
+    # Only needed to write to object storage, pip install cogconverter[s3]
+    boto3 = None
+
+
+# S3 refuses multipart parts smaller than this, except the last one
+S3_MIN_PART = 5 * 1024 * 1024
+
+# S3 refuses multipart uploads of more parts than this
+S3_MAX_PARTS = 10000
+
+# Bytes read at once by copy_file
+COPY_CHUNK = 8 * 1024 * 1024
+
+
+class SinkException(Exception):
+    pass
+
+
+def is_remote(path):
+    return path.startswith('s3://')
+
+
+def parse_s3(url):
+    """Bucket and key of a ``s3://bucket/key`` url."""
+    bucket, _, key = url[len('s3://'):].partition('/')
+    if not bucket or not key:
+        raise SinkException('Expected s3://bucket/key, got %s' % url)
+    return bucket, key
+
+
+def s3_client(endpoint_url=default_config.S3_ENDPOINT_URL):
+    if boto3 is None:
+        raise SinkException('boto3 is needed to write to s3://, install it '
+                            'with pip install boto3')
+    return boto3.client('s3', endpoint_url=endpoint_url)
+
+
+def s3_fetch(url, client=None):
+    """``fetch(offset, size)`` reading ranges of an S3 object, to use with
+    tiff.RangeReader."""
+    client = client or s3_client()
+    bucket, key = parse_s3(url)
+
+    def fetch(offset, size):
+        response = client.get_object(
+            Bucket=bucket, Key=key,
+            Range='bytes=%d-%d' % (offset, offset + size - 1))
+        return response['Body'].read()
+    return fetch
+
+
+class Sink(object):
+    """Destination of the output bytes, written front to back.
+
+    Leaving the context completes the output, or aborts it if an error was
+    raised, so no partial output is left behind.
+
+    Usage:
+        with open_sink(path) as out:
+            out.write(data)
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+            return False
+        try:
+            self.close()
+        except Exception:
+            self.abort()
+            raise
+        return False
+
+
+class LocalSink(Sink):
+    """Write the output to a local file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.bytes_written += len(data)
+
+    def close(self):
+        self.file.close()
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class S3Sink(Sink):
+    """Stream the output to S3 compatible storage with a multipart upload.
+
+    Written bytes are cut into parts of ``part_mb`` that are uploaded by
+    ``workers`` threads while the next parts are being written. At most
+    ``workers`` parts are in flight and one is being filled, so memory is
+    bounded by ``(workers + 1) * part_mb`` whatever the output size. When
+    the output size is known, ``expected_size`` raises the part size so the
+    upload fits in S3_MAX_PARTS parts. A part that fails is retried
+    ``retries`` times before the upload is aborted. Outputs smaller than one
+    part are sent with a single PutObject.
+    """
+
+    def __init__(self, url, part_mb=default_config.S3_PART_MB,
+                 workers=default_config.S3_UPLOAD_WORKERS,
+                 retries=default_config.S3_RETRIES, client=None,
+                 expected_size=None):
+        self.path = url
+        self.bucket, self.key = parse_s3(url)
+        self.part_size = max(part_mb * 1024 * 1024, S3_MIN_PART,
+                             int(math.ceil((expected_size or 0) /
+                                           float(S3_MAX_PARTS))))
+        self.retries = retries
+        self.client = client or s3_client()
+        self.bytes_written = 0
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.futures = []
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # Parts uploading, write blocks when all workers are busy
+        self.slots = threading.BoundedSemaphore(workers)
+        self.start = time.time()
+
+    def write(self, data):
+        self.buffer += data
+        self.bytes_written += len(data)
+        while len(self.buffer) >= self.part_size:
+            part = bytes(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+            self.submit(part)
+
+    def submit(self, part):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key)['UploadId']
+        # Fail early instead of encoding the rest for nothing
+        for future in self.futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+        number = len(self.futures) + 1
+        if number > S3_MAX_PARTS:
+            raise SinkException('%s needs more than %d parts of %d bytes, '
+                                'give its expected size or a larger part '
+                                'size' % (self.path, S3_MAX_PARTS,
+                                          self.part_size))
+        self.slots.acquire()
+        self.futures.append(self.executor.submit(self.upload_part, number,
+                                                 part))
+
+    def upload_part(self, number, part):
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    response = self.client.upload_part(
+                        Bucket=self.bucket, Key=self.key, PartNumber=number,
+                        UploadId=self.upload_id, Body=part)
+                    return {'PartNumber': number, 'ETag': response['ETag']}
+                except Exception:
+                    if attempt == self.retries:
+                        raise
+                    time.sleep(2 ** attempt * 0.5)
+        finally:
+            self.slots.release()
+
+    def close(self):
+        with instrument.stage('upload', bytes_written=self.bytes_written) \
+                as fields:
+            if self.upload_id is None:
+                self.client.put_object(Bucket=self.bucket, Key=self.key,
+                                       Body=bytes(self.buffer))
+                fields['parts'] = 1
+            else:
+                if self.buffer:
+                    self.submit(bytes(self.buffer))
+                parts = [future.result() for future in self.futures]
+                self.client.complete_multipart_upload(
+                    Bucket=self.bucket, Key=self.key,
+                    UploadId=self.upload_id, MultipartUpload={'Parts': parts})
+                fields['parts'] = len(parts)
+            self.buffer = bytearray()
+            self.executor.shutdown()
+            # From the sink creation until the object is available
+            fields['available_after'] = round(time.time() - self.start, 3)
+        print('Success: Uploaded %s in %d parts' % (self.path,
+                                                    fields['parts']))
+
+    def abort(self):
+        self.executor.shutdown(wait=True)
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+
+
+def open_sink(path, **kwargs):
+    """S3Sink for ``s3://`` urls, LocalSink for local paths.
+
+    ``kwargs`` are passed to S3Sink only.
+    """
+    if is_remote(path):
+        return S3Sink(path, **kwargs)
+    return LocalSink(path)
+
+
+def copy_file(path_input, path_output):
+    """Copy a local file to a sink, in chunks."""
+    with open(path_input, 'rb') as f, open_sink(
+            path_output, expected_size=os.path.getsize(path_input)) as out:
+        for chunk in iter(lambda: f.read(COPY_CHUNK), b''):
+            out.write(chunk)
+    return path_output
@@ -0,0 +1,369 @@
+from osgeo import gdal
+import json
+import math
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import traceback
+
+from cogconverter.config import default_config
+from cogconverter.src import codec
+from cogconverter.src import instrument
+from cogconverter.src import metadata
+from cogconverter.src import narrow
+from cogconverter.src import warp
+
+
+class SplitException(Exception):
+    pass
+
+
+def shard_size(ds, blocksize, shard_px=None, shard_geo=None):
+    """Shard side in pixels, a multiple of ``blocksize``.
+
+    ``shard_geo`` is a side in SRS units (degrees for EPSG:4326) converted
+    with the pixel size, ``shard_px`` a side in pixels. Rounding up to the
+    tile size keeps the tiles of every shard on the tile grid of the whole
+    raster.
+    """
+    if shard_geo is not None:
+        gt = ds.GetGeoTransform()
+        shard_px = shard_geo / min(abs(gt[1]), abs(gt[5]))
+    if not shard_px:
+        raise SplitException('Give a shard size in pixels or SRS units')
+    return max(1, int(math.ceil(shard_px / float(blocksize)))) * blocksize
+
+
+def shards(width, height, size):
+    """Windows ``(column, row, xoff, yoff, xsize, ysize)`` of the grid."""
+    for row, yoff in enumerate(range(0, height, size)):
+        for column, xoff in enumerate(range(0, width, size)):
+            yield (column, row, xoff, yoff, min(size, width - xoff),
+                   min(size, height - yoff))
+
+
+class WorkQueue(object):
+    """Task queue in a folder, shared by any number of local processes.
+
+    Every task is a JSON file moving between the todo, doing, done and
+    failed subfolders. Claiming a task is an atomic rename, so workers never
+    run the same task twice, and a task can be retried on its own by moving
+    it back to todo. Workers touch the tasks they run every few seconds, so
+    only the tasks of crashed workers go stale. The folder outlives the
+    processes, a rerun picks up where the previous one stopped.
+    """
+
+    STATES = ('todo', 'doing', 'done', 'failed')
+
+    def __init__(self, folder):
+        self.folder = folder
+        for state in self.STATES:
+            path = os.path.join(folder, state)
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+    def path(self, state, name):
+        return os.path.join(self.folder, state, name)
+
+    def names(self, state):
+        # Dot files are being written, see write
+        return sorted(name for name in
+                      os.listdir(os.path.join(self.folder, state))
+                      if not name.startswith('.'))
+
+    def write(self, state, name, task):
+        """Write a task file atomically, readers never see it half done."""
+        path_tmp = self.path(state, '.' + name)
+        with open(path_tmp, 'w') as f:
+            json.dump(task, f)
+        os.replace(path_tmp, self.path(state, name))
+
+    def put(self, name, task):
+        """Add a task unless it is already known in any state."""
+        name = name + '.json'
+        if any(os.path.exists(self.path(state, name))
+               for state in self.STATES):
+            return False
+        self.write('todo', name, task)
+        return True
+
+    def claim(self):
+        """Move the next task to doing, return ``(name, task)`` or None."""
+        for name in self.names('todo'):
+            try:
+                os.rename(self.path('todo', name), self.path('doing', name))
+            except OSError:
+                # Another worker was faster
+                continue
+            self.touch(name)
+            with open(self.path('doing', name)) as f:
+                return name, json.load(f)
+        return None
+
+    def touch(self, name):
+        """Mark a task in doing as alive, see requeue."""
+        os.utime(self.path('doing', name), None)
+
+    def finish(self, name, task, error=None):
+        state = 'failed' if error else 'done'
+        if error:
+            task['error'] = error
+            task['attempts'] = task.get('attempts', 0) + 1
+        else:
+            task.pop('error', None)
+        self.write(state, name, task)
+        os.remove(self.path('doing', name))
+
+    def retry(self, max_attempts=default_config.SPLIT_RETRIES):
+        """Move failed tasks with attempts left back to todo, all of them
+        when ``max_attempts`` is None."""
+        moved = 0
+        for name in self.names('failed'):
+            with open(self.path('failed', name)) as f:
+                task = json.load(f)
+            if max_attempts is None or \
+                    task.get('attempts', 0) < max_attempts:
+                os.rename(self.path('failed', name), self.path('todo', name))
+                moved += 1
+        return moved
+
+    def requeue(self, older_than=default_config.SPLIT_STALE_SECONDS):
+        """Move tasks stuck in doing (crashed workers) back to todo.
+
+        Running tasks are touched every SPLIT_HEARTBEAT seconds, so a task
+        not touched for ``older_than`` seconds lost its worker.
+        """
+        moved = 0
+        for name in self.names('doing'):
+            path = self.path('doing', name)
+            try:
+                if time.time() - os.path.getmtime(path) <= older_than:
+                    continue
+                os.rename(path, self.path('todo', name))
+            except OSError:
+                # Finished or requeued meanwhile
+                continue
+            moved += 1
+        return moved
+
+    def tasks(self, state):
+        for name in self.names(state):
+            with open(self.path(state, name)) as f:
+                yield json.load(f)
+
+
+def convert_shard(task):
+    """Convert one shard window of the source into its own COG."""
+    # Imported here, converter imports this module for its CLI
+    from cogconverter import converter
+
+    source = gdal.Open(task['source'])
+    window = gdal.Translate('', source, format='VRT',
+                            srcWin=task['window'])
+    source = None
+    options = dict(task['options'])
+    if options.get('narrowing'):
+        options['narrowing'] = narrow.Narrowing.from_dict(
+            options['narrowing'])
+    path_tmp = task['path'] + '.tmp'
+    ds = converter.convert2blocksize(window, path_tmp, engine='parallel',
+                                     workers=1, **options)
+    ds = None
+    # Rename last, a shard output is either complete or missing
+    os.rename(path_tmp, task['path'])
+
+
+def _heartbeat(queue, name, stop,
+               interval=default_config.SPLIT_HEARTBEAT):
+    """Touch a running task until ``stop`` is set."""
+    while not stop.wait(interval):
+        try:
+            queue.touch(name)
+        except OSError:
+            return
+
+
+def run_worker(folder):
+    """Pull and convert shards from the queue until it is empty."""
+    queue = WorkQueue(folder)
+    worker = '%s-%d' % (socket.gethostname(), os.getpid())
+    while True:
+        claimed = queue.claim()
+        if claimed is None:
+            return
+        name, task = claimed
+        start = time.time()
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=_heartbeat,
+                                     args=(queue, name, stop))
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            convert_shard(task)
+        except Exception:
+            error = traceback.format_exc()
+        else:
+            error = None
+        finally:
+            stop.set()
+            heartbeat.join()
+        if error:
+            queue.finish(name, task, error=error)
+            instrument.emit({'event': 'shard', 'shard': task['id'],
+                             'worker': worker, 'status': 'failed'})
+            continue
+        queue.finish(name, task)
+        instrument.emit({'event': 'shard', 'shard': task['id'],
+                         'worker': worker, 'status': 'done',
+                         'seconds': round(time.time() - start, 3)})
+
+
+def shared_options(ds, options):
+    """Decide once for the whole source what every shard must share.
+
+    Codecs picked by 'auto' and dtypes narrowed per shard window would
+    differ between shards, and gdalbuildvrt skips the shards whose dtype
+    differs from the first one. The codec, the narrowing (with its nodata)
+    and the input compression are resolved on ``ds`` and stored in the
+    options as JSON values.
+    """
+    # Imported here, converter imports this module for its CLI
+    from cogconverter import converter
+
+    options = dict(options)
+    narrowing = None
+    if options.get('narrowing'):
+        print('Processing: Scanning value range')
+        narrowing = narrow.plan(ds)
+        print(narrowing)
+        if not narrowing.changed:
+            narrowing = None
+        options['narrowing'] = narrowing.as_dict() if narrowing else False
+
+    compression = options.get('compression')
+    if compression is None:
+        options['compression'] = converter.raster(ds).compression
+    elif isinstance(compression, str) and compression.upper() == 'AUTO':
+        print('Processing: Trial encoding sampled tiles')
+        options['compression'], _ = codec.select(
+            ds, policy=options.get('policy',
+                                   default_config.COMPRESS_POLICY),
+            blocksize=options['blocksize'], narrowing=narrowing)
+    return options
+
+
+def plan(path_input, folder_output, dst_srs=default_config.EPSG_CRS,
+         blocksize=default_config.BLOCKSIZE, shard_px=None, shard_geo=None,
+         options=None, folder_queue=None):
+    """Queue one task per shard of ``path_input``.
+
+    Inputs outside ``dst_srs`` are warped into a VRT next to the queue, so
+    each shard only warps its own window. Codec and narrowing are decided
+    once, see shared_options, and kept next to the queue for reruns.
+
+    Returns:
+      The WorkQueue.
+    """
+    folder_queue = folder_queue or os.path.join(folder_output, '.queue')
+    queue = WorkQueue(folder_queue)
+
+    source = os.path.abspath(path_input)
+    warp_plan = warp.plan(path_input, dst_srs)
+    print(warp_plan)
+    if warp_plan.action != 'direct':
+        source = os.path.join(os.path.abspath(folder_queue), 'source.vrt')
+        if not os.path.exists(source):
+            ds = warp.open_source(warp_plan, intermediate_format='VRT',
+                                  path_warped=source)
+            ds = None
+
+    ds = gdal.Open(source)
+    path_options = os.path.join(folder_queue, 'options.json')
+    if os.path.exists(path_options):
+        with open(path_options) as f:
+            options = json.load(f)
+    else:
+        options = shared_options(ds, dict(options or {},
+                                          blocksize=blocksize))
+        path_tmp = path_options + '.tmp'
+        with open(path_tmp, 'w') as f:
+            json.dump(options, f)
+        os.replace(path_tmp, path_options)
+    size = shard_size(ds, blocksize, shard_px, shard_geo)
+    name = os.path.splitext(os.path.basename(path_input))[0]
+    count = 0
+    for column, row, xoff, yoff, xsize, ysize in shards(
+            ds.RasterXSize, ds.RasterYSize, size):
+        shard_id = '%s_%03d_%03d' % (name, row, column)
+        task = {
+            'id': shard_id,
+            'source': source,
+            'window': [xoff, yoff, xsize, ysize],
+            'path': os.path.join(os.path.abspath(folder_output),
+                                 shard_id + '.tif'),
+            'options': options,
+        }
+        queue.put(shard_id, task)
+        count += 1
+    print('Split: %d shards of %d px' % (count, size))
+    return queue
+
+
+def run(queue, workers=default_config.WORKERS,
+        retries=default_config.SPLIT_RETRIES):
+    """Drain ``queue`` with ``workers`` processes, retrying failed shards.
+
+    Shards left in doing by a killed run, and shards failed in an earlier
+    run with attempts left, are queued again first. Shards claimed by
+    workers still running are left alone, so more workers can join at any
+    time with run_worker.
+
+    Returns:
+      The number of shards still failed.
+    """
+    workers = workers or os.cpu_count() or 1
+    queue.requeue()
+    queue.retry(retries)
+    for attempt in range(retries + 1):
+        processes = [multiprocessing.Process(target=run_worker,
+                                             args=(queue.folder,))
+                     for _ in range(workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        if not queue.retry(retries):
+            break
+        print('Split: retrying failed shards')
+    return len(queue.names('failed'))
+
+
+def manifest(queue, folder_output, name='manifest'):
+    """Write ``<name>.json`` and ``<name>.vrt`` listing the done shards."""
+    entries = []
+    for task in sorted(queue.tasks('done'), key=lambda t: t['id']):
+        ds = gdal.Open(task['path'])
+        gt = ds.GetGeoTransform()
+        entries.append({
+            'id': task['id'],
+            'path': os.path.relpath(task['path'], folder_output),
+            'window': task['window'],
+            'bbox': [gt[0], gt[3] + ds.RasterYSize * gt[5],
+                     gt[0] + ds.RasterXSize * gt[1], gt[3]],
+            'bbox_lonlat': metadata.bbox_lonlat(ds),
+        })
+        ds = None
+
+    path_json = os.path.join(folder_output, name + '.json')
+    with open(path_json, 'w') as f:
+        json.dump({'shards': entries,
+                   'failed': [t['id'] for t in queue.tasks('failed')]},
+                  f, indent=4, separators=(',', ': '))
+
+    path_vrt = os.path.join(folder_output, name + '.vrt')
+    vrt = gdal.BuildVRT(path_vrt, [os.path.join(folder_output, e['path'])
+                                   for e in entries])
+    vrt = None
+    return path_json, path_vrt
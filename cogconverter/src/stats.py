@@ -0,0 +1,172 @@
+from osgeo import gdal
+import json
+import numpy as np
+
+from cogconverter.config import default_config
+
+
+class Stats(object):
+    """Per-band statistics and fixed-bin histograms that can be merged.
+
+    Every tile adds its valid pixels with a few vectorized reductions, and
+    partial results of workers are combined with merge, so the statistics
+    come out of the copy without another pass over the data.
+    """
+
+    def __init__(self, ranges, bins=default_config.HISTOGRAM_BINS):
+        bands = len(ranges)
+        self.ranges = [tuple(r) for r in ranges]
+        self.bins = bins
+        self.count = np.zeros(bands, dtype=np.int64)
+        self.total = np.zeros(bands, dtype=np.float64)
+        self.total_sq = np.zeros(bands, dtype=np.float64)
+        self.minimum = np.full(bands, np.inf)
+        self.maximum = np.full(bands, -np.inf)
+        self.histogram = np.zeros((bands, bins), dtype=np.int64)
+
+    def add(self, array, valid):
+        """Add the ``valid`` pixels of a ``(bands, h, w)`` array."""
+        for b in range(array.shape[0]):
+            values = array[b][valid[b]]
+            if values.dtype.kind == 'f':
+                values = values[~np.isnan(values)]
+            if not values.size:
+                continue
+            values = values.astype(np.float64)
+            self.count[b] += values.size
+            self.total[b] += values.sum()
+            self.total_sq[b] += np.dot(values, values)
+            self.minimum[b] = min(self.minimum[b], values.min())
+            self.maximum[b] = max(self.maximum[b], values.max())
+
+            # Values outside the range are counted in the edge bins
+            low, high = self.ranges[b]
+            index = ((values - low) * (self.bins / (high - low))).astype(
+                np.int64)
+            np.clip(index, 0, self.bins - 1, out=index)
+            self.histogram[b] += np.bincount(index, minlength=self.bins)
+
+    def merge(self, other):
+        if other is None:
+            return self
+        self.count += other.count
+        self.total += other.total
+        self.total_sq += other.total_sq
+        np.minimum(self.minimum, other.minimum, out=self.minimum)
+        np.maximum(self.maximum, other.maximum, out=self.maximum)
+        self.histogram += other.histogram
+        return self
+
+    def state(self):
+        """JSON serializable state, see from_state."""
+        return {'ranges': self.ranges, 'bins': self.bins,
+                'count': self.count.tolist(), 'total': self.total.tolist(),
+                'total_sq': self.total_sq.tolist(),
+                'minimum': self.minimum.tolist(),
+                'maximum': self.maximum.tolist(),
+                'histogram': self.histogram.tolist()}
+
+    @classmethod
+    def from_state(cls, state):
+        stats = cls(state['ranges'], state['bins'])
+        stats.count[:] = state['count']
+        stats.total[:] = state['total']
+        stats.total_sq[:] = state['total_sq']
+        stats.minimum[:] = state['minimum']
+        stats.maximum[:] = state['maximum']
+        stats.histogram[:] = state['histogram']
+        return stats
+
+    def bands(self, pixels=None):
+        """Statistics of every band, None for bands without valid pixels.
+
+        ``pixels`` is the number of pixels of a band, to report the share
+        of valid ones.
+        """
+        result = []
+        for b in range(len(self.count)):
+            count = int(self.count[b])
+            if not count:
+                result.append(None)
+                continue
+            mean = self.total[b] / count
+            variance = max(0.0, self.total_sq[b] / count - mean * mean)
+            low, high = self.ranges[b]
+            band = {
+                'minimum': float(self.minimum[b]),
+                'maximum': float(self.maximum[b]),
+                'mean': float(mean),
+                'stddev': float(np.sqrt(variance)),
+                'valid_count': count,
+                'histogram': {'min': low, 'max': high, 'buckets': self.bins,
+                              'counts': self.histogram[b].tolist()},
+            }
+            if pixels:
+                band['valid_percent'] = round(100.0 * count / pixels, 3)
+            result.append(band)
+        return result
+
+
+def ranges(ds, bins=default_config.HISTOGRAM_BINS):
+    """Histogram range of every band of ``ds``, known before the copy.
+
+    Byte bands use one bin per value. Other bands use an approximate
+    min/max, which GDAL computes from overviews or a subsample.
+    """
+    result = []
+    for i in range(ds.RasterCount):
+        band = ds.GetRasterBand(i + 1)
+        if band.DataType == gdal.GDT_Byte and bins == 256:
+            result.append((-0.5, 255.5))
+            continue
+        try:
+            low, high = band.ComputeRasterMinMax(True)
+        except (RuntimeError, TypeError):
+            # Only nodata, any range will do
+            low, high = 0.0, 1.0
+        if band.DataType in (gdal.GDT_Float32, gdal.GDT_Float64):
+            result.append((low, high if high > low else low + 1.0))
+        else:
+            result.append((low - 0.5, high + 0.5))
+    return result
+
+
+def write(ds, stats, pixels=None):
+    """Store statistics as GDAL band metadata of ``ds``.
+
+    The usual STATISTICS_* items are set, so GDAL and tile servers pick
+    them up, and the histogram is stored as JSON in STATISTICS_HISTOGRAM.
+    """
+    for i, band_stats in enumerate(stats.bands(pixels)):
+        if band_stats is None:
+            continue
+        band = ds.GetRasterBand(i + 1)
+        band.SetMetadataItem('STATISTICS_MINIMUM',
+                             repr(band_stats['minimum']))
+        band.SetMetadataItem('STATISTICS_MAXIMUM',
+                             repr(band_stats['maximum']))
+        band.SetMetadataItem('STATISTICS_MEAN', repr(band_stats['mean']))
+        band.SetMetadataItem('STATISTICS_STDDEV', repr(band_stats['stddev']))
+        if 'valid_percent' in band_stats:
+            band.SetMetadataItem('STATISTICS_VALID_PERCENT',
+                                 repr(band_stats['valid_percent']))
+        band.SetMetadataItem('STATISTICS_HISTOGRAM',
+                             json.dumps(band_stats['histogram']))
+
+
+def read(ds):
+    """Statistics stored in the band metadata of ``ds``, or None."""
+    result = []
+    for i in range(ds.RasterCount):
+        metadata = ds.GetRasterBand(i + 1).GetMetadata()
+        if 'STATISTICS_MEAN' not in metadata:
+            return None
+        band = {}
+        for key in ('MINIMUM', 'MAXIMUM', 'MEAN', 'STDDEV',
+                    'VALID_PERCENT'):
+            if 'STATISTICS_' + key in metadata:
+                band[key.lower()] = float(metadata['STATISTICS_' + key])
+        if 'STATISTICS_HISTOGRAM' in metadata:
+            band['histogram'] = json.loads(metadata['STATISTICS_HISTOGRAM'])
+        result.append(band)
+    return result
@@ -0,0 +1,487 @@
+import mmap
+import struct
+
+
+# TIFF tags used while reading and assembling cloud optimized GeoTIFFs
+NEW_SUBFILE_TYPE = 254
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC = 262
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+PLANAR_CONFIG = 284
+PREDICTOR = 317
+TILE_WIDTH = 322
+TILE_LENGTH = 323
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+EXTRA_SAMPLES = 338
+SAMPLE_FORMAT = 339
+JPEG_TABLES = 347
+MODEL_PIXEL_SCALE = 33550
+MODEL_TIEPOINT = 33922
+MODEL_TRANSFORMATION = 34264
+GEO_KEY_DIRECTORY = 34735
+GEO_DOUBLE_PARAMS = 34736
+GEO_ASCII_PARAMS = 34737
+GDAL_METADATA = 42112
+GDAL_NODATA = 42113
+
+GEO_TAGS = (MODEL_PIXEL_SCALE, MODEL_TIEPOINT, MODEL_TRANSFORMATION,
+            GEO_KEY_DIRECTORY, GEO_DOUBLE_PARAMS, GEO_ASCII_PARAMS)
+
+# Field types
+BYTE = 1
+ASCII = 2
+SHORT = 3
+LONG = 4
+RATIONAL = 5
+SBYTE = 6
+UNDEFINED = 7
+SSHORT = 8
+SLONG = 9
+SRATIONAL = 10
+FLOAT = 11
+DOUBLE = 12
+IFD = 13
+LONG8 = 16
+SLONG8 = 17
+IFD8 = 18
+
+# Field type: (struct code, values per element, element size in bytes).
+# Byte-like types are kept as raw bytes.
+TYPES = {
+    BYTE: (None, 1, 1),
+    ASCII: (None, 1, 1),
+    SHORT: ('H', 1, 2),
+    LONG: ('I', 1, 4),
+    RATIONAL: ('I', 2, 8),
+    SBYTE: (None, 1, 1),
+    UNDEFINED: (None, 1, 1),
+    SSHORT: ('h', 1, 2),
+    SLONG: ('i', 1, 4),
+    SRATIONAL: ('i', 2, 8),
+    FLOAT: ('f', 1, 4),
+    DOUBLE: ('d', 1, 8),
+    IFD: ('I', 1, 4),
+    LONG8: ('Q', 1, 8),
+    SLONG8: ('q', 1, 8),
+    IFD8: ('Q', 1, 8),
+}
+
+BIGTIFF_HEADER_SIZE = 16
+
+
+class TiffException(Exception):
+    pass
+
+
+class Ifd(object):
+    """One image file directory.
+
+    ``tags`` maps a tag id to a ``(field type, values)`` tuple, where values
+    are raw bytes for byte-like types and a tuple of numbers otherwise.
+    """
+
+    def __init__(self, offset, tags, next_offset):
+        self.offset = offset
+        self.tags = tags
+        self.next_offset = next_offset
+
+    def get(self, tag, default=None):
+        if tag not in self.tags:
+            return default
+        return self.tags[tag][1]
+
+    def value(self, tag, default=None):
+        values = self.get(tag)
+        if values is None or len(values) == 0:
+            return default
+        return values[0]
+
+    @property
+    def width(self):
+        return self.value(IMAGE_WIDTH)
+
+    @property
+    def height(self):
+        return self.value(IMAGE_LENGTH)
+
+    @property
+    def is_tiled(self):
+        return TILE_WIDTH in self.tags
+
+    @property
+    def is_overview(self):
+        return bool(self.value(NEW_SUBFILE_TYPE, 0) & 1)
+
+    @property
+    def is_mask(self):
+        return bool(self.value(NEW_SUBFILE_TYPE, 0) & 4)
+
+    def block_offsets(self):
+        if self.is_tiled:
+            return self.get(TILE_OFFSETS, ())
+        return self.get(STRIP_OFFSETS, ())
+
+    def block_byte_counts(self):
+        if self.is_tiled:
+            return self.get(TILE_BYTE_COUNTS, ())
+        return self.get(STRIP_BYTE_COUNTS, ())
+
+
+def decode_values(field_type, count, data, endian):
+    code, per_element, _ = TYPES[field_type]
+    if code is None:
+        return bytes(data)
+    return struct.unpack('%s%d%s' % (endian, count * per_element, code), data)
+
+
+def encode_values(field_type, values, endian='<'):
+    code, per_element, _ = TYPES[field_type]
+    if code is None:
+        return bytes(values)
+    return struct.pack('%s%d%s' % (endian, len(values), code), *values)
+
+
+def value_count(field_type, values):
+    return len(values) // TYPES[field_type][1]
+
+
+def read_header(read):
+    """Parse the TIFF header.
+
+    Args:
+      read: Callable ``read(offset, size)`` returning bytes.
+
+    Returns:
+      A tuple ``(endian, bigtiff, first_ifd_offset)``.
+    """
+    head = read(0, BIGTIFF_HEADER_SIZE)
+    if len(head) < 8:
+        raise TiffException('File too small to be a TIFF')
+    if head[:2] == b'II':
+        endian = '<'
+    elif head[:2] == b'MM':
+        endian = '>'
+    else:
+        raise TiffException('Not a TIFF file')
+
+    version = struct.unpack(endian + 'H', head[2:4])[0]
+    if version == 42:
+        return endian, False, struct.unpack(endian + 'I', head[4:8])[0]
+    if version == 43:
+        if len(head) < BIGTIFF_HEADER_SIZE:
+            raise TiffException('Truncated BigTIFF header')
+        return endian, True, struct.unpack(endian + 'Q', head[8:16])[0]
+    raise TiffException('Unknown TIFF version %d' % version)
+
+
+def read_ifd(read, offset, endian, bigtiff):
+    """Parse the IFD located at ``offset``, including out-of-line values."""
+    if bigtiff:
+        count_code, count_size, entry_size, next_code = 'Q', 8, 20, 'Q'
+        inline_size = 8
+    else:
+        count_code, count_size, entry_size, next_code = 'H', 2, 12, 'I'
+        inline_size = 4
+
+    count = struct.unpack(endian + count_code, read(offset, count_size))[0]
+    raw = read(offset + count_size, count * entry_size + inline_size)
+    if len(raw) < count * entry_size + inline_size:
+        raise TiffException('Truncated IFD at offset %d' % offset)
+
+    tags = {}
+    for i in range(count):
+        entry = raw[i * entry_size:(i + 1) * entry_size]
+        if bigtiff:
+            tag, field_type, n = struct.unpack(endian + 'HHQ', entry[:12])
+        else:
+            tag, field_type, n = struct.unpack(endian + 'HHI', entry[:8])
+        field = entry[entry_size - inline_size:]
+
+        # Unknown field types cannot be sized, skip them
+        if field_type not in TYPES:
+            continue
+
+        size = n * TYPES[field_type][2]
+        if size <= inline_size:
+            data = field[:size]
+        else:
+            value_offset = struct.unpack(
+                endian + ('Q' if bigtiff else 'I'), field)[0]
+            data = read(value_offset, size)
+            if len(data) < size:
+                raise TiffException(
+                    'Truncated value of tag %d at offset %d' %
+                    (tag, value_offset))
+        tags[tag] = (field_type, decode_values(field_type, n, data, endian))
+
+    next_offset = struct.unpack(
+        endian + next_code, raw[count * entry_size:])[0]
+    return Ifd(offset, tags, next_offset)
+
+
+def read_ifds(read, max_ifds=1024):
+    """Parse the header and the full IFD chain of a TIFF file.
+
+    Returns:
+      A tuple ``(endian, bigtiff, ifds)``.
+    """
+    endian, bigtiff, offset = read_header(read)
+    ifds = []
+    seen = set()
+    while offset and len(ifds) < max_ifds:
+        if offset in seen:
+            raise TiffException('Loop in IFD chain at offset %d' % offset)
+        seen.add(offset)
+        ifd = read_ifd(read, offset, endian, bigtiff)
+        ifds.append(ifd)
+        offset = ifd.next_offset
+    return endian, bigtiff, ifds
+
+
+def bytes_reader(data):
+    """Wrap an in-memory buffer as a ``read(offset, size)`` callable."""
+    def read(offset, size):
+        return data[offset:offset + size]
+    return read
+
+
+class RangeReader(object):
+    """Byte range reader with a prefetch window and I/O accounting.
+
+    ``fetch(offset, size)`` performs the actual read, for example an HTTP
+    range request. Every fetch reads at least ``prefetch`` bytes so that
+    the header and the IFDs following it are served by a single request.
+    Instances are callable like the ``read`` functions above.
+    """
+
+    def __init__(self, fetch, prefetch=16384):
+        self.fetch = fetch
+        self.prefetch = prefetch
+        self.bytes_read = 0
+        self.requests = 0
+        self.window_offset = 0
+        self.window = b''
+
+    def read(self, offset, size):
+        start = offset - self.window_offset
+        if 0 <= start and start + size <= len(self.window):
+            return self.window[start:start + size]
+
+        data = self.fetch(offset, max(size, self.prefetch))
+        self.bytes_read += len(data)
+        self.requests += 1
+        self.window_offset = offset
+        self.window = data
+        return data[:size]
+
+    __call__ = read
+
+    def fetch_range(self, offset, size):
+        """Read exactly one range, bypassing the prefetch window.
+
+        Used for tile data, which is read once and would only evict the
+        header from the window.
+        """
+        data = self.fetch(offset, size)
+        self.bytes_read += len(data)
+        self.requests += 1
+        return data
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+class MmapReader(RangeReader):
+    """RangeReader over a local file mapped in memory."""
+
+    def __init__(self, path, prefetch=16384):
+        self.file = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped
+            self.map = b''
+        RangeReader.__init__(self, self._fetch, prefetch)
+
+    def _fetch(self, offset, size):
+        return self.map[offset:offset + size]
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.file.close()
+
+
+######################################################################
+# BigTIFF COG assembly
+
+def _align(offset, alignment=8):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def _ifd_size(tags):
+    """Size of a BigTIFF IFD including its out-of-line values."""
+    size = 8 + 20 * len(tags) + 8
+    for field_type, values in tags.values():
+        value_size = value_count(field_type, values) * TYPES[field_type][2]
+        if value_size > 8:
+            size = _align(size) + value_size
+    return _align(size)
+
+
+def _encode_ifd(tags, offset, next_offset):
+    entries = []
+    extra = b''
+    extra_start = offset + 8 + 20 * len(tags) + 8
+    for tag in sorted(tags):
+        field_type, values = tags[tag]
+        data = encode_values(field_type, values)
+        count = value_count(field_type, values)
+        if len(data) <= 8:
+            field = data.ljust(8, b'\0')
+        else:
+            position = extra_start + len(extra)
+            extra += b'\0' * (_align(position) - position)
+            field = struct.pack('<Q', extra_start + len(extra))
+            extra += data
+        entries.append(struct.pack('<HHQ', tag, field_type, count) + field)
+
+    block = (struct.pack('<Q', len(tags)) + b''.join(entries) +
+             struct.pack('<Q', next_offset) + extra)
+    return block.ljust(_ifd_size(tags), b'\0')
+
+
+def hilbert_index(x, y, order):
+    """Distance of cell ``(x, y)`` along a Hilbert curve over a square of
+    ``2 ** order`` cells per side."""
+    d = 0
+    s = 1 << (order - 1) if order else 0
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        d += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant so the curve stays continuous
+        if ry == 0:
+            if rx == 1:
+                x = s - 1 - x
+                y = s - 1 - y
+            x, y = y, x
+        s >>= 1
+    return d
+
+
+def hilbert_order(tiles_x, tiles_y, planes=1):
+    """Tile indices of a level sorted along a Hilbert curve.
+
+    Tiles next to each other on the grid mostly end up next to each other
+    in the file. The blocks of every plane of a band interleaved tile are
+    kept together.
+    """
+    order = max(tiles_x - 1, tiles_y - 1, 0).bit_length()
+    cells = sorted(range(tiles_x * tiles_y),
+                   key=lambda i: hilbert_index(i % tiles_x, i // tiles_x,
+                                               order))
+    count = tiles_x * tiles_y
+    return [plane * count + i for i in cells for plane in range(planes)]
+
+
+def data_order(tile_sizes, orders=None):
+    """Yield ``(level, index)`` in the order tile data is laid out.
+
+    Smallest overview first and full resolution last, so that a reader
+    fetching a low zoom level only touches the start of the file. Within a
+    level tiles follow ``orders[level]``, a list of tile indices, or the
+    index order when it is None.
+    """
+    for level in range(len(tile_sizes) - 1, -1, -1):
+        indices = orders[level] if orders is not None and \
+            orders[level] is not None else range(len(tile_sizes[level]))
+        for index in indices:
+            yield level, index
+
+
+def _offset_type(level_tags, tile_sizes):
+    """LONG offsets when the whole file stays below 4 GiB, else LONG8."""
+    position = BIGTIFF_HEADER_SIZE
+    for tags, sizes in zip(level_tags, tile_sizes):
+        tags = dict(tags)
+        tags[TILE_OFFSETS] = (LONG, (0,) * len(sizes))
+        tags[TILE_BYTE_COUNTS] = (LONG, tuple(sizes))
+        position += _ifd_size(tags)
+    end = position + sum(sum(sizes) for sizes in tile_sizes)
+    return LONG if end < 1 << 32 else LONG8
+
+
+def build_header(level_tags, tile_sizes, orders=None):
+    """Assemble the BigTIFF header and every IFD of a COG.
+
+    Every IFD and its tile offset and byte count arrays sit at the start of
+    the file, so one read of the header gives a client the location of
+    every tile. The arrays use 4 byte values when they can.
+
+    Args:
+      level_tags: List of tag dictionaries, full resolution first, without
+        tile offsets or byte counts.
+      tile_sizes: Per level list of encoded tile sizes, in tile index
+        order. A size of 0 marks a sparse (unwritten) tile.
+      orders: Optional per level tile order, see data_order.
+
+    Returns:
+      A tuple ``(header, offsets)``. ``header`` holds the TIFF header and
+      all IFDs, and tile data must be written right after it following
+      ``data_order``. ``offsets`` gives each tile's absolute offset.
+    """
+    if len(level_tags) != len(tile_sizes):
+        raise TiffException('One list of tile sizes is needed per level')
+
+    # Tile sizes are bounded by the tile, offsets by the file size
+    offset_type = _offset_type(level_tags, tile_sizes)
+    count_type = LONG if max([0] + [max(sizes or [0])
+                                    for sizes in tile_sizes]) < 1 << 32 \
+        else LONG8
+
+    levels = []
+    for tags, sizes in zip(level_tags, tile_sizes):
+        tags = dict(tags)
+        for tag in (STRIP_OFFSETS, STRIP_BYTE_COUNTS, ROWS_PER_STRIP):
+            tags.pop(tag, None)
+        tags[TILE_OFFSETS] = (offset_type, (0,) * len(sizes))
+        tags[TILE_BYTE_COUNTS] = (count_type, tuple(sizes))
+        levels.append(tags)
+
+    # IFDs go first, full resolution first, so their sizes fix the layout
+    ifd_offsets = []
+    position = BIGTIFF_HEADER_SIZE
+    for tags in levels:
+        ifd_offsets.append(position)
+        position += _ifd_size(tags)
+
+    offsets = [[0] * len(sizes) for sizes in tile_sizes]
+    for level, index in data_order(tile_sizes, orders):
+        size = tile_sizes[level][index]
+        if size:
+            offsets[level][index] = position
+            position += size
+
+    header = b'II' + struct.pack('<HHHQ', 43, 8, 0, ifd_offsets[0])
+    for i, tags in enumerate(levels):
+        tags[TILE_OFFSETS] = (offset_type, tuple(offsets[i]))
+        next_offset = ifd_offsets[i + 1] if i + 1 < len(levels) else 0
+        header += _encode_ifd(tags, ifd_offsets[i], next_offset)
+
+    return header, offsets
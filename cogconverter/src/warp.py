@@ -0,0 +1,105 @@
+from osgeo import gdal
+from osgeo import osr
+
+from cogconverter.config import default_config
+
+
+class WarpException(Exception):
+    pass
+
+
+def target_srs(dst_srs):
+    srs = osr.SpatialReference()
+    if srs.SetFromUserInput(dst_srs) != 0:
+        raise WarpException('Unknown target SRS %s' % dst_srs)
+    return srs
+
+
+def is_north_up(geotransform):
+    """True if pixels are axis aligned with no rotation or flipping."""
+    return (geotransform is not None and geotransform[2] == 0 and
+            geotransform[4] == 0 and geotransform[1] > 0 and
+            geotransform[5] < 0)
+
+
+class WarpPlan(object):
+    """Decision of how the source reaches the target SRS.
+
+    ``action`` is 'direct' when the source can be opened as is, or 'warp'
+    when it has to be reprojected. ``reason`` explains the decision for the
+    job logs.
+    """
+
+    def __init__(self, path_input, dst_srs, action, reason):
+        self.path_input = path_input
+        self.dst_srs = dst_srs
+        self.action = action
+        self.reason = reason
+
+    def __str__(self):
+        return 'Warp plan: %s (%s)' % (self.action, self.reason)
+
+
+def plan(path_input, dst_srs=default_config.EPSG_CRS):
+    """Compare the source SRS and geotransform with the target.
+
+    Returns:
+      A WarpPlan.
+    """
+    ds = gdal.Open(path_input)
+    if ds is None:
+        raise WarpException('Input file %s cannot be loaded' % path_input)
+
+    if ds.GetGCPCount() > 0 and not ds.GetProjection():
+        return WarpPlan(path_input, dst_srs, 'warp',
+                        'source is georeferenced by GCPs')
+
+    wkt = ds.GetProjection()
+    if not wkt:
+        return WarpPlan(path_input, dst_srs, 'warp',
+                        'source SRS is not defined')
+
+    source = osr.SpatialReference(wkt=wkt)
+    target = target_srs(dst_srs)
+    # Compare axes as stored, GDAL 3 would otherwise honour EPSG axis order
+    for srs in (source, target):
+        if hasattr(srs, 'SetAxisMappingStrategy'):
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    if not source.IsSame(target):
+        return WarpPlan(path_input, dst_srs, 'warp',
+                        'source SRS differs from %s' % dst_srs)
+
+    if not is_north_up(ds.GetGeoTransform(can_return_null=True)):
+        return WarpPlan(path_input, dst_srs, 'warp',
+                        'source geotransform is rotated or flipped')
+
+    return WarpPlan(path_input, dst_srs, 'direct',
+                    'source already in %s and north up' % dst_srs)
+
+
+def open_source(warp_plan, warp_memory_mb=default_config.WARP_MEMORY_MB,
+                threads=default_config.WARP_THREADS,
+                intermediate_format=default_config.INTERMEDIATE_FORMAT,
+                path_warped=''):
+    """Open the source according to ``warp_plan``.
+
+    For 'warp' a lazy warped dataset is returned whose warper processes
+    chunks of at most ``warp_memory_mb`` with ``threads`` threads (all CPUs
+    when None), so materializing it runs the warp chunked and in parallel.
+    ``path_warped`` saves the warped VRT to a file, by default it only
+    exists in memory.
+    """
+    if warp_plan.action == 'direct':
+        return gdal.Open(warp_plan.path_input)
+
+    options = gdal.WarpOptions(
+        format=intermediate_format,
+        dstSRS=warp_plan.dst_srs,
+        multithread=True,
+        warpMemoryLimit=warp_memory_mb * 1024 * 1024,
+        warpOptions=['NUM_THREADS=%s' % (threads or 'ALL_CPUS')])
+    ds = gdal.Warp(path_warped, warp_plan.path_input, options=options)
+    if ds is None:
+        raise WarpException('Unable to warp %s' % warp_plan.path_input)
+    return ds
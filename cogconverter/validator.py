@@ -5,21 +5,39 @@ import os
 import sys
 
 import osr
+import fnmatch
+import glob
 import json
+import struct
 import time
 import datetime
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+
+from cogconverter.config import default_config
+from cogconverter.src import tiff
+
+# Bytes fetched by the first read of the header backend
+HEADER_PREFETCH = default_config.HEADER_PREFETCH
+
+# File patterns picked up when a directory is given to the bulk mode
+BULK_PATTERNS = ('*.tif', '*.tiff', '*.TIF', '*.TIFF')
 
 
 class ValidateCloudOptimizedGeoTIFFException(Exception):
     pass
 
 
-def validate(ds, check_tiled=True):
+def validate(ds, check_tiled=True, backend='gdal', reader=None):
     """Check if a file is a (Geo)TIFF with cloud optimized compatible structure.
 
     Args:
-      ds: GDAL Dataset for the file to inspect.
+      ds: GDAL Dataset for the file to inspect, or its path.
       check_tiled: Set to False to ignore missing tiling.
+      backend: 'gdal' to inspect the file through GDAL, or 'header' to parse
+        the TIFF header and IFDs directly with byte range reads.
+      reader: Optional tiff.RangeReader used by the 'header' backend, for
+        files that are not on the local file system.
 
     Returns:
       A tuple, whose first element is an array of error messages
@@ -31,6 +49,13 @@ def validate(ds, check_tiled=True):
         file is not a Tiff.
     """
 
+    if backend == 'header':
+        if isinstance(ds, gdal.Dataset):
+            ds = ds.GetDescription()
+        return validate_header(ds, check_tiled=check_tiled, reader=reader)
+    if backend != 'gdal':
+        raise ValueError('Unknown validation backend %s' % backend)
+
     if int(gdal.VersionInfo('VERSION_NUM')) < 2020000:
         raise ValidateCloudOptimizedGeoTIFFException(
             'GDAL 2.2 or above required')
@@ -47,21 +72,159 @@ def validate(ds, check_tiled=True):
             raise ValidateCloudOptimizedGeoTIFFException(
                 'The file is not a GeoTIFF')
 
-    details = {}
-    errors = []
-    warnings = []
+    return check_layout(gdal_layout(ds), check_tiled)
+
+
+def gdal_layout(ds):
+    """Describe the structure of ``ds`` as read through GDAL."""
     filename = ds.GetDescription()
     main_band = ds.GetRasterBand(1)
-    ovr_count = main_band.GetOverviewCount()
     filelist = ds.GetFileList()
-    if filelist is not None and filename + '.ovr' in filelist:
+
+    def describe(band):
+        ifd_offset = int(band.GetMetadataItem('IFD_OFFSET', 'TIFF'))
+        block_offset = band.GetMetadataItem('BLOCK_OFFSET_0_0', 'TIFF')
+        sparse = not block_offset
+        if sparse:
+            block_offset = first_block_offset(band)
+        return {
+            'size': (band.XSize, band.YSize),
+            'block_size': tuple(band.GetBlockSize()),
+            'ifd_offset': ifd_offset,
+            'data_offset': int(block_offset) if block_offset else None,
+            'sparse': sparse,
+        }
+
+    return {
+        'external_ovr': (filelist is not None and
+                         filename + '.ovr' in filelist),
+        'main': describe(main_band),
+        'overviews': [describe(main_band.GetOverview(i))
+                      for i in range(main_band.GetOverviewCount())],
+    }
+
+
+def first_block_offset(band):
+    """Offset of the first block written to disk, skipping sparse blocks."""
+    block_x, block_y = band.GetBlockSize()
+    blocks_x = (band.XSize + block_x - 1) // block_x
+    blocks_y = (band.YSize + block_y - 1) // block_y
+    for y in range(blocks_y):
+        for x in range(blocks_x):
+            offset = band.GetMetadataItem('BLOCK_OFFSET_%d_%d' % (x, y),
+                                          'TIFF')
+            if offset:
+                return offset
+    return None
+
+
+def header_layout(ifds):
+    """Describe the structure of a TIFF from its parsed IFD chain."""
+    images = [ifd for ifd in ifds if not ifd.is_mask]
+    if not images:
+        raise ValidateCloudOptimizedGeoTIFFException('The file has no image')
+
+    def describe(ifd):
+        if ifd.is_tiled:
+            block_size = (ifd.value(tiff.TILE_WIDTH),
+                          ifd.value(tiff.TILE_LENGTH))
+        else:
+            block_size = (ifd.width,
+                          ifd.value(tiff.ROWS_PER_STRIP, ifd.height))
+        offsets = list(ifd.block_offsets())
+        byte_counts = list(ifd.block_byte_counts())
+        # Sparse blocks have a zero offset and byte count
+        written = [offset for offset in offsets if offset]
+        return {
+            'size': (ifd.width, ifd.height),
+            'block_size': block_size,
+            'ifd_offset': ifd.offset,
+            'data_offset': written[0] if written else None,
+            'sparse': bool(offsets) and not offsets[0],
+            'sparse_tiles': sum(1 for offset, count in
+                                zip(offsets, byte_counts)
+                                if not offset and not count),
+            'offsets': offsets,
+            'byte_counts': byte_counts,
+        }
+
+    return {
+        'external_ovr': False,
+        'main': describe(images[0]),
+        'overviews': [describe(ifd) for ifd in images[1:]
+                      if ifd.is_overview],
+    }
+
+
+def validate_header(path, check_tiled=True, reader=None,
+                    prefetch=HEADER_PREFETCH):
+    """Validate a COG from its TIFF header and IFDs, without GDAL.
+
+    Only the header, the IFDs and their out-of-line values (tile offset and
+    byte count tables included) are read, through ``reader`` or a memory
+    map of ``path``. Returns the same ``(warnings, errors, details)`` as
+    ``validate``, with ``details`` also holding per-level ``tiles`` tables,
+    and the ``bytes_read`` and ``requests`` it took.
+    """
+    own_reader = reader is None
+    if own_reader:
+        try:
+            reader = tiff.MmapReader(path, prefetch=prefetch)
+        except (IOError, OSError) as e:
+            raise ValidateCloudOptimizedGeoTIFFException(
+                'Invalid file : %s' % e)
+
+    try:
+        _, _, ifds = tiff.read_ifds(reader)
+    except (tiff.TiffException, struct.error) as e:
+        raise ValidateCloudOptimizedGeoTIFFException(
+            'The file is not a GeoTIFF : %s' % e)
+    finally:
+        if own_reader:
+            reader.close()
+
+    layout = header_layout(ifds)
+    if isinstance(path, str):
+        layout['external_ovr'] = os.path.exists(path + '.ovr')
+
+    warnings, errors, details = check_layout(layout, check_tiled)
+    details['tiles'] = {'main': {
+        'offsets': layout['main']['offsets'],
+        'byte_counts': layout['main']['byte_counts']}}
+    for i, overview in enumerate(layout['overviews']):
+        details['tiles']['overview_%d' % i] = {
+            'offsets': overview['offsets'],
+            'byte_counts': overview['byte_counts']}
+    details['bytes_read'] = reader.bytes_read
+    details['requests'] = reader.requests
+    return warnings, errors, details
+
+
+def check_layout(layout, check_tiled=True):
+    """Run the cloud optimized checks on a layout description.
+
+    ``layout`` holds 'external_ovr' and, for the 'main' image and each of
+    the 'overviews', its 'size', 'block_size', 'ifd_offset' and
+    'data_offset' (offset of the first written block, None when missing).
+    'sparse' tells whether the first block is sparse (zero offset and byte
+    count, GDAL SPARSE_OK) and the optional 'sparse_tiles' counts them.
+    Sparse blocks are reported in ``details`` and skipped by the ordering
+    checks.
+    """
+    details = {}
+    errors = []
+    warnings = []
+    main = layout['main']
+    overviews = layout['overviews']
+    ovr_count = len(overviews)
+    if layout['external_ovr']:
         errors += [
             'Overviews found in external .ovr file. They should be internal']
 
-    if main_band.XSize >= 512 or main_band.YSize >= 512:
+    if main['size'][0] >= 512 or main['size'][1] >= 512:
         if check_tiled:
-            block_size = main_band.GetBlockSize()
-            if block_size[0] == main_band.XSize and block_size[0] > 1024:
+            block_size = main['block_size']
+            if block_size[0] == main['size'][0] and block_size[0] > 1024:
                 errors += [
                     'The file is greater than 512xH or Wx512, but is not tiled']
 
@@ -70,7 +233,7 @@ def validate(ds, check_tiled=True):
                 'The file is greater than 512xH or Wx512, it is recommended '
                 'to include internal overviews']
 
-    ifd_offset = int(main_band.GetMetadataItem('IFD_OFFSET', 'TIFF'))
+    ifd_offset = main['ifd_offset']
     ifd_offsets = [ifd_offset]
     if ifd_offset not in (8, 16):
         errors += [
@@ -79,31 +242,30 @@ def validate(ds, check_tiled=True):
     details['ifd_offsets'] = {}
     details['ifd_offsets']['main'] = ifd_offset
 
-    for i in range(ovr_count):
+    for i, ovr in enumerate(overviews):
         # Check that overviews are by descending sizes
-        ovr_band = ds.GetRasterBand(1).GetOverview(i)
         if i == 0:
-            if (ovr_band.XSize > main_band.XSize or
-                    ovr_band.YSize > main_band.YSize):
+            if (ovr['size'][0] > main['size'][0] or
+                    ovr['size'][1] > main['size'][1]):
                 errors += [
                     'First overview has larger dimension than main band']
         else:
-            prev_ovr_band = ds.GetRasterBand(1).GetOverview(i - 1)
-            if (ovr_band.XSize > prev_ovr_band.XSize or
-                    ovr_band.YSize > prev_ovr_band.YSize):
+            prev_ovr = overviews[i - 1]
+            if (ovr['size'][0] > prev_ovr['size'][0] or
+                    ovr['size'][1] > prev_ovr['size'][1]):
                 errors += [
                     'Overview of index %d has larger dimension than '
                     'overview of index %d' % (i, i - 1)]
 
         if check_tiled:
-            block_size = ovr_band.GetBlockSize()
-            if block_size[0] == ovr_band.XSize and block_size[0] > 1024:
+            block_size = ovr['block_size']
+            if block_size[0] == ovr['size'][0] and block_size[0] > 1024:
                 errors += [
                     'Overview of index %d is not tiled' % i]
 
         # Check that the IFD of descending overviews are sorted by increasing
         # offsets
-        ifd_offset = int(ovr_band.GetMetadataItem('IFD_OFFSET', 'TIFF'))
+        ifd_offset = ovr['ifd_offset']
         ifd_offsets.append(ifd_offset)
         details['ifd_offsets']['overview_%d' % i] = ifd_offset
         if ifd_offsets[-1] < ifd_offsets[-2]:
@@ -120,22 +282,32 @@ def validate(ds, check_tiled=True):
                     'which is at byte %d' %
                     (i, ifd_offsets[-1], i - 1, ifd_offsets[-2])]
 
+    # Report sparse blocks, they are not missing
+    details['sparse'] = {}
+    details['sparse_tiles'] = {}
+    for name, level in [('main', main)] + [
+            ('overview_%d' % i, ovr) for i, ovr in enumerate(overviews)]:
+        if level.get('sparse'):
+            details['sparse'][name] = True
+        if level.get('sparse_tiles'):
+            details['sparse_tiles'][name] = level['sparse_tiles']
+
     # Check that the imagery starts by the smallest overview and ends with
     # the main resolution dataset
-    block_offset = main_band.GetMetadataItem('BLOCK_OFFSET_0_0', 'TIFF')
-    if not block_offset:
+    data_offset = main['data_offset']
+    if not data_offset and not main.get('sparse'):
         errors += ['Missing BLOCK_OFFSET_0_0']
-    data_offset = int(block_offset) if block_offset else None
     data_offsets = [data_offset]
     details['data_offsets'] = {}
     details['data_offsets']['main'] = data_offset
-    for i in range(ovr_count):
-        ovr_band = ds.GetRasterBand(1).GetOverview(i)
-        data_offset = int(ovr_band.GetMetadataItem('BLOCK_OFFSET_0_0', 'TIFF'))
+    for i, ovr in enumerate(overviews):
+        data_offset = ovr['data_offset']
         data_offsets.append(data_offset)
         details['data_offsets']['overview_%d' % i] = data_offset
 
-    if data_offsets[-1] < ifd_offsets[-1]:
+    # Levels that only hold sparse blocks have no data to order
+    written = [offset for offset in data_offsets if offset]
+    if written and written[-1] < ifd_offsets[-1]:
         if ovr_count > 0:
             errors += [
                 'The offset of the first block of the smallest overview '
@@ -145,12 +317,14 @@ def validate(ds, check_tiled=True):
                 'The offset of the first block of the image should '
                 'be after its IFD']
     for i in range(len(data_offsets) - 2, 0, -1):
-        if data_offsets[i] < data_offsets[i + 1]:
+        if data_offsets[i] and data_offsets[i + 1] and \
+                data_offsets[i] < data_offsets[i + 1]:
             errors += [
                 'The offset of the first block of overview of index %d should '
                 'be after the one of the overview of index %d' %
                 (i - 1, i)]
-    if len(data_offsets) >= 2 and data_offsets[0] < data_offsets[1]:
+    if len(data_offsets) >= 2 and data_offsets[0] and data_offsets[1] and \
+            data_offsets[0] < data_offsets[1]:
         errors += [
             'The offset of the first block of the main resolution image'
             'should be after the one of the overview of index %d' %
@@ -159,13 +333,110 @@ def validate(ds, check_tiled=True):
     return warnings, errors, details
 
 
+def iter_paths(inputs, file_list=None, patterns=BULK_PATTERNS):
+    """Lazily yield files from directories, globs, paths and a file list.
+
+    Directories are walked recursively for ``patterns``. ``file_list`` is a
+    text file with one path per line ('-' for stdin). Nothing is collected
+    in memory, so this scales to millions of files.
+    """
+    for item in inputs or ():
+        if os.path.isdir(item):
+            for root, _, files in os.walk(item):
+                for name in files:
+                    if any(fnmatch.fnmatch(name, p) for p in patterns):
+                        yield os.path.join(root, name)
+        elif glob.has_magic(item):
+            for path in glob.iglob(item, recursive=True):
+                if os.path.isfile(path):
+                    yield path
+        else:
+            yield item
+
+    if file_list:
+        f = sys.stdin if file_list == '-' else open(file_list)
+        try:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+
+def validate_record(path, backend='gdal', check_tiled=True):
+    """Validate one file into a JSON serializable record."""
+    start = time.time()
+    record = {'path': path}
+    try:
+        warnings, errors, details = validate(path, check_tiled=check_tiled,
+                                             backend=backend)
+        record['valid'] = not errors
+        record['warnings'] = warnings
+        record['errors'] = errors
+        record['ifd_offsets'] = details['ifd_offsets']
+        record['data_offsets'] = details['data_offsets']
+        if 'bytes_read' in details:
+            record['bytes_read'] = details['bytes_read']
+    except Exception as e:
+        record['valid'] = False
+        record['warnings'] = []
+        record['errors'] = ['%s' % e]
+    record['seconds'] = round(time.time() - start, 6)
+    return record
+
+
+def validate_bulk(paths, output=sys.stdout, workers=None, pool='process',
+                  backend='gdal', check_tiled=True):
+    """Validate many files concurrently, streaming JSON Lines to ``output``.
+
+    At most ``4 * workers`` files are in flight, so neither the inputs nor
+    the results are held in memory. Records are written as they complete,
+    not in input order.
+
+    Returns:
+      A summary dictionary.
+    """
+    workers = workers or os.cpu_count() or 1
+    executor_class = ProcessPoolExecutor if pool == 'process' \
+        else ThreadPoolExecutor
+    summary = {'files': 0, 'valid': 0, 'invalid': 0, 'warnings': 0}
+    start = time.time()
+
+    def emit(futures):
+        for future in futures:
+            record = future.result()
+            summary['files'] += 1
+            summary['valid' if record['valid'] else 'invalid'] += 1
+            if record['warnings']:
+                summary['warnings'] += 1
+            output.write(json.dumps(record) + '\n')
+
+    with executor_class(max_workers=workers) as executor:
+        pending = set()
+        for path in paths:
+            if len(pending) >= workers * 4:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                emit(done)
+            pending.add(executor.submit(validate_record, path, backend,
+                                        check_tiled))
+        emit(wait(pending).done)
+
+    output.flush()
+    summary['seconds'] = round(time.time() - start, 3)
+    summary['files_per_second'] = round(
+        summary['files'] / summary['seconds'], 1) if summary['seconds'] else 0
+    return summary
+
+
 """
 -co TILED=YES -co COMPRESS=JPEG -co PHOTOMETRIC=YCBCR -co COPY_SRC_OVERVIEWS=YES \
 -co BLOCKXSIZE=512 -co BLOCKYSIZE=512 --config GDAL_TIFF_OVR_BLOCKSIZE 512
 """
 
 
-def main():
+def main(backend='gdal'):
     """Return 0 in case of success, 1 for failure."""
 
     filename = path_input
@@ -175,7 +446,7 @@ def main():
 
     try:
         ret = 0
-        warnings, errors, _ = validate(filename)
+        warnings, errors, _ = validate(filename, backend=backend)
         if warnings:
             print('The following warnings were found:')
             for warning in warnings:
@@ -207,17 +478,58 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
     parser.add_argument('-p', '--payload',
-                        help='Pass input file', required=True)
+                        help='Pass input file', required=False)
+
+    parser.add_argument('-i', '--inputs',
+                        help='Bulk mode: files, directories or globs',
+                        nargs='+', required=False)
+
+    parser.add_argument('-l', '--file-list',
+                        help='Bulk mode: file with one path per line, '
+                        '- for stdin', required=False)
+
+    parser.add_argument('-o', '--output',
+                        help='Bulk mode: JSON Lines output, default stdout',
+                        required=False)
+
+    parser.add_argument('-w', '--workers',
+                        help='Bulk mode: number of workers, default all CPUs',
+                        type=int, required=False)
+
+    parser.add_argument('--pool',
+                        help='Bulk mode: worker pool type',
+                        choices=['process', 'thread'],
+                        default='process')
+
+    parser.add_argument('-b', '--backend',
+                        help='gdal, or header to parse the TIFF directly',
+                        choices=['gdal', 'header'],
+                        default='gdal')
 
     args = parser.parse_args()
     path_input = args.payload
 
+    if args.inputs or args.file_list:
+        output = open(args.output, 'w') if args.output else sys.stdout
+        try:
+            summary = validate_bulk(
+                iter_paths(args.inputs, args.file_list), output=output,
+                workers=args.workers, pool=args.pool, backend=args.backend)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        sys.stderr.write('Summary: %s\n' % json.dumps(summary))
+        sys.exit(0 if summary['invalid'] == 0 else 1)
+
+    if path_input is None:
+        parser.error('No input file is given')
+
     if not os.path.exists(path_input):
         raise('Error: File not Found')
     
     # Validator starts here
     try:
-        main()
+        main(backend=args.backend)
     except Exception as e:
         raise('Error: Unable to validate and convert. %s' % e)
     sys.exit()
@@ -36,6 +36,9 @@ setup(name='cogconverter',
               'argparse',
               'tqdm'
           ],
+          's3': [
+              'boto3'
+          ],
       },
     #   entry_points="""
     #   [console_scripts]
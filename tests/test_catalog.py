@@ -0,0 +1,23 @@
+import pytest
+
+# The package imports GDAL on import
+pytest.importorskip('osgeo')
+
+from cogconverter import catalog  # noqa: E402
+
+
+def test_scan_skips_repeated_paths(tmp_path):
+    path = tmp_path / 'broken.tif'
+    path.write_bytes(b'not a tiff')
+    db = catalog.Catalog(str(tmp_path / 'catalog.db'))
+    try:
+        summary = db.scan([str(path), str(tmp_path / '.' / 'broken.tif')],
+                          workers=1)
+        assert summary['files'] == 1
+        assert summary['updated'] == 1
+        records = list(db.query())
+        assert len(records) == 1
+        assert records[0]['error']
+        assert records[0]['valid'] == 0
+    finally:
+        db.close()
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+# The package imports GDAL on import
+pytest.importorskip('osgeo')
+
+from cogconverter.src import codec  # noqa: E402
+from cogconverter.src import narrow  # noqa: E402
+
+
+def names(dtype, bands=1):
+    return [c.name for c in codec.candidates(dtype, bands,
+                                             codecs={'LZW', 'JPEG'})]
+
+
+def test_candidates_predictor_follows_dtype():
+    assert names(np.float32) == ['LZW', 'LZW+PREDICTOR=3']
+    assert names(np.uint16) == ['LZW', 'LZW+PREDICTOR=2']
+
+
+def test_candidates_jpeg_for_rgb_bytes():
+    assert 'JPEG+YCBCR' in names(np.uint8, 3)
+    assert 'JPEG+YCBCR' not in names(np.uint16, 3)
+
+
+def test_narrowed_samples_get_integer_predictor():
+    value_range = narrow.ValueRange()
+    value_range.add(np.array([0.0, 200.0]))
+    narrowing = narrow.choose(np.float32, value_range)
+    tile = narrowing.apply(np.array([[[0.0, 200.0]]], dtype=np.float32))
+    assert names(tile.dtype) == ['LZW', 'LZW+PREDICTOR=2']
+
+
+def test_choose_policies():
+    results = [
+        {'name': 'a', 'bytes': 10, 'lossless': False,
+         'decode_mb_per_s': 50},
+        {'name': 'b', 'bytes': 20, 'lossless': True, 'decode_mb_per_s': 90},
+        {'name': 'c', 'bytes': 15, 'lossless': True, 'decode_mb_per_s': 40},
+        {'name': 'd', 'error': 'unsupported'},
+    ]
+    assert codec.choose(results, 'smallest')['name'] == 'a'
+    assert codec.choose(results, 'lossless')['name'] == 'c'
+    assert codec.choose(results, 'fastest-decode')['name'] == 'b'
+    with pytest.raises(codec.CodecException):
+        codec.choose(results[3:], 'smallest')
@@ -0,0 +1,58 @@
+import threading
+
+import numpy as np
+import pytest
+
+# The package imports GDAL on import
+gdal = pytest.importorskip('osgeo.gdal')
+
+from cogconverter.src import copier  # noqa: E402
+
+
+def mem_dataset(data):
+    bands, height, width = data.shape
+    ds = gdal.GetDriverByName('MEM').Create('', width, height, bands,
+                                            gdal.GDT_UInt16)
+    for i in range(bands):
+        ds.GetRasterBand(i + 1).WriteArray(data[i])
+    return ds
+
+
+def test_block_copier_copies_every_strip():
+    data = np.arange(3 * 100 * 70, dtype=np.uint16).reshape(3, 100, 70)
+    src = mem_dataset(data)
+    src.GetRasterBand(1).SetNoDataValue(7)
+    dst = copier.create_like(src, '/vsimem/test_copier_dst.tif',
+                             ['TILED=YES', 'BLOCKXSIZE=32',
+                              'BLOCKYSIZE=32'])
+    try:
+        assert copier.BlockCopier(src, dst, depth=1).run() == data.nbytes
+        assert np.array_equal(dst.ReadAsArray(), data)
+        assert dst.GetRasterBand(1).GetNoDataValue() == 7
+    finally:
+        dst = None
+        gdal.Unlink('/vsimem/test_copier_dst.tif')
+
+
+class FailingDestination(object):
+    """Destination whose first write fails."""
+
+    def __init__(self, src):
+        self.src = src
+
+    def GetRasterBand(self, i):
+        return self
+
+    def GetBlockSize(self):
+        return [self.src.RasterXSize, 4]
+
+    def WriteRaster(self, *args, **kwargs):
+        raise IOError('disk full')
+
+
+def test_block_copier_stops_the_reader_on_error():
+    src = mem_dataset(np.zeros((1, 100, 16), dtype=np.uint16))
+    before = threading.active_count()
+    with pytest.raises(IOError):
+        copier.BlockCopier(src, FailingDestination(src), depth=1).run()
+    assert threading.active_count() == before
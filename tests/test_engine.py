@@ -0,0 +1,122 @@
+import pytest
+
+# The package imports GDAL on import
+pytest.importorskip('osgeo')
+
+from cogconverter.src import engine  # noqa: E402
+
+JOB = {'size': [512, 512], 'bands': 1, 'blocksize': 256}
+
+
+def spool_tiles(journal, spool, tiles):
+    for level, index, data in tiles:
+        offset = spool.tell()
+        spool.write(data)
+        journal.add(level, index, offset, [len(data)], None)
+    journal.commit(spool)
+
+
+def test_journal_resume(tmp_path):
+    path = str(tmp_path / 'out.tif.journal')
+    with open(str(tmp_path / 'out.tif.spool'), 'wb') as spool:
+        journal = engine.Journal(path, JOB)
+        journal.start()
+        spool_tiles(journal, spool, [(0, 0, b'aaaa'), (0, 1, b'bb')])
+        spool_tiles(journal, spool, [(1, 0, b'ccc')])
+        size = spool.tell()
+
+    resumed = engine.Journal(path, dict(JOB))
+    assert resumed.load(size) == size
+    assert resumed.done == {(0, 0): (0, [4]), (0, 1): (4, [2]),
+                            (1, 0): (6, [3])}
+
+
+def test_journal_ignores_batches_past_spool(tmp_path):
+    path = str(tmp_path / 'out.tif.journal')
+    with open(str(tmp_path / 'out.tif.spool'), 'wb') as spool:
+        journal = engine.Journal(path, JOB)
+        journal.start()
+        spool_tiles(journal, spool, [(0, 0, b'aaaa')])
+        spool_tiles(journal, spool, [(0, 1, b'bb')])
+
+    # The spool lost its last batch, only the first one is kept
+    resumed = engine.Journal(path, JOB)
+    assert resumed.load(4) == 4
+    assert list(resumed.done) == [(0, 0)]
+
+
+def test_journal_torn_line(tmp_path):
+    path = str(tmp_path / 'out.tif.journal')
+    with open(str(tmp_path / 'out.tif.spool'), 'wb') as spool:
+        journal = engine.Journal(path, JOB)
+        journal.start()
+        spool_tiles(journal, spool, [(0, 0, b'aaaa')])
+    with open(path, 'a') as f:
+        f.write('{"end": 10, "til')
+
+    resumed = engine.Journal(path, JOB)
+    assert resumed.load(10) == 4
+    assert list(resumed.done) == [(0, 0)]
+
+
+def test_journal_other_job(tmp_path):
+    path = str(tmp_path / 'out.tif.journal')
+    with open(str(tmp_path / 'out.tif.spool'), 'wb') as spool:
+        journal = engine.Journal(path, JOB)
+        journal.start()
+        spool_tiles(journal, spool, [(0, 0, b'aaaa')])
+
+    resumed = engine.Journal(path, dict(JOB, blocksize=512))
+    assert resumed.load(4) == 0
+    assert resumed.done == {}
+
+
+def test_journal_missing(tmp_path):
+    journal = engine.Journal(str(tmp_path / 'none.journal'), JOB)
+    assert journal.load(0) == 0
+
+
+def test_source_identity_changes_with_input(tmp_path):
+    path = tmp_path / 'input.tif'
+    path.write_bytes(b'abc')
+    before = engine.source_identity([str(path)])
+    assert before == [[str(path), 3, path.stat().st_mtime]]
+    path.write_bytes(b'abcd')
+    assert engine.source_identity([str(path)]) != before
+
+
+def test_journal_other_input(tmp_path):
+    path = str(tmp_path / 'out.tif.journal')
+    source = tmp_path / 'input.tif'
+    source.write_bytes(b'abc')
+    job = dict(JOB, source=engine.source_identity([str(source)]))
+    with open(str(tmp_path / 'out.tif.spool'), 'wb') as spool:
+        journal = engine.Journal(path, job)
+        journal.start()
+        spool_tiles(journal, spool, [(0, 0, b'aaaa')])
+
+    source.write_bytes(b'abcdef')
+    job = dict(JOB, source=engine.source_identity([str(source)]))
+    assert engine.Journal(path, job).load(4) == 0
+
+
+def header_check(monkeypatch, header_bytes, strict):
+    from cogconverter import validator
+    monkeypatch.setattr(validator, 'validate', lambda path: (
+        [], [], {'data_offsets': {'main': header_bytes + 4096,
+                                  'overview_0': header_bytes}}))
+    job = engine.TileEngine.__new__(engine.TileEngine)
+    job.path_output = 'out.tif'
+    job.header_prefetch = 16384
+    job.header_strict = strict
+    job.check()
+
+
+def test_check_header_within_prefetch(monkeypatch):
+    header_check(monkeypatch, 16384, strict=True)
+
+
+def test_check_header_beyond_prefetch(monkeypatch):
+    header_check(monkeypatch, 20000, strict=False)
+    with pytest.raises(engine.EngineException):
+        header_check(monkeypatch, 20000, strict=True)
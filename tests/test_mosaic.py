@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+# The package imports GDAL on import
+gdal = pytest.importorskip('osgeo.gdal')
+osr = pytest.importorskip('osgeo.osr')
+
+from cogconverter.src import mosaic  # noqa: E402
+
+
+def write_input(path, data, origin_x, resolution, no_data=None):
+    height, width = data.shape
+    ds = gdal.GetDriverByName('GTiff').Create(str(path), width, height, 1,
+                                              gdal.GDT_Byte)
+    ds.SetGeoTransform((origin_x, resolution, 0, 10, 0, -resolution))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    ds.SetProjection(srs.ExportToWkt())
+    if no_data is not None:
+        ds.GetRasterBand(1).SetNoDataValue(no_data)
+    ds.GetRasterBand(1).WriteArray(data)
+    ds = None
+    return str(path)
+
+
+def test_read_resamples_from_fractional_windows(tmp_path):
+    fine = write_input(tmp_path / 'fine.tif',
+                       np.full((8, 8), 1, np.uint8), 0, 1, no_data=0)
+    # Offset by half of its own pixel from the mosaic grid
+    coarse = write_input(tmp_path / 'coarse.tif',
+                         np.array([[10, 20, 30]] * 4, np.uint8), 1, 2,
+                         no_data=0)
+    with mosaic.Mosaic([fine, coarse], overlap='last',
+                       folder=str(tmp_path)) as m:
+        out = m.read(0, 0, 8, 8, 8, 8)
+    assert list(out[0, 0]) == [1, 10, 10, 20, 20, 30, 30, 1]
+
+
+def test_last_overlap_keeps_valid_pixels(tmp_path):
+    first = write_input(tmp_path / 'first.tif',
+                        np.full((4, 4), 5, np.uint8), 0, 1, no_data=0)
+    collar = np.full((4, 4), 9, np.uint8)
+    collar[:, :2] = 0
+    last = write_input(tmp_path / 'last.tif', collar, 0, 1, no_data=0)
+    with mosaic.Mosaic([first, last], overlap='last',
+                       folder=str(tmp_path)) as m:
+        out = m.read(0, 0, 4, 4, 4, 4)
+    assert list(out[0, 0]) == [5, 5, 9, 9]
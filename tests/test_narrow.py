@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+
+# The package imports GDAL on import
+pytest.importorskip('osgeo')
+
+from cogconverter.src import narrow  # noqa: E402
+
+
+def value_range(*values):
+    result = narrow.ValueRange()
+    result.add(np.array(values))
+    return result
+
+
+def test_choose_integral_floats():
+    narrowing = narrow.choose(np.float32, value_range(0.0, 3.0, 250.0))
+    assert narrowing.target == np.uint8
+    assert narrowing.changed
+
+
+def test_choose_keeps_nodata_when_it_fits():
+    narrowing = narrow.choose(np.int32, value_range(1, 1000), no_data=0)
+    assert narrowing.target == np.uint16
+    assert narrowing.target_no_data == 0
+
+
+def test_choose_moves_nodata_out_of_range():
+    narrowing = narrow.choose(np.float32, value_range(0.0, 100.0),
+                              no_data=-9999.0)
+    assert narrowing.target == np.uint8
+    assert narrowing.target_no_data == 255
+
+
+def test_choose_nan_nodata():
+    narrowing = narrow.choose(np.float64, value_range(1.0, 2.0),
+                              no_data=float('nan'))
+    assert narrowing.target == np.uint8
+    assert narrowing.target_no_data == 255
+
+
+def test_choose_float64_exact_in_float32():
+    narrowing = narrow.choose(np.float64, value_range(0.5, 1.25))
+    assert narrowing.target == np.float32
+
+
+def test_choose_keeps_dtype():
+    narrowing = narrow.choose(np.float32, value_range(0.1, 2.5))
+    assert narrowing.target == np.float32
+    assert not narrowing.changed
+
+
+def test_choose_keeps_nan_nodata():
+    narrowing = narrow.choose(np.float32, value_range(0.1, 70000.5),
+                              no_data=float('nan'))
+    assert narrowing.target == np.float32
+    assert not narrowing.changed
+
+
+def test_choose_only_nodata():
+    narrowing = narrow.choose(np.float32, narrow.ValueRange(), no_data=0)
+    assert not narrowing.changed
+
+
+def test_apply_remaps_nodata():
+    narrowing = narrow.choose(np.float32, value_range(0.0, 100.0),
+                              no_data=-9999.0)
+    out = narrowing.apply(np.array([[-9999.0, 4.0], [100.0, 0.4]],
+                                   dtype=np.float32))
+    assert out.dtype == np.uint8
+    assert out.tolist() == [[255, 4], [100, 0]]
+
+
+def test_plan():
+    gdal = pytest.importorskip('osgeo.gdal')
+    ds = gdal.GetDriverByName('MEM').Create('', 64, 32, 1, gdal.GDT_Float32)
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(-1)
+    data = np.arange(64 * 32, dtype=np.float32).reshape(32, 64) % 300
+    data[0, 0] = -1
+    band.WriteArray(data)
+    narrowing = narrow.plan(ds)
+    assert narrowing.source == np.float32
+    assert narrowing.target == np.uint16
+    assert narrowing.target_no_data == 65535
+
+
+def test_plan_nan_nodata_unchanged():
+    gdal = pytest.importorskip('osgeo.gdal')
+    ds = gdal.GetDriverByName('MEM').Create('', 64, 32, 1, gdal.GDT_Float32)
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(float('nan'))
+    data = np.linspace(-1e6, 1e6, 64 * 32, dtype=np.float32).reshape(32, 64)
+    data[0, :8] = np.nan
+    band.WriteArray(data)
+    narrowing = narrow.plan(ds)
+    assert narrowing.target == np.float32
+    assert not narrowing.changed
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+# The package imports GDAL on import
+pytest.importorskip('osgeo')
+
+from cogconverter.src import overview  # noqa: E402
+
+
+def test_reduce_nearest_takes_centre_pixel():
+    array = np.arange(16, dtype=np.uint8).reshape(1, 4, 4)
+    valid = np.ones(array.shape, dtype=bool)
+    out, out_valid = overview.reduce(array, valid, 2, 'NEAREST')
+    # GDAL samples pixel j * 2 + 1 along both axes
+    assert out.tolist() == [[[5, 7], [13, 15]]]
+    assert out_valid.all()
+
+
+def test_reduce_nearest_skips_nodata_centre():
+    array = np.arange(16, dtype=np.uint8).reshape(1, 4, 4)
+    valid = overview.valid_mask(array, no_data=5)
+    out, _ = overview.reduce(array, valid, 2, 'NEAREST')
+    assert out[0, 0, 0] == 0
+
+
+def test_reduce_nearest_edge_block():
+    array = np.arange(9, dtype=np.uint8).reshape(1, 3, 3)
+    valid = np.ones(array.shape, dtype=bool)
+    out, out_valid = overview.reduce(array, valid, 2, 'NEAREST', fill=99)
+    assert out.shape == (1, 2, 2)
+    assert out_valid.all()
+    assert out[0, 0, 0] == 4
+
+
+def test_reduce_average_ignores_invalid():
+    array = np.array([[[1, 3], [0, 8]]], dtype=np.uint8)
+    valid = overview.valid_mask(array, no_data=0)
+    out, out_valid = overview.reduce(array, valid, 2, 'AVERAGE')
+    assert out.tolist() == [[[4]]]
+
+
+def test_reduce_all_invalid_filled():
+    array = np.zeros((1, 2, 2), dtype=np.float32)
+    valid = overview.valid_mask(array, no_data=0)
+    out, out_valid = overview.reduce(array, valid, 2, 'MAX', fill=-1)
+    assert out.tolist() == [[[-1]]]
+    assert not out_valid.any()
+
+
+def test_plan_strips_fits_the_budget():
+    assert overview.plan_strips(4096, 3, 1, 2, 'AVERAGE', 512, 4,
+                                memory_mb=512) == (512, 4)
+    # A wide raster gets shorter strips and fewer of them in flight
+    rows, in_flight = overview.plan_strips(400000, 4, 2, 2, 'AVERAGE', 512,
+                                           64, memory_mb=512)
+    row_bytes = 400000 * 2 * 4 * (4 * 2 + 2)
+    assert rows < 512
+    assert (in_flight + 1) * rows * row_bytes <= 512 * 1024 * 1024
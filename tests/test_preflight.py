@@ -0,0 +1,38 @@
+import json
+
+import pytest
+
+# The package imports GDAL on import
+pytest.importorskip('osgeo')
+
+from cogconverter.src import preflight  # noqa: E402
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    path = str(tmp_path / 'preflight.json')
+    cache = preflight.PreflightCache(path, max_entries=2)
+    cache.put('a', {'compliant': True})
+    cache.put('b', {'compliant': False})
+    assert cache.get('a') == {'compliant': True}
+    cache.put('c', {'compliant': True})
+    assert cache.get('b') is None
+    with open(path) as f:
+        assert sorted(json.load(f)) == ['a', 'c']
+
+
+def test_cache_merges_concurrent_writers(tmp_path):
+    path = str(tmp_path / 'preflight.json')
+    first = preflight.PreflightCache(path)
+    second = preflight.PreflightCache(path)
+    first.put('a', {'compliant': True})
+    second.put('b', {'compliant': True})
+    assert sorted(preflight.PreflightCache(path).entries) == ['a', 'b']
+
+
+def test_cache_ignores_corrupt_file(tmp_path):
+    path = tmp_path / 'preflight.json'
+    path.write_text('{"a": ')
+    cache = preflight.PreflightCache(str(path))
+    assert cache.get('a') is None
+    cache.put('a', {'compliant': True})
+    assert json.loads(path.read_text()) == {'a': {'compliant': True}}
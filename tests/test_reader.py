@@ -0,0 +1,67 @@
+import pytest
+
+# The package imports GDAL on import
+pytest.importorskip('osgeo')
+
+from cogconverter import reader  # noqa: E402
+
+
+def test_coalesce_merges_within_gap():
+    ranges = [(0, 10), (15, 5), (100, 10)]
+    assert reader.coalesce(ranges, gap=5) == [(0, 20, [0, 1]),
+                                              (100, 10, [2])]
+
+
+def test_coalesce_gap_zero_only_touching():
+    ranges = [(0, 10), (10, 5), (16, 4)]
+    assert reader.coalesce(ranges, gap=0) == [(0, 15, [0, 1]),
+                                              (16, 4, [2])]
+
+
+def test_coalesce_sorts_and_keeps_indices():
+    ranges = [(200, 10), (0, 10), (205, 20)]
+    assert reader.coalesce(ranges, gap=0) == [(0, 10, [1]),
+                                              (200, 25, [0, 2])]
+
+
+def test_coalesce_skips_sparse_tiles():
+    ranges = [(0, 10), (0, 0), (10, 10)]
+    assert reader.coalesce(ranges, gap=0) == [(0, 20, [0, 2])]
+
+
+def test_coalesce_contained_range():
+    assert reader.coalesce([(0, 100), (10, 5)], gap=0) == [(0, 100, [0, 1])]
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = reader.LruCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_lru_cache_bounded_by_size():
+    cache = reader.LruCache(10, sizeof=len)
+    cache.put('a', 'x' * 6)
+    cache.put('b', 'x' * 6)
+    assert cache.get('a') is None
+    assert cache.size == 6
+    # Larger than the whole cache, never stored
+    cache.put('c', 'x' * 11)
+    assert cache.get('c') is None
+    assert cache.get('b') == 'x' * 6
+
+
+def test_lru_cache_replace_updates_size():
+    cache = reader.LruCache(10, sizeof=len)
+    cache.put('a', 'x' * 4)
+    cache.put('a', 'x' * 8)
+    assert cache.size == 8
+    cache.clear()
+    assert cache.size == 0
+    assert cache.get('a') is None
@@ -0,0 +1,120 @@
+import threading
+
+import pytest
+
+# The package imports GDAL on import
+pytest.importorskip('osgeo')
+
+from cogconverter.src import sink  # noqa: E402
+
+
+class StubS3(object):
+    """In-memory stand-in for the boto3 S3 client calls of S3Sink."""
+
+    def __init__(self, failures=None):
+        # Part number to the number of times its upload fails
+        self.failures = dict(failures or {})
+        self.objects = {}
+        self.parts = {}
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.calls.append('create')
+        return {'UploadId': 'upload'}
+
+    def upload_part(self, Bucket, Key, PartNumber, UploadId, Body):
+        with self.lock:
+            self.calls.append('part')
+            if self.failures.get(PartNumber):
+                self.failures[PartNumber] -= 1
+                raise IOError('part %d failed' % PartNumber)
+            self.parts[PartNumber] = Body
+        return {'ETag': 'etag%d' % PartNumber}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId,
+                                  MultipartUpload):
+        self.calls.append('complete')
+        numbers = [p['PartNumber'] for p in MultipartUpload['Parts']]
+        assert numbers == list(range(1, len(numbers) + 1))
+        self.objects[Key] = b''.join(self.parts[n] for n in numbers)
+
+    def put_object(self, Bucket, Key, Body):
+        self.calls.append('put')
+        self.objects[Key] = Body
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.calls.append('abort')
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(sink.time, 'sleep', lambda seconds: None)
+
+
+DATA = bytes(bytearray(range(256))) * (48 * 1024)
+
+
+def write(out, data, chunk=100000):
+    for i in range(0, len(data), chunk):
+        out.write(data[i:i + chunk])
+
+
+def test_multipart_upload():
+    client = StubS3()
+    with sink.S3Sink('s3://bucket/out.tif', part_mb=5, workers=2,
+                     client=client) as out:
+        write(out, DATA)
+    assert client.objects['out.tif'] == DATA
+    assert client.calls.count('part') == 3
+    assert client.calls[-1] == 'complete'
+
+
+def test_small_output_is_one_put():
+    client = StubS3()
+    with sink.S3Sink('s3://bucket/small.tif', client=client) as out:
+        out.write(b'header')
+    assert client.objects['small.tif'] == b'header'
+    assert client.calls == ['put']
+
+
+def test_failed_part_is_retried():
+    client = StubS3(failures={2: 2})
+    with sink.S3Sink('s3://bucket/out.tif', part_mb=5, retries=2,
+                     client=client) as out:
+        write(out, DATA)
+    assert client.objects['out.tif'] == DATA
+    assert client.calls.count('part') == 5
+
+
+def test_error_aborts_the_upload():
+    client = StubS3(failures={1: 10})
+    with pytest.raises(IOError):
+        with sink.S3Sink('s3://bucket/out.tif', part_mb=5, retries=1,
+                         client=client) as out:
+            write(out, DATA)
+    assert 'abort' in client.calls
+    assert 'complete' not in client.calls
+    assert 'out.tif' not in client.objects
+
+
+def test_expected_size_keeps_parts_under_the_limit():
+    size = 200 * 1024 ** 3
+    out = sink.S3Sink('s3://bucket/huge.tif', part_mb=5, client=StubS3(),
+                      expected_size=size)
+    out.executor.shutdown()
+    assert out.part_size * sink.S3_MAX_PARTS >= size
+    out = sink.S3Sink('s3://bucket/out.tif', part_mb=5, client=StubS3(),
+                      expected_size=len(DATA))
+    out.executor.shutdown()
+    assert out.part_size == 5 * 1024 * 1024
+
+
+def test_too_many_parts_fails(monkeypatch):
+    monkeypatch.setattr(sink, 'S3_MAX_PARTS', 2)
+    client = StubS3()
+    with pytest.raises(sink.SinkException):
+        with sink.S3Sink('s3://bucket/out.tif', part_mb=5,
+                         client=client) as out:
+            write(out, DATA)
+    assert 'abort' in client.calls
@@ -0,0 +1,75 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+# The package imports GDAL on import
+gdal = pytest.importorskip('osgeo.gdal')
+
+from cogconverter.src import split  # noqa: E402
+
+
+def test_requeue_only_takes_back_stale_tasks(tmp_path):
+    queue = split.WorkQueue(str(tmp_path))
+    queue.put('stale', {'id': 'stale'})
+    queue.put('alive', {'id': 'alive'})
+    assert queue.claim()[0] == 'alive.json'
+    assert queue.claim()[0] == 'stale.json'
+    old = time.time() - 600
+    os.utime(queue.path('doing', 'stale.json'), (old, old))
+
+    assert queue.requeue(older_than=300) == 1
+    assert queue.names('todo') == ['stale.json']
+    assert queue.names('doing') == ['alive.json']
+
+
+def test_finish_and_retry(tmp_path):
+    queue = split.WorkQueue(str(tmp_path))
+    queue.put('shard', {'id': 'shard'})
+    name, task = queue.claim()
+    queue.finish(name, task, error='boom')
+    assert os.listdir(os.path.join(str(tmp_path), 'failed')) == [name]
+    assert list(queue.tasks('failed'))[0]['attempts'] == 1
+
+    assert queue.retry(max_attempts=1) == 0
+    assert queue.retry(max_attempts=2) == 1
+    name, task = queue.claim()
+    queue.finish(name, task)
+    assert list(queue.tasks('done'))[0] == {'id': 'shard', 'attempts': 1}
+
+
+def test_shards_share_codec_and_dtype(tmp_path):
+    # Left shard fits uint8, right shard needs uint16
+    data = np.zeros((32, 64), dtype=np.float32)
+    data[:, :32] = np.arange(32 * 32).reshape(32, 32) % 200
+    data[:, 32:] = np.arange(32 * 32).reshape(32, 32) * 50
+    path = str(tmp_path / 'ranges.tif')
+    ds = gdal.GetDriverByName('GTiff').Create(path, 64, 32, 1,
+                                              gdal.GDT_Float32)
+    ds.SetGeoTransform((0, 0.1, 0, 10, 0, -0.1))
+    ds.SetProjection('EPSG:4326')
+    ds.GetRasterBand(1).WriteArray(data)
+    ds = None
+
+    folder_output = str(tmp_path / 'shards')
+    os.makedirs(folder_output)
+    queue = split.plan(path, folder_output, blocksize=16, shard_px=32,
+                       options={'compression': 'auto', 'narrowing': True,
+                                'statistics': False})
+    assert split.run(queue, workers=1) == 0
+    _, path_vrt = split.manifest(queue, folder_output)
+
+    dtypes = set()
+    codecs = set()
+    for task in queue.tasks('done'):
+        shard = gdal.Open(task['path'])
+        dtypes.add(shard.GetRasterBand(1).DataType)
+        codecs.add(shard.GetMetadata('IMAGE_STRUCTURE').get('COMPRESSION'))
+        shard = None
+    assert dtypes == {gdal.GDT_UInt16}
+    assert len(codecs) == 1
+
+    vrt = gdal.Open(path_vrt)
+    assert (vrt.RasterXSize, vrt.RasterYSize) == (64, 32)
+    assert np.array_equal(vrt.ReadAsArray(), data.astype(np.uint16))
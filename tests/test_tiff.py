@@ -0,0 +1,147 @@
+import struct
+
+import pytest
+
+# The package imports GDAL on import
+pytest.importorskip('osgeo')
+
+from cogconverter.src import tiff  # noqa: E402
+
+
+def level_tags(width, height, tile=256, overview=False):
+    tags = {
+        tiff.IMAGE_WIDTH: (tiff.LONG, (width,)),
+        tiff.IMAGE_LENGTH: (tiff.LONG, (height,)),
+        tiff.BITS_PER_SAMPLE: (tiff.SHORT, (8,)),
+        tiff.COMPRESSION: (tiff.SHORT, (1,)),
+        tiff.TILE_WIDTH: (tiff.SHORT, (tile,)),
+        tiff.TILE_LENGTH: (tiff.SHORT, (tile,)),
+    }
+    if overview:
+        tags[tiff.NEW_SUBFILE_TYPE] = (tiff.LONG, (1,))
+    return tags
+
+
+def assemble(level_tags, tile_sizes, orders=None):
+    """Header followed by tiles filled with their own index."""
+    header, offsets = tiff.build_header(level_tags, tile_sizes, orders)
+    data = bytearray(header)
+    for level, index in tiff.data_order(tile_sizes, orders):
+        size = tile_sizes[level][index]
+        assert offsets[level][index] == (len(data) if size else 0)
+        data += bytes([index % 256]) * size
+    return bytes(data), offsets
+
+
+def test_build_header_round_trip():
+    tags = [level_tags(512, 512), level_tags(256, 256, overview=True)]
+    sizes = [[10, 20, 0, 40], [5]]
+    data, offsets = assemble(tags, sizes)
+
+    endian, bigtiff, ifds = tiff.read_ifds(tiff.bytes_reader(data))
+    assert (endian, bigtiff) == ('<', True)
+    assert len(ifds) == 2
+    assert (ifds[0].width, ifds[0].height) == (512, 512)
+    assert ifds[1].is_overview
+    for ifd, level_sizes, level_offsets in zip(ifds, sizes, offsets):
+        assert tuple(ifd.block_byte_counts()) == tuple(level_sizes)
+        assert tuple(ifd.block_offsets()) == tuple(level_offsets)
+        assert ifd.tags[tiff.TILE_OFFSETS][0] == tiff.LONG
+
+
+def test_build_header_ifds_before_data():
+    tags = [level_tags(512, 512), level_tags(256, 256, overview=True)]
+    sizes = [[10, 20, 30, 40], [5]]
+    header, offsets = tiff.build_header(tags, sizes)
+    assert min(min(o) for o in offsets) == len(header)
+    # Smallest overview first, full resolution last
+    assert offsets[1][0] < offsets[0][0]
+
+
+def test_build_header_sparse_tiles():
+    data, offsets = assemble([level_tags(512, 256)], [[0, 7]])
+    _, _, ifds = tiff.read_ifds(tiff.bytes_reader(data))
+    assert ifds[0].block_offsets() == (0, offsets[0][1])
+    assert ifds[0].block_byte_counts() == (0, 7)
+
+
+def test_build_header_long8_beyond_4gib():
+    sizes = [[1 << 31, 1 << 31, 16]]
+    header, offsets = tiff.build_header([level_tags(768, 256)], sizes)
+    _, _, ifds = tiff.read_ifds(tiff.bytes_reader(header))
+    assert ifds[0].tags[tiff.TILE_OFFSETS][0] == tiff.LONG8
+    assert ifds[0].block_offsets()[2] == offsets[0][2] > 1 << 32
+
+
+def test_build_header_needs_sizes_per_level():
+    with pytest.raises(tiff.TiffException):
+        tiff.build_header([level_tags(256, 256)], [[1], [1]])
+
+
+def test_data_order_default():
+    sizes = [[1, 1, 1], [1]]
+    assert list(tiff.data_order(sizes)) == [(1, 0), (0, 0), (0, 1), (0, 2)]
+
+
+def test_data_order_follows_orders():
+    sizes = [[1, 1, 1], [1]]
+    orders = [[2, 0, 1], None]
+    assert list(tiff.data_order(sizes, orders)) == \
+        [(1, 0), (0, 2), (0, 0), (0, 1)]
+
+
+def test_hilbert_order_2x2():
+    assert tiff.hilbert_order(2, 2) == [0, 2, 3, 1]
+
+
+@pytest.mark.parametrize('tiles_x, tiles_y', [(1, 1), (3, 5), (8, 8),
+                                              (7, 2)])
+def test_hilbert_order_is_permutation(tiles_x, tiles_y):
+    order = tiff.hilbert_order(tiles_x, tiles_y)
+    assert sorted(order) == list(range(tiles_x * tiles_y))
+
+
+def test_hilbert_order_neighbours_adjacent():
+    # On a full power of two grid every step moves to a neighbouring tile
+    order = tiff.hilbert_order(8, 8)
+    for a, b in zip(order, order[1:]):
+        assert abs(a % 8 - b % 8) + abs(a // 8 - b // 8) == 1
+
+
+def test_hilbert_order_keeps_planes_together():
+    order = tiff.hilbert_order(2, 2, planes=3)
+    assert order[:3] == [0, 4, 8]
+    assert sorted(order) == list(range(12))
+
+
+def test_hilbert_order_round_trip():
+    tags = [level_tags(768, 512)]
+    sizes = [[3, 4, 5, 6, 7, 8]]
+    orders = [tiff.hilbert_order(3, 2)]
+    data, offsets = assemble(tags, sizes, orders)
+    _, _, ifds = tiff.read_ifds(tiff.bytes_reader(data))
+    for index, (offset, size) in enumerate(zip(ifds[0].block_offsets(),
+                                               ifds[0].block_byte_counts())):
+        assert data[offset:offset + size] == bytes([index]) * size
+
+
+def test_range_reader_prefetch():
+    data = bytes(range(256)) * 4
+    fetched = []
+
+    def fetch(offset, size):
+        fetched.append((offset, size))
+        return data[offset:offset + size]
+
+    reader = tiff.RangeReader(fetch, prefetch=64)
+    assert reader.read(0, 8) == data[:8]
+    assert reader.read(8, 16) == data[8:24]
+    assert reader.requests == 1
+    assert reader.fetch_range(500, 10) == data[500:510]
+    assert fetched == [(0, 64), (500, 10)]
+    assert reader.bytes_read == 74
+
+
+def test_read_header_rejects_garbage():
+    with pytest.raises((tiff.TiffException, struct.error)):
+        tiff.read_ifds(tiff.bytes_reader(b'not a tiff file'))